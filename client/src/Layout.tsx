@@ -1,6 +1,7 @@
-import React, { useState } from "react";
+import React, { useState, useEffect, useRef, useCallback } from "react";
 import { NavLink } from "react-router-dom";
 import axios from "axios";
+import { SyncStatus, getSyncStatus, waitForSync, describeSync } from "./services.tsx";
 
 interface LayoutProps {
   userId: string;
@@ -14,17 +15,58 @@ function Layout({ userId, token, userName, onLogout, children }: LayoutProps) {
   const [refreshing, setRefreshing] = useState(false);
   const [fullRefreshing, setFullRefreshing] = useState(false);
   const [refreshMsg, setRefreshMsg] = useState("");
+  const [syncStatus, setSyncStatus] = useState<SyncStatus | null>(null);
+  const [syncError, setSyncError] = useState("");
+  const mounted = useRef(true);
+
+  // follow the job until it's done, the post only starts it
+  const followSync = useCallback(async (doneMsg: string, isActive = () => mounted.current) => {
+    setSyncError("");
+    try {
+      const final = await waitForSync(userId, setSyncStatus, isActive);
+      if (!final) return;
+      if (final.status === "failed") {
+        setRefreshMsg("error");
+        setSyncError(final.error || "sync failed");
+      } else {
+        setRefreshMsg(doneMsg);
+        setTimeout(() => setRefreshMsg(""), 4000);
+      }
+    } catch {
+      setRefreshMsg("error");
+      setSyncError("couldn't get the sync status");
+    } finally {
+      setSyncStatus(null);
+    }
+  }, [userId]);
+
+  // a sync may already be running, e.g. the first one after logging in
+  useEffect(() => {
+    let active = true;
+    mounted.current = true;
+    getSyncStatus(userId)
+      .then((res) => {
+        if (active && (res.data.status === "queued" || res.data.status === "running")) {
+          setRefreshing(true);
+          followSync("synced", () => active).finally(() => setRefreshing(false));
+        }
+      })
+      .catch(() => {});
+    return () => {
+      active = false;
+      mounted.current = false;
+    };
+  }, [userId, followSync]);
 
   const handleRefresh = async () => {
     setRefreshing(true);
     setRefreshMsg("");
     try {
       await axios.post("/api/cache/refresh", { user_id: userId, token });
-      setRefreshMsg("synced");
-      setTimeout(() => setRefreshMsg(""), 3000);
+      await followSync("synced");
     } catch {
       setRefreshMsg("error");
-      setTimeout(() => setRefreshMsg(""), 3000);
+      setSyncError("couldn't start the sync");
     } finally {
       setRefreshing(false);
     }
@@ -36,11 +78,10 @@ function Layout({ userId, token, userName, onLogout, children }: LayoutProps) {
     setRefreshMsg("");
     try {
       await axios.post("/api/cache/full_refresh", { user_id: userId, token });
-      setRefreshMsg("full sync done");
-      setTimeout(() => setRefreshMsg(""), 4000);
+      await followSync("full sync done");
     } catch {
       setRefreshMsg("error");
-      setTimeout(() => setRefreshMsg(""), 3000);
+      setSyncError("couldn't start the sync");
     } finally {
       setFullRefreshing(false);
     }
@@ -129,7 +170,7 @@ function Layout({ userId, token, userName, onLogout, children }: LayoutProps) {
               transition: "color 0.2s",
             }}
           >
-            {refreshing ? "syncing..." : refreshMsg || "refresh cache"}
+            {refreshing ? (syncStatus ? describeSync(syncStatus) : "syncing...") : refreshMsg || "refresh cache"}
           </button>
 
           {/* full refresh */}
@@ -148,9 +189,15 @@ function Layout({ userId, token, userName, onLogout, children }: LayoutProps) {
               transition: "color 0.2s",
             }}
           >
-            {fullRefreshing ? "rebuilding..." : "full refresh"}
+            {fullRefreshing ? (syncStatus ? describeSync(syncStatus) : "rebuilding...") : "full refresh"}
           </button>
 
+          {syncError && (
+            <div style={{ fontSize: "0.75rem", color: "#ff4d4d", marginBottom: "8px", paddingLeft: "4px", overflowWrap: "anywhere" }}>
+              {syncError}
+            </div>
+          )}
+
           <button
             onClick={onLogout}
             disabled={busy}
@@ -1,6 +1,7 @@
 import React, { useState } from "react";
 import { useNavigate } from "react-router-dom";
 import axios from "axios";
+import { waitForSync, describeSync } from "./services.tsx";
 
 type MenuProps = {
   userName: string;
@@ -19,12 +20,13 @@ const Menu: React.FC<MenuProps> = ({ userName, userId, token, onLogout }) => {
     setLoading(true);
     setMessage("");
     try {
-      const res = await axios.post(
+      await axios.post(
         "/api/cache/refresh",
         { user_id: userId, token },
         { headers: { "Content-Type": "application/json" } }
       );
-      setMessage(res.data.message || "cache refreshed successfully");
+      const final = await waitForSync(userId, (status) => setMessage(describeSync(status)));
+      setMessage(final?.status === "failed" ? `error refreshing cache: ${final.error}` : "cache refreshed successfully");
     } catch (error) {
       setMessage("error refreshing cache");
     } finally {
@@ -4,6 +4,8 @@ import axios from "axios";
 import MiniPlayer from "./MiniPlayer.tsx";
 
 const PAGE_SIZE = 50;
+// tracks asked from the server at a time, more are loaded when paging past them
+const FETCH_SIZE = 500;
 
 interface Artist {
   id: string;
@@ -18,6 +20,12 @@ interface Track {
   preview_url?: string | null;
 }
 
+interface SearchPage {
+  tracks: Track[];
+  total: number;
+  has_more: boolean;
+}
+
 interface Playlist {
   id: string;
   name: string;
@@ -73,6 +81,9 @@ function Search({ userId, token }: SearchProps) {
   const [likedOnly, setLikedOnly] = useState(false);
   const [loading, setLoading] = useState(false);
   const [searchResults, setSearchResults] = useState<Track[]>([]);
+  const [totalResults, setTotalResults] = useState(0);
+  const [hasMore, setHasMore] = useState(false);
+  const lastPayload = useRef<Record<string, unknown> | null>(null);
   const [selectedTracks, setSelectedTracks] = useState<Set<string>>(new Set());
   const [message, setMessage] = useState<{ text: string; type: "success" | "error" } | null>(null);
   const [currentPage, setCurrentPage] = useState(0);
@@ -84,7 +95,7 @@ function Search({ userId, token }: SearchProps) {
   const [selectedPlaylistId, setSelectedPlaylistId] = useState("");
   const [playlists, setPlaylists] = useState<Playlist[]>([]);
 
-  const totalPages = Math.ceil(searchResults.length / PAGE_SIZE);
+  const totalPages = Math.ceil(totalResults / PAGE_SIZE);
   const currentPageTracks = searchResults.slice(currentPage * PAGE_SIZE, (currentPage + 1) * PAGE_SIZE);
   const allOnPageSelected = currentPageTracks.length > 0 && currentPageTracks.every((t) => selectedTracks.has(t.id));
 
@@ -191,17 +202,45 @@ function Search({ userId, token }: SearchProps) {
       if (hasArtist) payload.artists = filledArtists;
       if (hasTime) { payload.start_year = startYear; payload.end_year = endYear; }
       if (hasGenre) payload.genres = filledGenres;
-      const res = await axios.post<Track[]>("/api/search_category", payload);
-      setSearchResults(res.data);
+      const res = await axios.post<SearchPage>("/api/search_category", { ...payload, limit: FETCH_SIZE, offset: 0 });
+      lastPayload.current = payload;
+      setSearchResults(res.data.tracks);
+      setTotalResults(res.data.total);
+      setHasMore(res.data.has_more);
       setSelectedTracks(new Set());
       setCurrentPage(0);
     } catch {
       setSearchResults([]);
+      setTotalResults(0);
+      setHasMore(false);
+      setMessage({ text: "search failed", type: "error" });
     } finally {
       setLoading(false);
     }
   };
 
+  const goToNextPage = async () => {
+    const next = currentPage + 1;
+    // the next page goes past what's loaded, fetch the following batch first
+    if (hasMore && lastPayload.current && searchResults.length < (next + 1) * PAGE_SIZE) {
+      setLoading(true);
+      try {
+        const res = await axios.post<SearchPage>("/api/search_category", {
+          ...lastPayload.current, limit: FETCH_SIZE, offset: searchResults.length,
+        });
+        setSearchResults((prev) => [...prev, ...res.data.tracks]);
+        setTotalResults(res.data.total);
+        setHasMore(res.data.has_more);
+      } catch {
+        setMessage({ text: "error loading more results", type: "error" });
+        return;
+      } finally {
+        setLoading(false);
+      }
+    }
+    setCurrentPage(next);
+  };
+
   const toggleTrack = (id: string) => {
     setSelectedTracks((prev) => {
       const s = new Set(prev);
@@ -456,7 +495,7 @@ function Search({ userId, token }: SearchProps) {
         <div style={{ marginTop: "28px" }}>
           <div style={{ display: "flex", alignItems: "center", gap: "12px", marginBottom: "12px", flexWrap: "wrap" }}>
             <span style={{ fontSize: "0.9rem", color: "var(--muted)" }}>
-              {searchResults.length} results
+              {totalResults} results
             </span>
             <button onClick={toggleSelectAllOnPage} style={pillBtn(allOnPageSelected)}>
               {allOnPageSelected ? "deselect page" : "select page"}
@@ -465,7 +504,7 @@ function Search({ userId, token }: SearchProps) {
               <>
                 <button onClick={() => setCurrentPage((p) => p - 1)} disabled={currentPage === 0} style={pillBtn(false)}>← prev</button>
                 <span style={{ fontSize: "0.85rem", color: "var(--muted)" }}>{currentPage + 1} / {totalPages}</span>
-                <button onClick={() => setCurrentPage((p) => p + 1)} disabled={currentPage >= totalPages - 1} style={pillBtn(false)}>next →</button>
+                <button onClick={goToNextPage} disabled={loading || currentPage >= totalPages - 1} style={pillBtn(false)}>next →</button>
               </>
             )}
             {selectedTracks.size > 0 && (
@@ -535,7 +574,7 @@ function Search({ userId, token }: SearchProps) {
             <div style={{ display: "flex", alignItems: "center", gap: "12px", marginTop: "16px" }}>
               <button onClick={() => setCurrentPage((p) => p - 1)} disabled={currentPage === 0} style={pillBtn(false)}>← prev</button>
               <span style={{ fontSize: "0.85rem", color: "var(--muted)" }}>{currentPage + 1} / {totalPages}</span>
-              <button onClick={() => setCurrentPage((p) => p + 1)} disabled={currentPage >= totalPages - 1} style={pillBtn(false)}>next →</button>
+              <button onClick={goToNextPage} disabled={loading || currentPage >= totalPages - 1} style={pillBtn(false)}>next →</button>
             </div>
           )}
         </div>
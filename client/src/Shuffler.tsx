@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from "react";
 import axios from "axios";
+import { SYNC_DONE_EVENT } from "./services.tsx";
 
 interface Playlist {
   id: string;
@@ -38,6 +39,9 @@ function Shuffler({ userId, token }: ShufflerProps) {
       }
     };
     fetchPlaylists();
+    // a sync that finishes while this page is open brings new or changed playlists
+    window.addEventListener(SYNC_DONE_EVENT, fetchPlaylists);
+    return () => window.removeEventListener(SYNC_DONE_EVENT, fetchPlaylists);
   }, [userId]);
 
   const togglePin = (id: string, e: React.MouseEvent) => {
@@ -5,3 +5,48 @@ const BASE_URL = "";
 export function getPlaylists(userId: string) {
   return axios.get(`${BASE_URL}/api/get_playlists?user_id=${userId}`);
 }
+
+export interface SyncStatus {
+  job_id?: number;
+  kind?: string;
+  // "none" before the user's first sync
+  status: "none" | "queued" | "running" | "done" | "failed";
+  playlists_done?: number;
+  playlists_total?: number;
+  tracks_ingested?: number;
+  error?: string | null;
+}
+
+// sent on window when a sync finishes, pages showing the library load it again
+export const SYNC_DONE_EVENT = "protify:sync-done";
+
+const SYNC_POLL_MS = 1500;
+
+export function getSyncStatus(userId: string) {
+  return axios.get<SyncStatus>(`${BASE_URL}/api/cache/status?user_id=${userId}`);
+}
+
+// syncs run as background jobs, poll the user's latest one until it stops running
+export async function waitForSync(
+  userId: string,
+  onProgress: (status: SyncStatus) => void,
+  isActive: () => boolean = () => true
+): Promise<SyncStatus | null> {
+  while (isActive()) {
+    const res = await getSyncStatus(userId);
+    if (!isActive()) break;
+    onProgress(res.data);
+    if (res.data.status !== "queued" && res.data.status !== "running") {
+      if (res.data.status === "done") window.dispatchEvent(new Event(SYNC_DONE_EVENT));
+      return res.data;
+    }
+    await new Promise((resolve) => setTimeout(resolve, SYNC_POLL_MS));
+  }
+  return null;
+}
+
+export function describeSync(status: SyncStatus) {
+  if (status.playlists_total) return `syncing ${status.playlists_done ?? 0}/${status.playlists_total} playlists`;
+  if (status.tracks_ingested) return `syncing... ${status.tracks_ingested} songs`;
+  return status.status === "queued" ? "sync queued..." : "syncing...";
+}
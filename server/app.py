@@ -1,13 +1,16 @@
 import os
 from flask import Flask, send_from_directory
 from dotenv import load_dotenv
+
+# before the local imports, they read their settings from the environment at import time
+load_dotenv()
+
 from apscheduler.schedulers.background import BackgroundScheduler
 from spotipy.oauth2 import SpotifyOAuth
 from database import init_db, SessionLocal, User, Bundle
 from routes import routes
-from scheduler import queue_scheduler
+from scheduler import get_scheduler
 
-load_dotenv()
 init_db()
 
 CLIENT_BUILD = os.path.join(os.path.dirname(__file__), "..", "client", "build")
@@ -24,10 +27,13 @@ app.sp_oauth = SpotifyOAuth(
     redirect_uri=os.getenv("SPOTIPY_REDIRECT_URI")
 )
 
-queue_scheduler.start()
-
 app.register_blueprint(routes)
 
+# started lazily so each gunicorn worker runs its own scheduler thread after the fork
+@app.before_request
+def ensure_scheduler():
+    get_scheduler()
+
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>")
 def serve_react(path):
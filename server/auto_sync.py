@@ -0,0 +1,283 @@
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+from spotipy.oauth2 import SpotifyOauthError
+from database import SessionLocal, User, Playlist, SyncJob, saved_track_table, user_playlist_table
+from fetcher import call, fetch_all
+from jobs import submit_sync, STALE_AFTER
+from rate_limiter import background
+from scheduler import add_startup_job, acquire_lease
+from spotify_client import get_client, refresh_user_token
+from spotify_helpers import get_playlists
+from watcher import refresh_watch_token
+
+# one worker at a time looks for libraries that are due a check, this often
+TICK_SECONDS = int(os.getenv("AUTO_SYNC_TICK_SECONDS", "60"))
+TICK_LEASE = timedelta(seconds=TICK_SECONDS * 2)
+# an active user's library is checked about this often, give or take JITTER
+SYNC_INTERVAL = timedelta(minutes=int(os.getenv("AUTO_SYNC_INTERVAL_MINUTES", "30")))
+JITTER = 0.25
+# users who haven't opened the app for this long are left alone
+ACTIVE_WINDOW = timedelta(days=int(os.getenv("AUTO_SYNC_ACTIVE_DAYS", "7")))
+# syncs queued or running across all workers, no new ones are started past this
+MAX_RUNNING = int(os.getenv("AUTO_SYNC_MAX_RUNNING", "4"))
+# spotify calls one tick may spend on checks plus the syncs it starts
+TICK_BUDGET = int(os.getenv("AUTO_SYNC_TICK_BUDGET", "200"))
+# kept back from the checks for the syncs they turn up, a change found
+# with nothing left to act on it means checking that user twice
+SYNC_RESERVE = MAX_RUNNING * 5
+CHECK_WORKERS = 4
+# last_active_at is written at most this often per user
+TOUCH_SECONDS = 300
+# access tokens are refreshed this long before they run out
+TOKEN_MARGIN = 300
+
+_touched = {}
+_touched_lock = threading.Lock()
+# user id -> (access token, expires_at), so a check doesn't refresh the token every time
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+def _next_sync(now, interval=SYNC_INTERVAL):
+    return now + interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def mark_active(user_id):
+    """Note that the user is around, so their library keeps getting synced."""
+    now = time.monotonic()
+    with _touched_lock:
+        if now - _touched.get(user_id, -TOUCH_SECONDS) < TOUCH_SECONDS:
+            return
+        _touched[user_id] = now
+    db = SessionLocal()
+    try:
+        db.query(User).filter(User.id == user_id).update(
+            {User.last_active_at: datetime.utcnow()}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def save_login(db, user, token_info, new_user=False):
+    """Keep a login's refresh token in the caller's transaction.
+
+    A returning user's library is checked within a tick or two, a new
+    user's gets its full sync now and its first check an interval later.
+    """
+    now = datetime.utcnow()
+    user.refresh_token = token_info.get("refresh_token") or user.refresh_token
+    user.last_active_at = now
+    if new_user:
+        user.next_sync_at = _next_sync(now)
+    else:
+        user.next_sync_at = now + timedelta(seconds=random.uniform(0, TICK_SECONDS))
+    with _tokens_lock:
+        _tokens[user.id] = (token_info["access_token"], token_info.get("expires_at") or time.time() + 3600)
+
+
+def _access_token(user_id, refresh_token):
+    """(access token, new token info or None), refreshing only when the cached token runs out."""
+    with _tokens_lock:
+        cached = _tokens.get(user_id)
+    if cached and cached[1] - TOKEN_MARGIN > time.time():
+        return cached[0], None
+    token_info = refresh_user_token(refresh_token)
+    with _tokens_lock:
+        _tokens[user_id] = (token_info["access_token"], token_info["expires_at"])
+    return token_info["access_token"], token_info
+
+
+def _library_state(db, user_id):
+    """What the cache knows: (liked song count, {playlist id: snapshot})."""
+    saved = db.execute(
+        select(func.count()).select_from(saved_track_table).where(saved_track_table.c.user_id == user_id)
+    ).scalar()
+    snapshots = dict(db.execute(
+        select(Playlist.id, Playlist.snapshot_id)
+        .join(user_playlist_table, user_playlist_table.c.playlist_id == Playlist.id)
+        .where(user_playlist_table.c.user_id == user_id)
+    ).all())
+    return saved, snapshots
+
+
+def _check_cost(snapshots):
+    # a token refresh, one liked songs page, the playlist list in pages of 50
+    return 2 + len(snapshots) // 50 + 1
+
+
+def _check(due):
+    """Compare the newest liked song, the liked count and the playlist snapshots with the cache.
+
+    Returns (how many of liked songs and playlists changed, access token,
+    new token info or None).
+    """
+    user_id, refresh_token, watermark, saved, snapshots = due
+    token, token_info = _access_token(user_id, refresh_token)
+    sp = get_client(token)
+
+    liked = call(sp.current_user_saved_tracks, limit=1)
+    newest = liked["items"][0].get("added_at") if liked["items"] else None
+    changes = int(liked["total"] != saved or newest != watermark)
+
+    current = {p["id"]: p.get("snapshot_id") for p in get_playlists(sp) if p}
+    changes += sum(1 for playlist_id, snapshot_id in current.items() if snapshots.get(playlist_id) != snapshot_id)
+    changes += sum(1 for playlist_id in snapshots if playlist_id not in current)
+    return changes, token, token_info
+
+
+def _running_syncs(db):
+    return db.execute(
+        select(func.count()).select_from(SyncJob)
+        .where(SyncJob.status.in_(["queued", "running"]), SyncJob.updated_at > datetime.utcnow() - STALE_AFTER)
+    ).scalar()
+
+
+def _save_token(db, user, token, token_info):
+    """Keep a refreshed token, spotify may hand out a new refresh token with it."""
+    if token_info:
+        user.refresh_token = token_info.get("refresh_token") or user.refresh_token
+        # opted in bundle watches pick up the fresh token too
+        refresh_watch_token(db, user.id, token)
+
+
+def sync_active_users():
+    """Check due users' libraries for changes and start incremental syncs where something changed.
+
+    Users are due every SYNC_INTERVAL with jitter so they spread over the
+    interval instead of lining up. The checks cost a few calls each and
+    most find nothing, a sync only starts when liked songs or a playlist
+    snapshot moved, and only while fewer than MAX_RUNNING syncs run.
+    Changes found with no slot free are kept in users.sync_pending and
+    started first on a later tick, by whichever worker holds the lease then.
+    """
+    if not acquire_lease("auto_sync", TICK_LEASE):
+        return
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        slots = MAX_RUNNING - _running_syncs(db)
+        if slots <= 0:
+            return
+        # found on an earlier tick, oldest first
+        pending = db.execute(
+            select(User.id, User.refresh_token, User.sync_pending)
+            .where(User.refresh_token != None, User.sync_pending > 0)
+            .order_by(User.next_sync_at)
+            .limit(slots)
+        ).all()
+        spent = sum(3 + changes for _, _, changes in pending)
+
+        users = db.execute(
+            select(User.id, User.refresh_token, User.saved_tracks_watermark)
+            .where(User.refresh_token != None, User.last_active_at > now - ACTIVE_WINDOW)
+            .where((User.next_sync_at == None) | (User.next_sync_at <= now))
+            .where((User.sync_pending == None) | (User.sync_pending == 0))
+            .order_by(User.next_sync_at)
+        ).all()
+
+        # checks only when there's room for what they find, most overdue first until the budget is spent
+        due = []
+        for user_id, refresh_token, watermark in users if len(pending) < slots else ():
+            saved, snapshots = _library_state(db, user_id)
+            cost = _check_cost(snapshots)
+            if spent + cost > TICK_BUDGET - SYNC_RESERVE:
+                break
+            spent += cost
+            due.append((user_id, refresh_token, watermark, saved, snapshots))
+    finally:
+        db.close()
+
+    def token(entry):
+        try:
+            return _access_token(entry[0], entry[1])
+        except SpotifyOauthError as e:
+            return e
+        except Exception as e:
+            print(f"auto sync: token refresh failed for {entry[0]}: {e}")
+            return None
+
+    def check(entry):
+        try:
+            return _check(entry)
+        except SpotifyOauthError as e:
+            return e
+        except Exception as e:
+            print(f"auto sync: check failed for {entry[0]}: {e}")
+            return 0, None, None
+
+    with background():
+        tokens = fetch_all(token, pending, workers=CHECK_WORKERS)
+        results = fetch_all(check, due, workers=CHECK_WORKERS)
+
+    to_start, resumed, waiting = [], [], 0
+    db = SessionLocal()
+    try:
+        for (user_id, *_), result in zip(pending, tokens):
+            user = db.get(User, user_id)
+            if user is None:
+                continue
+            if isinstance(result, SpotifyOauthError):
+                print(f"auto sync: refresh token rejected for {user_id}: {result}")
+                user.refresh_token = None
+                user.sync_pending = 0
+            elif result is None:
+                # left pending, tried again next tick
+                waiting += 1
+            else:
+                _save_token(db, user, *result)
+                to_start.append((user_id, result[0]))
+                resumed.append(user_id)
+
+        for (user_id, *_), result in zip(due, results):
+            user = db.get(User, user_id)
+            if user is None:
+                continue
+            if isinstance(result, SpotifyOauthError):
+                # revoked or expired for good, wait for the next login
+                print(f"auto sync: refresh token rejected for {user_id}: {result}")
+                user.refresh_token = None
+                continue
+            changes, token, token_info = result
+            _save_token(db, user, token, token_info)
+            user.next_sync_at = _next_sync(now)
+            if changes:
+                # the sync relists everything it checks, plus a page or more per change
+                cost = 3 + changes
+                if len(to_start) < slots and spent + cost <= TICK_BUDGET:
+                    spent += cost
+                    to_start.append((user_id, token))
+                else:
+                    # due again straight away, so any worker holding the lease next starts it
+                    user.sync_pending = changes
+                    user.next_sync_at = now
+                    waiting += 1
+        db.commit()
+    finally:
+        db.close()
+
+    # after the commit, submit_sync writes the job row from its own session
+    started = 0
+    for user_id, token in to_start:
+        _, fresh = submit_sync(get_client(token), user_id, "incremental")
+        started += fresh
+    # only cleared once the job is there, a worker dying in between leaves the changes pending
+    if resumed:
+        db = SessionLocal()
+        try:
+            db.query(User).filter(User.id.in_(resumed)).update(
+                {User.sync_pending: 0, User.next_sync_at: _next_sync(now)}, synchronize_session=False
+            )
+            db.commit()
+        finally:
+            db.close()
+    if due or to_start:
+        print(f"auto sync: checked {len(due)} libraries, started {started} syncs, {waiting} waiting, ~{spent} calls")
+
+
+# jitter spreads the ticks of the workers competing for the lease
+add_startup_job(sync_active_users, id="auto_sync", trigger="interval", seconds=TICK_SECONDS, jitter=TICK_SECONDS // 4)
@@ -0,0 +1,98 @@
+import threading
+from sqlalchemy import func
+from database import User, Bundle
+
+
+class BundlePlan:
+    """A user's bundles compiled into hash indexes so applying them is O(tracks).
+
+    Matches the old linear scan exactly: for each track the earliest unused
+    bundle wins, where a bundle matches on its intro, or on its main when strict.
+    """
+
+    def __init__(self, bundles):
+        # bundles are (id, intro_song_id, main_song_id, strict) in priority order
+        self.by_intro = {}
+        self.by_strict_main = {}
+        for pos, (bundle_id, intro_id, main_id, strict) in enumerate(bundles):
+            entry = (pos, bundle_id, intro_id, main_id, bool(strict))
+            self.by_intro.setdefault(intro_id, []).append(entry)
+            if strict:
+                self.by_strict_main.setdefault(main_id, []).append(entry)
+
+    @classmethod
+    def from_bundles(cls, bundles):
+        return cls((b.id, b.intro_song_id, b.main_song_id, b.strict) for b in bundles)
+
+    def __bool__(self):
+        return bool(self.by_intro)
+
+    def match(self, track_id, seen):
+        best = None
+        for candidates in (self.by_intro.get(track_id, ()), self.by_strict_main.get(track_id, ())):
+            for entry in candidates:
+                if entry[1] not in seen:
+                    if best is None or entry[0] < best[0]:
+                        best = entry
+                    break
+        return best
+
+    def expand(self, track_id, seen):
+        """What one track turns into in the queue, marking its bundle used in seen."""
+        bundle = self.match(track_id, seen)
+        if not bundle:
+            return [track_id]
+
+        _, bundle_id, intro_id, main_id, strict = bundle
+        seen.add(bundle_id)
+        if strict or track_id == intro_id:
+            # strict always plays intro then main, loose only when intro comes up
+            return [intro_id, main_id]
+        return [track_id]
+
+    def apply(self, track_ids):
+        new_queue = []
+        seen = set()
+        for track_id in track_ids:
+            new_queue.extend(self.expand(track_id, seen))
+        return new_queue
+
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def get_bundle_plan(db, user_id, bundles_version):
+    """Compiled plan for a user, rebuilt only after their bundles change.
+
+    bundles_version is the user's users.bundles_version as the caller read it.
+    """
+    version = bundles_version or 0
+    with _plans_lock:
+        cached = _plans.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    rows = (
+        db.query(Bundle.id, Bundle.intro_song_id, Bundle.main_song_id, Bundle.strict)
+        .filter(Bundle.user_id == user_id)
+        .order_by(Bundle.id)
+        .all()
+    )
+    plan = BundlePlan(rows)
+    with _plans_lock:
+        _plans[user_id] = (version, plan)
+    return plan
+
+
+def invalidate_bundle_plan(db, user_id):
+    """Bump the user's bundle version in the caller's transaction.
+
+    The version lives in the db so the other gunicorn worker drops its copy too.
+    """
+    db.query(User).filter(User.id == user_id).update(
+        {User.bundles_version: func.coalesce(User.bundles_version, 0) + 1},
+        synchronize_session=False,
+    )
+    with _plans_lock:
+        _plans.pop(user_id, None)
@@ -1,8 +1,9 @@
-from sqlalchemy import create_engine, Column, String, Integer, ForeignKey, Table, Date, Boolean, DateTime
+import os
+from sqlalchemy import create_engine, Column, String, Integer, ForeignKey, Table, Date, Boolean, DateTime, Text, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 
-DATABASE_URL = "sqlite:///spotify_cache.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///spotify_cache.db")
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
@@ -17,7 +18,18 @@ playlist_track_table = Table(
 saved_track_table = Table(
     "saved_track", Base.metadata,
     Column("user_id", String, ForeignKey("users.id"), primary_key=True),
-    Column("track_id", String, ForeignKey("tracks.id"), primary_key=True)
+    Column("track_id", String, ForeignKey("tracks.id"), primary_key=True),
+    # spotify's added_at, ISO strings so they compare in time order
+    Column("added_at", String)
+)
+
+# which users follow which playlists, the playlist rows and their tracks are shared
+user_playlist_table = Table(
+    "user_playlists", Base.metadata,
+    Column("user_id", String, ForeignKey("users.id"), primary_key=True),
+    Column("playlist_id", String, ForeignKey("playlists.id"), primary_key=True),
+    # finds a playlist's remaining followers when one unfollows
+    Index("ix_user_playlists_playlist_id", "playlist_id")
 )
 
 track_artist_table = Table(
@@ -32,13 +44,52 @@ artist_genre_table = Table(
     Column("genre_id", Integer, ForeignKey("genres.id"), primary_key=True)
 )
 
+# materialized genre histogram: how many of a user's artists carry each genre
+user_genre_count_table = Table(
+    "user_genre_counts", Base.metadata,
+    Column("user_id", String, ForeignKey("users.id"), primary_key=True),
+    Column("genre_id", Integer, ForeignKey("genres.id"), primary_key=True),
+    Column("artist_count", Integer, nullable=False)
+)
+
+# rebuilds one user's rows from their liked songs + playlists in a single statement
+USER_GENRE_COUNTS_SQL = """
+    INSERT INTO user_genre_counts (user_id, genre_id, artist_count)
+    SELECT :user_id, ag.genre_id, COUNT(*)
+    FROM artist_genre ag
+    WHERE ag.artist_id IN (
+        SELECT ta.artist_id FROM track_artists ta
+        WHERE ta.track_id IN (
+            SELECT st.track_id FROM saved_track st WHERE st.user_id = :user_id
+            UNION
+            SELECT pt.track_id FROM playlist_track pt
+            JOIN user_playlists up ON up.playlist_id = pt.playlist_id WHERE up.user_id = :user_id
+        )
+    )
+    GROUP BY ag.genre_id
+"""
+
 class User(Base):
     __tablename__ = "users"
     id = Column(String, primary_key=True, index=True)
     name = Column(String)
     curr_index = Column(Integer, default=0)
+    bundles_version = Column(Integer, default=0)
+    # added_at of the newest liked song at the last sync
+    saved_tracks_watermark = Column(String)
+    # liked songs items with no usable track (local files, unavailable ones) at the last sync
+    saved_tracks_skipped = Column(Integer, default=0)
+    # bumped on every change to saved_tracks so cached copies of the list know they're stale
+    saved_tracks_version = Column(Integer, default=0)
+    # lets auto_sync get an access token while the user is away, set at login
+    refresh_token = Column(String, nullable=True)
+    last_active_at = Column(DateTime, nullable=True)
+    # when auto_sync next checks the library for changes, jittered so users spread out
+    next_sync_at = Column(DateTime, nullable=True)
+    # changes an auto sync check found while every sync slot was taken, started on a later tick
+    sync_pending = Column(Integer, default=0)
 
-    playlists = relationship("Playlist", back_populates="user")
+    playlists = relationship("Playlist", secondary=user_playlist_table, back_populates="users")
     saved_tracks = relationship("Track", secondary=saved_track_table, back_populates="saved_by_users")
     bundles = relationship("Bundle", back_populates="user")
 
@@ -46,11 +97,11 @@ class Playlist(Base):
     __tablename__ = "playlists"
     id = Column(String, primary_key=True)
     name = Column(String)
-    user_id = Column(String, ForeignKey("users.id"))
     snapshot_id = Column(String, nullable=True)
     image_url = Column(String, nullable=True)
+    num_tracks = Column(Integer, default=0)  # denormalized count of playlist_track rows
 
-    user = relationship("User", back_populates="playlists")
+    users = relationship("User", secondary=user_playlist_table, back_populates="playlists")
     tracks = relationship("Track", secondary=playlist_track_table, back_populates="playlists")
 
 class Album(Base):
@@ -58,18 +109,37 @@ class Album(Base):
     id = Column(String, primary_key=True)
     name = Column(String)
     release_date = Column(String)
+    release_year = Column(Integer, nullable=True)
+    release_ordinal = Column(Integer, nullable=True)  # yyyymmdd, unknown month/day are 00
     image_url = Column(String, nullable=True)
 
     tracks = relationship("Track", back_populates="album")
 
+    __table_args__ = (Index("ix_albums_release_year_id", "release_year", "id"),)
+
+def parse_release_date(release_date):
+    """Spotify dates come as YYYY, YYYY-MM or YYYY-MM-DD, returns (year, ordinal)."""
+    parts = (release_date or "").split("-")
+    try:
+        year = int(parts[0])
+        month = int(parts[1]) if len(parts) > 1 else 0
+        day = int(parts[2]) if len(parts) > 2 else 0
+    except ValueError:
+        return None, None
+    return year, year * 10000 + month * 100 + day
+
 class Artist(Base):
     __tablename__ = "artists"
     id = Column(String, primary_key=True)
     name = Column(String)
+    # last /artists lookup, genres are fetched again once this is older than ARTIST_TTL
+    genres_fetched_at = Column(DateTime, nullable=True)
 
     tracks = relationship("Track", secondary=track_artist_table, back_populates="artists")
     genres = relationship("Genre", secondary=artist_genre_table, back_populates="artists")
 
+    __table_args__ = (Index("ix_artists_genres_fetched_at", "genres_fetched_at"),)
+
 class Genre(Base):
     __tablename__ = "genres"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -83,6 +153,7 @@ class Track(Base):
     name = Column(String)
     album_id = Column(String, ForeignKey("albums.id"), nullable=True)
     preview_url = Column(String, nullable=True)
+    duration_ms = Column(Integer, nullable=True)
     
     album = relationship("Album", back_populates="tracks")
     artists = relationship("Artist", secondary=track_artist_table, back_populates="tracks")
@@ -116,14 +187,102 @@ class Bundle(Base):
     
     user = relationship("User", back_populates="bundles")
 
+# shuffle state that any worker can pick up, one row per listening user
+class QueueSession(Base):
+    __tablename__ = "queue_sessions"
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    track_ids = Column(Text, nullable=False)  # json list in play order, only for sessions without a source
+    curr_index = Column(Integer, default=0)
+    # lazy shuffle: "saved:<user id>" or "playlist:<id>", replayed from seed, cursor counts source tracks used
+    source = Column(String, nullable=True)
+    seed = Column(Integer, nullable=True)
+    num_tracks = Column(Integer, default=0)
+    cursor = Column(Integer, default=0)
+    pending = Column(Text, nullable=True)  # json list, tracks a bundle produced past the last refill
+    bundles_used = Column(Text, nullable=True)  # json list of bundle ids already played
+    mode = Column(String, nullable=True)  # "random", or "artist" / "album" to spread those out
+    spread_window = Column(Integer, nullable=True)
+    # what spotify was playing at the last check and when we first saw it, to guess how much is left
+    playing_track_id = Column(String, nullable=True)
+    playing_since = Column(DateTime, nullable=True)
+    device_id = Column(String, nullable=True)
+    access_token = Column(String, nullable=True)
+    active = Column(Boolean, default=True)
+    updated_at = Column(DateTime, nullable=True)
+
+# background library syncs, at most one queued/running per user
+class SyncJob(Base):
+    __tablename__ = "sync_jobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String, nullable=False, index=True)
+    kind = Column(String, nullable=False)  # full, incremental, full_refresh
+    status = Column(String, default="queued")  # queued, running, done, failed
+    owner = Column(String, nullable=True)  # worker running it
+    playlists_done = Column(Integer, default=0)
+    playlists_total = Column(Integer, default=0)
+    tracks_ingested = Column(Integer, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_sync_jobs_one_active", "user_id", unique=True,
+              sqlite_where=text("status IN ('queued', 'running')")),
+    )
+
+# users who want their bundles enforced when playing from spotify itself, see watcher.py
+class BundleWatch(Base):
+    __tablename__ = "bundle_watches"
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    access_token = Column(String, nullable=True)  # cleared when it expires, the next login sets it again
+    updated_at = Column(DateTime, nullable=True)
+
+# named lock with an expiry so only one worker runs a given job at a time
+class Lease(Base):
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
 def init_db():
     Base.metadata.create_all(bind=engine, checkfirst=True)
-    from sqlalchemy import text
     with engine.connect() as conn:
         track_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(tracks)"))]
         if "preview_url" not in track_cols:
             conn.execute(text("ALTER TABLE tracks ADD COLUMN preview_url TEXT"))
             conn.commit()
+        # filled in as tracks are synced again, the queue guesses a length for the rest
+        if "duration_ms" not in track_cols:
+            conn.execute(text("ALTER TABLE tracks ADD COLUMN duration_ms INTEGER"))
+            conn.commit()
+
+        user_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(users)"))]
+        if "bundles_version" not in user_cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN bundles_version INTEGER DEFAULT 0"))
+            conn.commit()
+        if "saved_tracks_watermark" not in user_cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN saved_tracks_watermark TEXT"))
+            conn.commit()
+        if "saved_tracks_version" not in user_cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN saved_tracks_version INTEGER DEFAULT 0"))
+            conn.commit()
+        if "refresh_token" not in user_cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN refresh_token TEXT"))
+            conn.execute(text("ALTER TABLE users ADD COLUMN last_active_at DATETIME"))
+            conn.execute(text("ALTER TABLE users ADD COLUMN next_sync_at DATETIME"))
+            conn.commit()
+        if "sync_pending" not in user_cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN sync_pending INTEGER DEFAULT 0"))
+            conn.commit()
+        if "saved_tracks_skipped" not in user_cols:
+            conn.execute(text("ALTER TABLE users ADD COLUMN saved_tracks_skipped INTEGER DEFAULT 0"))
+            conn.commit()
+
+        # rows from before this have no added_at, the next sync walks the whole library and fills them in
+        saved_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(saved_track)"))]
+        if "added_at" not in saved_cols:
+            conn.execute(text("ALTER TABLE saved_track ADD COLUMN added_at TEXT"))
+            conn.commit()
 
         playlist_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(playlists)"))]
         if "snapshot_id" not in playlist_cols:
@@ -132,8 +291,94 @@ def init_db():
         if "image_url" not in playlist_cols:
             conn.execute(text("ALTER TABLE playlists ADD COLUMN image_url TEXT"))
             conn.commit()
+        if "num_tracks" not in playlist_cols:
+            conn.execute(text("ALTER TABLE playlists ADD COLUMN num_tracks INTEGER DEFAULT 0"))
+            conn.execute(text(
+                "UPDATE playlists SET num_tracks = "
+                "(SELECT COUNT(*) FROM playlist_track pt WHERE pt.playlist_id = playlists.id)"
+            ))
+            conn.commit()
+        # playlists used to belong to the one user who last synced them
+        if "user_id" in playlist_cols and conn.execute(text("SELECT 1 FROM user_playlists LIMIT 1")).first() is None:
+            conn.execute(text(
+                "INSERT OR IGNORE INTO user_playlists (user_id, playlist_id) "
+                "SELECT user_id, id FROM playlists WHERE user_id IS NOT NULL"
+            ))
+            conn.commit()
+
+        artist_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(artists)"))]
+        if "genres_fetched_at" not in artist_cols:
+            conn.execute(text("ALTER TABLE artists ADD COLUMN genres_fetched_at DATETIME"))
+            # artists with genres were looked up at some point, count that as now. The rest
+            # never were or have no genres, the refresher picks those up first
+            conn.execute(text(
+                "UPDATE artists SET genres_fetched_at = CURRENT_TIMESTAMP "
+                "WHERE id IN (SELECT artist_id FROM artist_genre)"
+            ))
+            conn.commit()
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_artists_genres_fetched_at ON artists (genres_fetched_at)"))
+        conn.commit()
 
         album_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(albums)"))]
         if "image_url" not in album_cols:
             conn.execute(text("ALTER TABLE albums ADD COLUMN image_url TEXT"))
             conn.commit()
+        if "release_year" not in album_cols:
+            conn.execute(text("ALTER TABLE albums ADD COLUMN release_year INTEGER"))
+            conn.execute(text("ALTER TABLE albums ADD COLUMN release_ordinal INTEGER"))
+            conn.execute(text("""
+                UPDATE albums SET
+                    release_year = CAST(substr(release_date, 1, 4) AS INTEGER),
+                    release_ordinal = CAST(substr(release_date, 1, 4) AS INTEGER) * 10000
+                        + (CASE WHEN length(release_date) >= 7 THEN CAST(substr(release_date, 6, 2) AS INTEGER) ELSE 0 END) * 100
+                        + (CASE WHEN length(release_date) >= 10 THEN CAST(substr(release_date, 9, 2) AS INTEGER) ELSE 0 END)
+                WHERE release_date GLOB '[0-9][0-9][0-9][0-9]*'
+            """))
+            conn.commit()
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_albums_release_year_id ON albums (release_year, id)"))
+        conn.commit()
+
+        queue_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(queue_sessions)"))]
+        if "source" not in queue_cols:
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN source TEXT"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN seed INTEGER"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN num_tracks INTEGER DEFAULT 0"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN cursor INTEGER DEFAULT 0"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN pending TEXT"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN bundles_used TEXT"))
+            conn.commit()
+        if "mode" not in queue_cols:
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN mode TEXT"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN spread_window INTEGER"))
+            conn.commit()
+        if "playing_track_id" not in queue_cols:
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN playing_track_id TEXT"))
+            conn.execute(text("ALTER TABLE queue_sessions ADD COLUMN playing_since DATETIME"))
+            conn.commit()
+
+        # full-text index over names, kept in sync by ingest.ingest_tracks
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS track_search USING fts5("
+            "track_id UNINDEXED, name, artists, album, tokenize='unicode61 remove_diacritics 2')"
+        ))
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS artist_search USING fts5("
+            "artist_id UNINDEXED, name, tokenize='unicode61 remove_diacritics 2')"
+        ))
+        if conn.execute(text("SELECT 1 FROM track_search LIMIT 1")).first() is None:
+            conn.execute(text("""
+                INSERT INTO track_search (track_id, name, artists, album)
+                SELECT t.id, t.name,
+                       COALESCE((SELECT group_concat(a.name, ' ') FROM track_artists ta
+                                 JOIN artists a ON a.id = ta.artist_id WHERE ta.track_id = t.id), ''),
+                       COALESCE(al.name, '')
+                FROM tracks t LEFT JOIN albums al ON al.id = t.album_id
+            """))
+        if conn.execute(text("SELECT 1 FROM artist_search LIMIT 1")).first() is None:
+            conn.execute(text("INSERT INTO artist_search (artist_id, name) SELECT id, name FROM artists"))
+        conn.commit()
+
+        if conn.execute(text("SELECT 1 FROM user_genre_counts LIMIT 1")).first() is None:
+            for (user_id,) in conn.execute(text("SELECT id FROM users")).fetchall():
+                conn.execute(text(USER_GENRE_COUNTS_SQL), {"user_id": user_id})
+            conn.commit()
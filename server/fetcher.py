@@ -0,0 +1,102 @@
+import os
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from spotipy.exceptions import SpotifyException
+from rate_limiter import rate_limiter
+
+# how many spotify reads run at once during a library fetch
+FETCH_WORKERS = int(os.getenv("SPOTIFY_FETCH_WORKERS", "8"))
+MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "5"))
+
+
+def _retry_after(error, attempt):
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return max(1.0, float(value))
+    except (TypeError, ValueError):
+        return min(30.0, 2 ** attempt)
+
+
+def call(fn, *args, **kwargs):
+    """Run one spotify call, retrying 429s once the shared limiter's pause is over.
+
+    The budget itself is taken per HTTP request in spotify_client's adapter.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except SpotifyException as e:
+            if e.http_status != 429 or attempt == MAX_RETRIES:
+                raise
+            wait = _retry_after(e, attempt)
+            print(f"rate limited by spotify, retrying in {wait:.0f}s")
+            rate_limiter.pause(wait)
+
+
+def fetch_all(fn, items, workers=None):
+    """Map fn over items on a bounded thread pool, results come back in item order."""
+    items = list(items)
+    if not items:
+        return []
+    workers = min(workers or FETCH_WORKERS, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # pool threads start with a blank context, carry over the caller's rate limit lane
+        futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+        return [f.result() for f in futures]
+
+
+def _put(out, entry, stop):
+    # keep checking stop so producers don't hang on a full queue after the consumer left
+    while not stop.is_set():
+        try:
+            out.put(entry, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def stream(fn, items, workers=None, buffer=None):
+    """Run the generator fn(item) for every item on a bounded pool, yielding (item, batch) as batches arrive.
+
+    Each item finishes with (item, None). At most `buffer` batches wait for
+    the consumer, producers block beyond that so memory stays bounded.
+    """
+    items = list(items)
+    if not items:
+        return
+    workers = min(workers or FETCH_WORKERS, len(items))
+    out = queue.Queue(maxsize=buffer or workers * 2)
+    stop = threading.Event()
+
+    def produce(item):
+        if stop.is_set():
+            return
+        try:
+            for batch in fn(item):
+                if not _put(out, (item, batch, None), stop):
+                    return
+            _put(out, (item, None, None), stop)
+        except Exception as e:
+            _put(out, (item, None, e), stop)
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            pool.submit(contextvars.copy_context().run, produce, item)
+        remaining = len(items)
+        while remaining:
+            item, batch, error = out.get()
+            if error:
+                raise error
+            if batch is None:
+                remaining -= 1
+            yield item, batch
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
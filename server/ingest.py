@@ -0,0 +1,281 @@
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, text, update
+from sqlalchemy.dialects.sqlite import insert
+from database import Track, Album, Artist, Genre, Playlist, user_playlist_table, track_artist_table, artist_genre_table, saved_track_table, playlist_track_table, user_genre_count_table, USER_GENRE_COUNTS_SQL, parse_release_date
+
+# sqlite caps bound parameters per statement, keep IN (...) lists under it
+CHUNK_SIZE = 500
+# artist genres are looked up again after this long, the catalog changes slowly
+ARTIST_TTL = timedelta(days=int(os.getenv("ARTIST_TTL_DAYS", "30")))
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _insert_ignore(db, table, rows):
+    if rows:
+        db.execute(insert(table).on_conflict_do_nothing(), rows)
+
+
+def _insert_new(db, table, rows):
+    """Insert the rows whose id isn't taken yet, returns the ids that went in.
+
+    RETURNING only reports rows this statement inserted, so two syncs
+    writing the same ids at once can't both think they're new.
+    """
+    if not rows:
+        return set()
+    return set(db.execute(insert(table).on_conflict_do_nothing().returning(table.c.id), rows).scalars())
+
+
+def artists_to_fetch(db, artist_ids):
+    """Which artists need a genre fetch: not cached yet, never looked up, or looked up over ARTIST_TTL ago.
+
+    Artists are shared by every user, so one user's sync covers the next
+    user's, and artists spotify has no genres for aren't asked about again.
+    """
+    artist_ids = list(artist_ids)
+    cutoff = datetime.utcnow() - ARTIST_TTL
+    fresh = set()
+    for chunk in chunks(artist_ids):
+        fresh.update(db.execute(
+            select(Artist.id).where(Artist.id.in_(chunk), Artist.genres_fetched_at >= cutoff)
+        ).scalars())
+    return [i for i in artist_ids if i not in fresh]
+
+
+def _genre_ids(db, names):
+    _insert_ignore(db, Genre.__table__, [{"name": name} for name in names])
+    ids = {}
+    for chunk in chunks(names):
+        for genre_id, name in db.execute(select(Genre.id, Genre.name).where(Genre.name.in_(chunk))):
+            ids[name] = genre_id
+    return ids
+
+
+def save_artist_details(db, artist_details, fetched_ids=()):
+    """Store /artists payloads, replacing the artists' genres and marking them fetched.
+
+    fetched_ids are all the ids that were looked up, the ones spotify
+    returned nothing for are marked too so they aren't asked about again
+    until the TTL is up.
+    """
+    now = datetime.utcnow()
+    if artist_details:
+        stmt = insert(Artist.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={"name": func.coalesce(stmt.excluded.name, Artist.__table__.c.name), "genres_fetched_at": now},
+        )
+        db.execute(stmt, [
+            {"id": artist_id, "name": details.get("name"), "genres_fetched_at": now}
+            for artist_id, details in artist_details.items()
+        ])
+        for chunk in chunks(artist_details):
+            db.execute(artist_genre_table.delete().where(artist_genre_table.c.artist_id.in_(chunk)))
+        all_genres = {name for details in artist_details.values() for name in details.get("genres") or ()}
+        if all_genres:
+            genre_ids = _genre_ids(db, all_genres)
+            _insert_ignore(db, artist_genre_table, [
+                {"artist_id": artist_id, "genre_id": genre_ids[name]}
+                for artist_id, details in artist_details.items()
+                for name in set(details.get("genres") or ()) if name in genre_ids
+            ])
+    empty = [artist_id for artist_id in fetched_ids if artist_id not in artist_details]
+    for chunk in chunks(empty):
+        db.execute(update(Artist).where(Artist.id.in_(chunk)).values(genres_fetched_at=now)
+                   .execution_options(synchronize_session=False))
+
+
+def ingest_tracks(db, tracks, artist_details=None, user_id=None, playlist_id=None, added_at=None):
+    """Write a batch of spotify track dicts with a few set-based statements.
+
+    artist_details maps artist id -> full artist payload (with genres) from
+    fetch_artist_genres. When user_id / playlist_id is given the tracks are
+    also linked to that user's liked songs / that playlist, added_at maps
+    track id -> when it was liked.
+    Returns the ids of the tracks that were ingested.
+    """
+    artist_details = artist_details or {}
+    albums, artists = {}, {}
+    track_rows, track_artist_rows, track_artist_names = {}, set(), {}
+
+    for track_data in tracks:
+        if not track_data or track_data.get("type", "track") != "track" or not track_data.get("id"):
+            continue
+        track_id = track_data["id"]
+
+        album_data = track_data.get("album") or {}
+        if album_data.get("id"):
+            images = album_data.get("images", [])
+            release_year, release_ordinal = parse_release_date(album_data.get("release_date"))
+            albums[album_data["id"]] = {
+                "id": album_data["id"],
+                "name": album_data.get("name"),
+                "release_date": album_data.get("release_date", ""),
+                "release_year": release_year,
+                "release_ordinal": release_ordinal,
+                "image_url": images[0]["url"] if images else None,
+            }
+
+        for artist_data in track_data.get("artists", []):
+            artist_id = artist_data.get("id")
+            if not artist_id:
+                continue
+            full = artist_details.get(artist_id, artist_data)
+            artists[artist_id] = {"id": artist_id, "name": full.get("name") or artist_data.get("name")}
+            if (track_id, artist_id) not in track_artist_rows:
+                track_artist_rows.add((track_id, artist_id))
+                track_artist_names.setdefault(track_id, []).append(artists[artist_id]["name"] or "")
+
+        track_rows[track_id] = {
+            "id": track_id,
+            "name": track_data.get("name"),
+            "album_id": album_data.get("id"),
+            "preview_url": track_data.get("preview_url"),
+            "duration_ms": track_data.get("duration_ms"),
+        }
+
+    if not track_rows:
+        if playlist_id:
+            refresh_playlist_count(db, playlist_id)
+        return []
+
+    _insert_ignore(db, Album.__table__, list(albums.values()))
+    new_artist_ids = _insert_new(db, Artist.__table__, list(artists.values()))
+    save_artist_details(db, {a: d for a, d in artist_details.items() if a in artists})
+
+    new_track_ids = _insert_new(db, Track.__table__, list(track_rows.values()))
+    # existing tracks only get their preview_url and duration backfilled
+    existing = [row for track_id, row in track_rows.items() if track_id not in new_track_ids]
+    if existing:
+        track_stmt = insert(Track.__table__)
+        track_stmt = track_stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={
+                "preview_url": func.coalesce(Track.__table__.c.preview_url, track_stmt.excluded.preview_url),
+                "duration_ms": func.coalesce(track_stmt.excluded.duration_ms, Track.__table__.c.duration_ms),
+            },
+        )
+        db.execute(track_stmt, existing)
+
+    _insert_ignore(db, track_artist_table, [
+        {"track_id": track_id, "artist_id": artist_id} for track_id, artist_id in track_artist_rows
+    ])
+
+    # only rows this batch inserted go into the search index
+    if new_artist_ids:
+        db.execute(
+            text("INSERT INTO artist_search (artist_id, name) VALUES (:artist_id, :name)"),
+            [{"artist_id": artist_id, "name": artists[artist_id]["name"] or ""} for artist_id in new_artist_ids]
+        )
+    if new_track_ids:
+        db.execute(
+            text("INSERT INTO track_search (track_id, name, artists, album) VALUES (:track_id, :name, :artists, :album)"),
+            [{
+                "track_id": track_id,
+                "name": track_rows[track_id]["name"] or "",
+                "artists": " ".join(track_artist_names.get(track_id, [])),
+                "album": albums.get(track_rows[track_id]["album_id"], {}).get("name") or "",
+            } for track_id in new_track_ids]
+        )
+
+    if user_id and track_rows:
+        added_at = added_at or {}
+        stmt = insert(saved_track_table)
+        # re-liking moves a song to the top, keep the newer added_at
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "track_id"],
+            set_={"added_at": func.coalesce(stmt.excluded.added_at, saved_track_table.c.added_at)},
+        )
+        db.execute(stmt, [
+            {"user_id": user_id, "track_id": track_id, "added_at": added_at.get(track_id)}
+            for track_id in track_rows
+        ])
+    if playlist_id:
+        _insert_ignore(db, playlist_track_table, [
+            {"playlist_id": playlist_id, "track_id": track_id} for track_id in track_rows
+        ])
+        refresh_playlist_count(db, playlist_id)
+
+    return list(track_rows)
+
+
+def refresh_playlist_count(db, playlist_id):
+    """Recount playlists.num_tracks from the join table (a PK prefix scan)."""
+    db.flush()
+    db.execute(
+        update(Playlist)
+        .where(Playlist.id == playlist_id)
+        .values(num_tracks=select(func.count()).select_from(playlist_track_table)
+                .where(playlist_track_table.c.playlist_id == playlist_id)
+                .scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def link_playlists(db, user_id, playlist_ids):
+    """Add playlists to a user's library, the playlist rows and tracks are shared."""
+    _insert_ignore(db, user_playlist_table, [
+        {"user_id": user_id, "playlist_id": playlist_id} for playlist_id in playlist_ids
+    ])
+
+
+def playlist_followers(db, playlist_ids):
+    """Ids of the users following any of the playlists, whose genre counts include their tracks."""
+    followers = set()
+    for chunk in chunks(list(playlist_ids)):
+        followers.update(db.execute(
+            select(user_playlist_table.c.user_id).where(user_playlist_table.c.playlist_id.in_(chunk))
+        ).scalars())
+    return followers
+
+
+def artist_listeners(db, artist_ids):
+    """Ids of the users with tracks by any of the artists in their liked songs or followed playlists."""
+    listeners = set()
+    for chunk in chunks(list(artist_ids)):
+        track_ids = select(track_artist_table.c.track_id).where(track_artist_table.c.artist_id.in_(chunk))
+        listeners.update(db.execute(
+            select(saved_track_table.c.user_id).where(saved_track_table.c.track_id.in_(track_ids)).distinct()
+        ).scalars())
+        listeners.update(db.execute(
+            select(user_playlist_table.c.user_id)
+            .join(playlist_track_table, playlist_track_table.c.playlist_id == user_playlist_table.c.playlist_id)
+            .where(playlist_track_table.c.track_id.in_(track_ids)).distinct()
+        ).scalars())
+    return listeners
+
+
+def unlink_playlists(db, user_id, playlist_ids):
+    """Take playlists out of a user's library, deleting the ones nobody follows anymore.
+
+    Returns the ids of the deleted playlists.
+    """
+    playlist_ids = list(playlist_ids)
+    for chunk in chunks(playlist_ids):
+        db.execute(user_playlist_table.delete().where(
+            (user_playlist_table.c.user_id == user_id) &
+            (user_playlist_table.c.playlist_id.in_(chunk))
+        ))
+    followed = set()
+    for chunk in chunks(playlist_ids):
+        followed.update(db.execute(
+            select(user_playlist_table.c.playlist_id).where(user_playlist_table.c.playlist_id.in_(chunk))
+        ).scalars())
+    orphaned = [playlist_id for playlist_id in playlist_ids if playlist_id not in followed]
+    for chunk in chunks(orphaned):
+        db.execute(playlist_track_table.delete().where(playlist_track_table.c.playlist_id.in_(chunk)))
+        db.execute(Playlist.__table__.delete().where(Playlist.id.in_(chunk)))
+    return orphaned
+
+
+def refresh_user_genre_counts(db, user_id):
+    """Rebuild the user's genre histogram inside the caller's transaction."""
+    db.flush()
+    db.execute(user_genre_count_table.delete().where(user_genre_count_table.c.user_id == user_id))
+    db.execute(text(USER_GENRE_COUNTS_SQL), {"user_id": user_id})
@@ -0,0 +1,221 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal, SyncJob
+from scheduler import worker_id
+from rate_limiter import background
+from spotify_helpers import cache_all_music_data, cache_incremental, clear_user_cache
+
+# syncs run here instead of inside the request, a couple at a time per worker
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "2"))
+# a running job from another worker with no update for this long is treated as dead
+STALE_AFTER = timedelta(minutes=int(os.getenv("SYNC_STALE_MINUTES", "30")))
+# a full refresh retried within this long of failing keeps what the failed one got through
+RESUME_WINDOW = timedelta(days=1)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# progress of jobs queued or running in this process, by job id
+_running = {}
+_running_lock = threading.Lock()
+
+
+class SyncProgress:
+    """Counters the cache functions bump while a job runs, saved with every checkpoint commit."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.playlists_done = 0
+        self.playlists_total = 0
+        self.tracks_ingested = 0
+
+    def set_total(self, playlists_total):
+        self.playlists_total = playlists_total
+
+    def playlist_done(self, num_tracks=0):
+        self.playlists_done += 1
+        self.tracks_ingested += num_tracks
+
+    def add_tracks(self, num_tracks):
+        self.tracks_ingested += num_tracks
+
+    def save(self, db):
+        """Write the counters to the job row in the caller's transaction, which also shows it's alive."""
+        db.query(SyncJob).filter(SyncJob.id == self.job_id).update({
+            SyncJob.playlists_done: self.playlists_done,
+            SyncJob.playlists_total: self.playlists_total,
+            SyncJob.tracks_ingested: self.tracks_ingested,
+            SyncJob.updated_at: datetime.utcnow(),
+        }, synchronize_session=False)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="sync")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _is_dead(job, now):
+    if job.status not in ("queued", "running"):
+        return False
+    if job.owner == worker_id():
+        return job.id not in _running
+    return job.updated_at is None or now - job.updated_at > STALE_AFTER
+
+
+def _fail_dead_jobs(db, user_id):
+    now = datetime.utcnow()
+    active = db.query(SyncJob).filter(SyncJob.user_id == user_id, SyncJob.status.in_(["queued", "running"])).all()
+    for job in active:
+        if _is_dead(job, now):
+            job.status = "failed"
+            job.error = "worker stopped"
+            job.updated_at = now
+    db.commit()
+
+
+def _finish(job_id, status, progress, error=None):
+    db = SessionLocal()
+    try:
+        job = db.get(SyncJob, job_id)
+        job.status = status
+        job.error = error
+        job.playlists_done = progress.playlists_done
+        job.playlists_total = progress.playlists_total
+        job.tracks_ingested = progress.tracks_ingested
+        job.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+
+def _interrupted_refresh(user_id, job_id):
+    """Whether the user's previous job was a full refresh that failed recently."""
+    db = SessionLocal()
+    try:
+        previous = (
+            db.query(SyncJob)
+            .filter(SyncJob.user_id == user_id, SyncJob.id < job_id)
+            .order_by(SyncJob.id.desc())
+            .first()
+        )
+        return (
+            previous is not None and previous.kind == "full_refresh" and previous.status == "failed"
+            and previous.updated_at is not None and datetime.utcnow() - previous.updated_at < RESUME_WINDOW
+        )
+    finally:
+        db.close()
+
+
+def _run(job_id, sp, user_id, kind):
+    progress = _running[job_id]
+
+    db = SessionLocal()
+    try:
+        job = db.get(SyncJob, job_id)
+        job.status = "running"
+        job.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+    print(f"sync job {job_id} ({kind}) started for {user_id}")
+    try:
+        # syncs give way to shuffles and playback when the api budget runs low
+        with background():
+            if kind == "full_refresh":
+                # a retry carries on from the last one's checkpoints instead of clearing them away
+                if _interrupted_refresh(user_id, job_id):
+                    print(f"sync job {job_id} resuming an interrupted full refresh")
+                else:
+                    clear_user_cache(user_id)
+                cache_all_music_data(sp, user_id, progress)
+            elif kind == "full":
+                cache_all_music_data(sp, user_id, progress)
+            else:
+                cache_incremental(sp, user_id, progress)
+        _finish(job_id, "done", progress)
+        print(f"sync job {job_id} done")
+    except Exception as e:
+        print(f"sync job {job_id} failed: {e}")
+        _finish(job_id, "failed", progress, error=str(e))
+    finally:
+        _running.pop(job_id, None)
+
+
+def submit_sync(sp, user_id, kind):
+    """Queue a library sync, or join the user's active one.
+
+    Returns (job_id, started) where started is False when a sync was
+    already queued or running for this user.
+    """
+    db = SessionLocal()
+    try:
+        with _running_lock:
+            _fail_dead_jobs(db, user_id)
+            now = datetime.utcnow()
+            job = SyncJob(user_id=user_id, kind=kind, status="queued", owner=worker_id(), created_at=now, updated_at=now)
+            db.add(job)
+            try:
+                db.commit()
+            except IntegrityError:
+                # the partial unique index allows one queued/running job per user
+                db.rollback()
+                active = (
+                    db.query(SyncJob)
+                    .filter(SyncJob.user_id == user_id, SyncJob.status.in_(["queued", "running"]))
+                    .first()
+                )
+                return active.id, False
+            job_id = job.id
+            _running[job_id] = SyncProgress(job_id)
+    finally:
+        db.close()
+
+    _get_executor().submit(_run, job_id, sp, user_id, kind)
+    return job_id, True
+
+
+def get_sync_status(user_id):
+    """Latest job for the user, with live counters when it runs in this worker."""
+    db = SessionLocal()
+    try:
+        job = (
+            db.query(SyncJob)
+            .filter(SyncJob.user_id == user_id)
+            .order_by(SyncJob.id.desc())
+            .first()
+        )
+        if not job:
+            return None
+        with _running_lock:
+            if _is_dead(job, datetime.utcnow()):
+                _fail_dead_jobs(db, user_id)
+                db.refresh(job)
+
+        status = {
+            "job_id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "playlists_done": job.playlists_done,
+            "playlists_total": job.playlists_total,
+            "tracks_ingested": job.tracks_ingested,
+            "error": job.error,
+            "created_at": job.created_at.isoformat() if job.created_at else None,
+            "updated_at": job.updated_at.isoformat() if job.updated_at else None
+        }
+        live = _running.get(job.id)
+        if live:
+            status["playlists_done"] = live.playlists_done
+            status["playlists_total"] = live.playlists_total
+            status["tracks_ingested"] = live.tracks_ingested
+        return status
+    finally:
+        db.close()
@@ -0,0 +1,59 @@
+import random
+
+MASK64 = (1 << 64) - 1
+# seeds are stored in a signed 64-bit sqlite integer
+SEED_LIMIT = 1 << 63
+ROUNDS = 4
+
+
+def _mix(x):
+    # splitmix64 finalizer, cheap and spreads every input bit over the output
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def new_seed():
+    return random.randrange(SEED_LIMIT)
+
+
+class FeistelPermutation:
+    """Seeded shuffle of range(n) where any position can be computed on its own.
+
+    A balanced Feistel network over the smallest even-bit domain that holds
+    n, with cycle walking to map results outside range(n) back in. Only n
+    and the round keys are kept, so a shuffle of any size costs the same
+    memory and the same seed always replays the same order.
+    """
+
+    def __init__(self, n, seed, rounds=ROUNDS):
+        # larger seeds can't be stored, and would share round keys with smaller ones
+        if not 0 <= seed < SEED_LIMIT:
+            raise ValueError(f"seed must be from 0 to {SEED_LIMIT - 1}")
+        self.n = n
+        self.seed = seed
+        bits = max(2, max(n - 1, 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self.keys = [_mix((seed + r * 0x9E3779B97F4A7C15) & MASK64) for r in range(1, rounds + 1)]
+
+    def __len__(self):
+        return self.n
+
+    def _encrypt(self, x):
+        left, right = x >> self.half, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right ^ key) & self.mask)
+        return (left << self.half) | right
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        # the domain is under 4n, so this takes a few steps at most on average
+        x = self._encrypt(i)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+    def __iter__(self):
+        return (self[i] for i in range(self.n))
@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# app-wide request budget, shared by every worker when REDIS_URL is set
+REQUESTS_PER_SECOND = float(os.getenv("SPOTIFY_REQUESTS_PER_SECOND", "10"))
+BURST = float(os.getenv("SPOTIFY_BURST", str(max(1.0, REQUESTS_PER_SECOND))))
+# share of the bucket background work can't touch, so shuffles still go through during a big sync
+INTERACTIVE_RESERVE = float(os.getenv("SPOTIFY_INTERACTIVE_RESERVE", "0.3"))
+# the bundle watcher's polls go ahead of background work, but only up to this share of the budget
+WATCH_SHARE = float(os.getenv("SPOTIFY_WATCH_SHARE", "0.3"))
+WATCH_RATE = REQUESTS_PER_SECOND * WATCH_SHARE
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_KEY = "spotify:rate_limit"
+# after a redis error use the local bucket for a while before trying again
+REDIS_RETRY_SECONDS = 30
+
+INTERACTIVE = "interactive"
+WATCH = "watch"
+BACKGROUND = "background"
+
+_lane = ContextVar("spotify_lane", default=INTERACTIVE)
+
+
+@contextmanager
+def background():
+    """Spotify calls made inside this block queue behind interactive ones."""
+    token = _lane.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+@contextmanager
+def watching():
+    """Spotify calls made inside this block use the bundle watcher's share of the budget."""
+    token = _lane.set(WATCH)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def current_lane():
+    return _lane.get()
+
+
+class LocalBucket:
+    """Token bucket for this process only, used when there's no redis.
+
+    A sqlite bucket would be shared, but a library sync holds the sqlite
+    write lock until it commits, so every API call would queue behind it.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def take(self, floor):
+        """Take a token if that leaves at least floor behind, else return how long to wait."""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                return 0.0
+            return (floor + 1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# same bucket as LocalBucket, run atomically inside redis on redis's clock
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local floor = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local paused = tonumber(redis.call('HGET', KEYS[1], 'paused_until') or '0')
+if now < paused then
+    return tostring(paused - now)
+end
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or ARGV[2])
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated') or tostring(now))
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens - 1 >= floor then
+    tokens = tokens - 1
+else
+    wait = (floor + 1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], 60)
+return tostring(wait)
+"""
+
+PAUSE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local paused_until = now + tonumber(ARGV[1])
+local paused = tonumber(redis.call('HGET', KEYS[1], 'paused_until') or '0')
+if paused_until > paused then
+    redis.call('HSET', KEYS[1], 'paused_until', tostring(paused_until), 'tokens', '0', 'updated', tostring(paused_until))
+    redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[1])) + 60)
+end
+return 1
+"""
+
+
+class RedisBucket:
+    """Token bucket kept in redis so both gunicorn workers share one budget."""
+
+    def __init__(self, client, rate, capacity, key=REDIS_KEY):
+        self.client = client
+        self.rate = rate
+        self.capacity = capacity
+        self.key = key
+        self._take = client.register_script(TAKE_SCRIPT)
+        self._pause = client.register_script(PAUSE_SCRIPT)
+
+    def take(self, floor):
+        return float(self._take(keys=[self.key], args=[self.rate, self.capacity, floor]))
+
+    def pause(self, seconds):
+        self._pause(keys=[self.key], args=[seconds])
+
+
+class RateLimiter:
+    """Spotify request budget with interactive, watch and background lanes.
+
+    Lanes differ in how far they may drain the shared bucket, so interactive
+    calls go first, then the watcher, then background work. The watch lane
+    also has a bucket of its own that caps it at watch_share of the rate.
+    That one is per process, which is enough since one worker runs the watcher.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST, reserve=INTERACTIVE_RESERVE, redis_client=None,
+                 watch_share=WATCH_SHARE):
+        self.local = LocalBucket(rate, capacity)
+        self.shared = RedisBucket(redis_client, rate, capacity) if redis_client is not None else None
+        self.floors = {INTERACTIVE: 0.0, WATCH: capacity * reserve / 2, BACKGROUND: capacity * reserve}
+        self.caps = {WATCH: LocalBucket(rate * watch_share, max(1.0, rate * watch_share))}
+        self.redis_down_until = 0.0
+
+    def _bucket(self):
+        if self.shared is not None and time.monotonic() >= self.redis_down_until:
+            return self.shared
+        return self.local
+
+    def _redis_failed(self, e):
+        print(f"rate limiter can't reach redis, using the local bucket: {e}")
+        self.redis_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+
+    def acquire(self, lane=None):
+        lane = lane or current_lane()
+        cap = self.caps.get(lane)
+        while cap is not None:
+            wait = cap.take(0.0)
+            if wait <= 0:
+                break
+            time.sleep(min(wait, 1.0))
+        floor = self.floors[lane]
+        while True:
+            bucket = self._bucket()
+            try:
+                wait = bucket.take(floor)
+            except redis.RedisError as e:
+                self._redis_failed(e)
+                continue
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 1.0))
+
+    def pause(self, seconds):
+        """Hold back every caller, used when spotify answers 429."""
+        self.local.pause(seconds)
+        if self.shared is not None:
+            try:
+                self.shared.pause(seconds)
+            except redis.RedisError as e:
+                self._redis_failed(e)
+
+
+def _redis_client():
+    if not REDIS_URL:
+        return None
+    if redis is None:
+        print("REDIS_URL is set but the redis package isn't installed, rate limiting per worker")
+        return None
+    return redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+
+rate_limiter = RateLimiter(redis_client=_redis_client())
@@ -1,25 +1,44 @@
 from flask import Blueprint, request, jsonify, redirect, current_app
 import random
 import os
+import time
 import requests as http_requests
 import spotipy
 import spotify_helpers
-from scheduler import queue_scheduler
-from database import SessionLocal, User, Playlist, Track, Album, Artist, PodcastEpisode, Show, Bundle, Genre, track_artist_table, playlist_track_table, saved_track_table, artist_genre_table
-from spotify_helpers import cache_all_music_data, cache_incremental, apply_bundles, get_tracks_by_artists, get_tracks_by_genres, get_tracks_by_release_year, get_tracks_by_name, get_playlists
+from database import SessionLocal, User, Playlist, Track, Album, Artist, PodcastEpisode, Show, Bundle, Genre, track_artist_table, playlist_track_table, saved_track_table, artist_genre_table, user_genre_count_table, user_playlist_table
+from spotify_helpers import cache_all_music_data, cache_incremental, clear_user_cache, apply_bundles, get_tracks_by_artists, get_tracks_by_genres, get_tracks_by_release_year, get_tracks_by_name, get_playlists, search_track_ids, search_artist_ids, search_tracks, get_year_histogram
 from spotipy import Spotify
+from sqlalchemy import text, select
+from bundles import get_bundle_plan, invalidate_bundle_plan
+from ingest import refresh_user_genre_counts, refresh_playlist_count, playlist_followers
+from jobs import submit_sync, get_sync_status
+from spotify_client import get_client, get_user_id
+from spread import DEFAULT_WINDOW, MAX_WINDOW
+from permutation import SEED_LIMIT
+from track_store import invalidate_saved
+from watcher import set_watch, refresh_watch_token
+from auto_sync import mark_active, save_login
+from serializers import json_response, serialize_tracks, serialize_playlists, serialize_saved_songs
 
 routes = Blueprint("routes", __name__)
 
-def get_spotify_client(code=None, token=None):
+SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 200
+CATEGORY_LIMIT = 500
+MAX_CATEGORY_LIMIT = 2000
+
+def get_access_token(code=None, token=None):
     if token:
-        return spotipy.Spotify(auth=token)
+        return token
     elif code:
         token_info = current_app.sp_oauth.get_access_token(code, as_dict=True)
-        return spotipy.Spotify(auth=token_info['access_token'])
+        return token_info['access_token']
     else:
         raise Exception("no token or code given")
 
+def get_spotify_client(code=None, token=None):
+    return get_client(get_access_token(code=code, token=token))
+
 @routes.route("/login")
 def login():
     auth_url = current_app.sp_oauth.get_authorize_url()
@@ -36,19 +55,28 @@ def callback():
     token_info = current_app.sp_oauth.get_access_token(code, as_dict=True)
     access_token = token_info["access_token"]
     
-    sp = spotipy.Spotify(auth=access_token)
+    sp = get_client(access_token)
     user_info = sp.me()
     user_id = user_info["id"]
     display_name = user_info.get("display_name", user_id)
     
     db = SessionLocal()
     user = db.query(User).filter_by(id=user_id).first()
+    new_user = user is None
+    if new_user:
+        user = User(id=user_id, name=display_name)
+        db.add(user)
+    # keeps the library synced while the user is away
+    save_login(db, user, token_info, new_user=new_user)
+    # the bundle watcher stops when a token expires, a new login picks it back up
+    refresh_watch_token(db, user_id, access_token)
+    db.commit()
     db.close()
     
-    # only cache user if they are new
-    if not user:
+    # only cache user if they are new, in the background so login returns right away
+    if new_user:
         print("caching new user...")
-        cache_all_music_data(sp, user_id)
+        submit_sync(sp, user_id, "full")
     
     frontend_url = os.getenv("FRONTEND_URL", "")
     return redirect(
@@ -62,23 +90,16 @@ def api_get_playlists():
         return jsonify({"error": "no user_id"}), 400
     
     db = SessionLocal()
-    user = db.query(User).filter_by(id=user_id).first()
+    user = db.get(User, user_id)
     if not user:
         db.close()
         return jsonify({"error": "user not found"}), 404
     
-    playlists = [
-        {
-            "id": playlist.id,
-            "name": playlist.name,
-            "num_tracks": len(playlist.tracks),
-            "image_url": playlist.image_url
-        }
-        for playlist in user.playlists
-    ]
+    playlists = serialize_playlists(db, user_id)
     
     db.close()
-    return jsonify(playlists)
+    mark_active(user_id)
+    return json_response(playlists)
 
 @routes.route("/api/get_bundles", methods=["GET"])
 def api_get_bundles():
@@ -112,22 +133,15 @@ def api_get_saved_songs():
         return jsonify({"error": "no user_id"}), 400
     
     db = SessionLocal()
-    user = db.query(User).filter_by(id=user_id).first()
+    user = db.get(User, user_id)
     if not user:
         db.close()
         return jsonify({"error": "user not found"}), 404
     
-    tracks = [
-        {
-            "id": t.id,
-            "name": t.name,
-            "album": t.album.name if t.album else None
-        }
-        for t in user.saved_tracks
-    ]
+    tracks = serialize_saved_songs(db, user_id)
     
     db.close()
-    return jsonify({
+    return json_response({
         "num_saved_songs": len(tracks),
         "tracks": tracks
     })
@@ -135,13 +149,17 @@ def api_get_saved_songs():
 # main shuffle route
 @routes.route("/api/shuffle", methods=["POST"])
 def api_shuffle():
+    started = time.perf_counter()
     data = request.get_json()
-    sp = get_spotify_client(code=data.get("code"), token=data.get("token"))
-    user_id = sp.current_user()["id"]
+    token = get_access_token(code=data.get("code"), token=data.get("token"))
+    sp = get_spotify_client(token=token)
+    # both cached, so a repeat shuffle's first call to spotify is the one that starts playback
+    user_id = get_user_id(token)
     shuffle_choice = data.get("shuffle_choice")
     
     if not user_id or not shuffle_choice:
         return jsonify({"error": "no required fields"}), 400
+    mark_active(user_id)
     
     db = SessionLocal()
     user = db.query(User).filter_by(id=user_id).first()
@@ -149,49 +167,75 @@ def api_shuffle():
         db.close()
         return jsonify({"error": "user not found"}), 404
     
-    devices = sp.devices().get("devices", [])
-    if not devices:
+    device_id = spotify_helpers.remembered_device(db, user_id)
+    remembered = device_id is not None
+    if not remembered:
+        device_id = spotify_helpers.pick_device(sp)
+    if not device_id:
+        db.close()
         return jsonify({"error": "no devices found"}), 400
-    device_id = devices[0]["id"]
     
     if shuffle_choice == "1":
-        track_uris = [t.id for t in user.saved_tracks]
+        source = f"saved:{user_id}"
         playlist_name = "liked songs"
     elif shuffle_choice == "2":
         playlist_id = data.get("playlist_id")
-        playlist = db.query(Playlist).filter_by(id=playlist_id, user_id=user_id).first()
+        playlist = db.query(Playlist).filter(Playlist.id == playlist_id, Playlist.users.any(User.id == user_id)).first()
         if not playlist:
             db.close()
             return jsonify({"error": "invalid playlist_id"}), 404
         playlist_name = playlist.name
-        track_uris = [t.id for t in playlist.tracks]
+        source = f"playlist:{playlist.id}"
     elif shuffle_choice == "3":
-        if not user.playlists:
+        playlists = db.execute(
+            select(Playlist.id, Playlist.name)
+            .join(user_playlist_table, user_playlist_table.c.playlist_id == Playlist.id)
+            .where(user_playlist_table.c.user_id == user_id)
+        ).all()
+        if not playlists:
             db.close()
             return jsonify({"error": "no playlists"}), 400
-        playlist = random.choice(user.playlists)
-        playlist_name = playlist.name
-        track_uris = [t.id for t in playlist.tracks]
+        playlist_id, playlist_name = random.choice(playlists)
+        source = f"playlist:{playlist_id}"
     else:
         db.close()
         return jsonify({"error": "invalid shuffle_choice"}), 400
-    
-    user = db.query(User).filter_by(id=user_id).first()
-    if not user:
-        pass
-    
-    random.shuffle(track_uris)
-    bundles = user.bundles
-    if bundles:
-        track_uris = apply_bundles(track_uris, bundles)
-    
     db.close()
-    
-    spotify_helpers.start_playback_with_queue(sp, track_uris, device_id, queue_scheduler, user_id=user_id)
+
+    # the order is generated lazily from the seed, sending one back replays that shuffle
+    seed = data.get("seed")
+    try:
+        seed = int(seed) if seed is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid seed"}), 400
+    if seed is not None and not 0 <= seed < SEED_LIMIT:
+        return jsonify({"error": f"seed must be from 0 to {SEED_LIMIT - 1}"}), 400
+
+    # "artist" / "album" keep the same artist or album out of any spread_window tracks in a row
+    shuffle_mode = data.get("shuffle_mode", "random")
+    if shuffle_mode not in spotify_helpers.SHUFFLE_MODES:
+        return jsonify({"error": "invalid shuffle_mode"}), 400
+    spread_window = data.get("spread_window", DEFAULT_WINDOW)
+    if not isinstance(spread_window, int) or not 1 <= spread_window <= MAX_WINDOW:
+        return jsonify({"error": f"spread_window must be 1-{MAX_WINDOW}"}), 400
+
+    try:
+        seed, num_tracks = spotify_helpers.start_playback_with_queue(
+            sp, source, device_id, user_id=user_id, token=token,
+            seed=seed, mode=shuffle_mode, spread_window=spread_window, remembered=remembered
+        )
+    except spotify_helpers.EmptyShuffle:
+        return jsonify({"error": f"{playlist_name} has no tracks"}), 400
+    # request in to playback started, the queue fills in the background after this
+    first_sound_ms = round((time.perf_counter() - started) * 1000)
+    print(f"shuffle for {user_id}: playing after {first_sound_ms}ms")
     
     return jsonify({
         "message": f"shuffling {playlist_name}!",
-        "num_tracks": len(track_uris)
+        "num_tracks": num_tracks,
+        "seed": str(seed),
+        "shuffle_mode": shuffle_mode,
+        "time_to_first_sound_ms": first_sound_ms
     })
 
 # bundle routes
@@ -232,6 +276,7 @@ def api_create_bundle():
         )
         
         db.add(new_bundle)
+        invalidate_bundle_plan(db, user_id)
         db.commit()
         db.refresh(new_bundle)
     finally:
@@ -260,6 +305,7 @@ def api_update_bundle(bundle_id):
             return jsonify({"error": "bundle not found"}), 404
         
         bundle.strict = strict  # dont change it again!!
+        invalidate_bundle_plan(db, bundle.user_id)
         db.commit()
         
         return jsonify({"message": "bundle updated", "bundle_id": bundle_id, "strict": strict})
@@ -278,11 +324,34 @@ def api_delete_bundle(bundle_id):
         return jsonify({"error": "bundle not found"}), 404
     
     db.delete(bundle)
+    invalidate_bundle_plan(db, bundle.user_id)
     db.commit()
     db.close()
     
     return jsonify({"message": "bundle deleted", "bundle_id": bundle_id})
 
+# enforce bundles while the user plays from spotify itself, not just in our shuffles
+@routes.route("/api/bundles/watch", methods=["POST"])
+def api_watch_bundles():
+    data = request.get_json()
+    user_id = data.get("user_id")
+    token = data.get("token")
+    enabled = data.get("enabled", True)
+    
+    if not user_id or (enabled and not token):
+        return jsonify({"error": "missing user_id or token"}), 400
+    
+    db = SessionLocal()
+    try:
+        if not db.get(User, user_id):
+            return jsonify({"error": "user not found"}), 404
+        set_watch(db, user_id, token, bool(enabled))
+        db.commit()
+    finally:
+        db.close()
+    
+    return jsonify({"message": "watching bundles" if enabled else "stopped watching bundles", "enabled": bool(enabled)})
+
 @routes.route("/api/search_category", methods=["POST"])
 def api_search_category():
     data = request.get_json()
@@ -294,68 +363,66 @@ def api_search_category():
     liked_only = data.get("liked_only", False)
     user_id = data.get("user_id")
 
-    db = SessionLocal()
+    # results come a page at a time, has_more says whether to ask for offset + limit next
     try:
-        track_sets = []
-        track_objects = {}
-
-        if song_name:
-            name_tracks = get_tracks_by_name(db, song_name)
-            track_sets.append(set(t.id for t in name_tracks))
-            for t in name_tracks:
-                track_objects[t.id] = t
-
-        if artists:
-            artist_tracks = get_tracks_by_artists(db, artists)
-            track_sets.append(set(t.id for t in artist_tracks))
-            for t in artist_tracks:
-                track_objects[t.id] = t
-
-        if genres:
-            genre_tracks = get_tracks_by_genres(db, genres)
-            track_sets.append(set(t.id for t in genre_tracks))
-            for t in genre_tracks:
-                track_objects[t.id] = t
-
+        limit = min(int(data.get("limit", CATEGORY_LIMIT)), MAX_CATEGORY_LIMIT)
+        offset = int(data.get("offset", 0))
         if start_year and end_year:
-            year_tracks = get_tracks_by_release_year(db, int(start_year), int(end_year))
-            track_sets.append(set(t.id for t in year_tracks))
-            for t in year_tracks:
-                track_objects[t.id] = t
-
-        if liked_only and user_id:
-            user = db.query(User).filter_by(id=user_id).first()
-            if user:
-                liked_tracks = user.saved_tracks
-                liked_ids = set(t.id for t in liked_tracks)
-                if not track_sets:
-                    for t in liked_tracks:
-                        track_objects[t.id] = t
-                track_sets.append(liked_ids)
-
-        if not track_sets:
-            return jsonify([])
+            start_year, end_year = int(start_year), int(end_year)
+        else:
+            start_year = end_year = None
+    except (TypeError, ValueError):
+        return jsonify({"error": "limit, offset and years must be whole numbers"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"error": f"limit must be 1-{MAX_CATEGORY_LIMIT} and offset at least 0"}), 400
 
-        # intersect all filter results so combined filters narrow down results
-        common_ids = track_sets[0]
-        for s in track_sets[1:]:
-            common_ids = common_ids & s
+    db = SessionLocal()
+    try:
+        unique_tracks, total = search_tracks(
+            db,
+            user_id=user_id,
+            song_name=song_name,
+            artists=artists,
+            genres=genres,
+            start_year=start_year,
+            end_year=end_year,
+            liked_only=liked_only,
+            limit=limit,
+            offset=offset,
+        )
 
-        unique_tracks = [track_objects[tid] for tid in common_ids]
+        return jsonify({
+            "tracks": [
+                {
+                    "id": t.id,
+                    "name": t.name,
+                    "artists": [{"id": a.id, "name": a.name} for a in t.artists],
+                    "preview_url": t.preview_url,
+                    "album_image": t.album.image_url if t.album else None
+                }
+                for t in unique_tracks
+            ],
+            "total": total,
+            "has_more": offset + len(unique_tracks) < total,
+        })
+    except Exception as e:
+        print("error in search_categories:", e)
+        return jsonify({"error": "search failed"}), 500
+    finally:
+        db.close()
 
+@routes.route("/api/year_histogram", methods=["GET"])
+def api_year_histogram():
+    user_id = request.args.get("user_id")
+    if not user_id:
+        return jsonify({"error": "no user_id"}), 400
+
+    db = SessionLocal()
+    try:
         return jsonify([
-            {
-                "id": t.id,
-                "name": t.name,
-                "artists": [{"id": a.id, "name": a.name} for a in t.artists],
-                "preview_url": t.preview_url,
-                "album_image": t.album.image_url if t.album else None
-            }
-            for t in unique_tracks
+            {"year": year, "count": count}
+            for year, count in get_year_histogram(db, user_id)
         ])
-    except Exception as e:
-        print("error in search_categories:", e)
-        return jsonify([]), 500
     finally:
         db.close()
 
@@ -368,12 +435,9 @@ def api_search_artists():
         if not query:
             return jsonify([])
         
-        matches = (
-            db.query(Artist)
-            .filter(Artist.name.ilike(f"%{query}%"))
-            .limit(10)
-            .all()
-        )
+        artist_ids = search_artist_ids(db, query, limit=10)
+        by_id = {a.id: a for a in db.query(Artist).filter(Artist.id.in_(artist_ids)).all()} if artist_ids else {}
+        matches = [by_id[i] for i in artist_ids if i in by_id]
         
         return jsonify([
             {
@@ -398,24 +462,9 @@ def api_search_songs():
         if not query and not artist:
             return jsonify([])
 
-        q = db.query(Track)
-        if query:
-            q = q.filter(Track.name.ilike(f"%{query}%"))
-        if artist:
-            q = q.join(Track.artists).filter(Artist.name.ilike(f"%{artist}%"))
-        matches = q.distinct().all()
-        
-        return jsonify([
-            {
-                "id": s.id,
-                "name": s.name,
-                "album": s.album.name if s.album else None,
-                "artists": [{"id": a.id, "name": a.name} for a in s.artists],
-                "preview_url": s.preview_url,
-                "album_image": s.album.image_url if s.album else None
-            }
-            for s in matches
-        ])
+        limit = min(request.args.get("limit", SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT)
+        track_ids = search_track_ids(db, name=query, artist=artist, limit=limit)
+        return json_response(serialize_tracks(db, track_ids))
     except Exception as e:
         print(f"search songs error: {e}")
         return jsonify({"error": "internal server error"}), 500
@@ -428,17 +477,11 @@ def api_get_track():
     
     db = SessionLocal()
     try:
-        track = db.query(Track).filter(Track.id == track_id).one_or_none()
-        if not track:
+        tracks = serialize_tracks(db, [track_id]) if track_id else []
+        if not tracks:
             return jsonify({"error": "Track not found"}), 404
         
-        return jsonify({
-            "id": track.id,
-            "name": track.name,
-            "artists": [{"id": a.id, "name": a.name} for a in track.artists],
-            "preview_url": track.preview_url,
-            "album_image": track.album.image_url if track.album else None
-        })
+        return json_response(tracks[0])
     finally:
         db.close()
 
@@ -454,7 +497,7 @@ def create_new_playlist():
         return jsonify({"error": "missing user_id or name"}), 400
     
     # create new playlist in spotify
-    sp = Spotify(auth=token)
+    sp = get_client(token)
     try:
         new_playlist = sp.user_playlist_create(user_id, name, public=False)
         new_id = new_playlist['id']
@@ -473,7 +516,7 @@ def create_new_playlist():
         return jsonify({"error": "user not found"}), 404
     
     # make new playlist in db
-    playlist = Playlist(name=name, user=user, id=new_id)
+    playlist = Playlist(name=name, users=[user], id=new_id)
     db.add(playlist)
     
     for track_id in track_ids:
@@ -481,6 +524,8 @@ def create_new_playlist():
         if track and track not in playlist.tracks:
             playlist.tracks.append(track)
     
+    refresh_playlist_count(db, new_id)
+    refresh_user_genre_counts(db, user_id)
     db.commit()
     db.close()
     
@@ -508,11 +553,15 @@ def add_to_playlist():
         if track and track not in playlist.tracks:
             playlist.tracks.append(track)
     
+    refresh_playlist_count(db, playlist_id)
+    # the tracks are shared by everyone following the playlist
+    for follower_id in playlist_followers(db, [playlist_id]):
+        refresh_user_genre_counts(db, follower_id)
     db.commit()
     db.close()
     
     # add to playlist in spotify
-    sp = Spotify(auth=token)
+    sp = get_client(token)
     try:
         sp.playlist_add_items(playlist_id, track_ids)
     except Exception as e:
@@ -530,7 +579,7 @@ def add_to_queue():
     if not track_ids:
         return jsonify({"error": "missing track_ids"}), 400
     
-    sp = Spotify(auth=token)
+    sp = get_client(token)
     try:
         for track in track_ids:
             sp.add_to_queue(track)
@@ -555,7 +604,7 @@ def remove_from_liked():
         return jsonify({"error": "missing user_id"}), 400
     
     # remove from spotify library
-    sp = Spotify(auth=token)
+    sp = get_client(token)
     try:
         sp.current_user_saved_tracks_delete(track_ids)
     except Exception as e:
@@ -570,6 +619,8 @@ def remove_from_liked():
                 (saved_track_table.c.user_id == user_id) & 
                 (saved_track_table.c.track_id == track)
             ).delete(synchronize_session=False)
+        invalidate_saved(db, user_id)
+        refresh_user_genre_counts(db, user_id)
         db.commit()
     except Exception as e:
         print("db error:", e)
@@ -589,42 +640,25 @@ def get_genres():
 
     db = SessionLocal()
     try:
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            return jsonify({"error": "user not found"}), 404
+        # genre -> number of the user's artists with it, kept up to date by the sync paths
+        sorted_genres = [
+            (name.lower().strip(), count)
+            for name, count in (
+                db.query(Genre.name, user_genre_count_table.c.artist_count)
+                .join(user_genre_count_table, user_genre_count_table.c.genre_id == Genre.id)
+                .filter(user_genre_count_table.c.user_id == user_id)
+                .order_by(user_genre_count_table.c.artist_count.desc())
+                .all()
+            )
+        ]
 
-        # Count how frequently each genre appears in the user's music
-        genre_count = {}
-        
-        # Collect all unique artists from user's saved tracks and playlists
-        user_artist_ids = set()
-        
-        # From saved tracks
-        for track in user.saved_tracks:
-            for artist in track.artists:
-                user_artist_ids.add(artist.id)
-        
-        # From playlist tracks
-        for playlist in user.playlists:
-            for track in playlist.tracks:
-                for artist in track.artists:
-                    user_artist_ids.add(artist.id)
-
-        # Get genres from user's artists using the many-to-many relationship
-        if user_artist_ids:
-            user_artists = db.query(Artist).filter(Artist.id.in_(user_artist_ids)).all()
-            
-            for artist in user_artists:
-                for genre in artist.genres:  # This uses the relationship defined in your schema
-                    genre_name = genre.name.lower().strip()
-                    genre_count[genre_name] = genre_count.get(genre_name, 0) + 1
-
-        # Sort genres by frequency and get top 10
-        if genre_count:
-            sorted_genres = sorted(genre_count.items(), key=lambda x: x[1], reverse=True)
+        # top 10 by frequency
+        if sorted_genres:
             top_10_genres = [genre[0] for genre in sorted_genres[:10]]
             all_genres_list = [genre[0] for genre in sorted_genres]
         else:
+            if not db.get(User, user_id):
+                return jsonify({"error": "user not found"}), 404
             # Fallback: get all genres from database if no user-specific data
             all_genres = db.query(Genre).all()
             all_genres_list = [genre.name.lower().strip() for genre in all_genres]
@@ -660,44 +694,16 @@ def api_search_genres():
             return jsonify([])
 
         db = SessionLocal()
-        user = db.query(User).filter_by(id=user_id).first()
-        if not user:
-            db.close()
-            return jsonify([])
-
-        # Get all genres from user's music using the proper relationships
-        user_genres = set()
-        
-        # Collect all unique artists from user's saved tracks and playlists
-        user_artist_ids = set()
-        
-        # From saved tracks
-        for track in user.saved_tracks:
-            for artist in track.artists:
-                user_artist_ids.add(artist.id)
-        
-        # From playlist tracks
-        for playlist in user.playlists:
-            for track in playlist.tracks:
-                for artist in track.artists:
-                    user_artist_ids.add(artist.id)
-
-        # Get genres from user's artists
-        if user_artist_ids:
-            user_artists = db.query(Artist).filter(Artist.id.in_(user_artist_ids)).all()
-            for artist in user_artists:
-                for genre in artist.genres:
-                    user_genres.add(genre.name.lower().strip())
-
-        # Filter genres matching query
-        matching_genres = [
-            genre for genre in user_genres 
-            if query in genre
-        ]
-        
-        # Sort and limit results
-        matching_genres.sort()
-        return jsonify(matching_genres[:10])
+        matching_genres = (
+            db.query(Genre.name)
+            .join(user_genre_count_table, user_genre_count_table.c.genre_id == Genre.id)
+            .filter(user_genre_count_table.c.user_id == user_id)
+            .filter(Genre.name.ilike(f"%{query}%"))
+            .order_by(Genre.name)
+            .limit(10)
+            .all()
+        )
+        return jsonify([name.lower().strip() for (name,) in matching_genres])
 
     except Exception as e:
         print(f"search genres error: {e}")
@@ -736,11 +742,12 @@ def api_cache_refresh():
         return jsonify({"error": "no user_id"}), 400
 
     sp = get_spotify_client(token=data.get("token"))
-    print("running incremental cache refresh")
-    cache_incremental(sp, user_id)
-    print("incremental cache complete")
+    job_id, started = submit_sync(sp, user_id, "incremental")
 
-    return jsonify({"message": "cache refreshed"})
+    return jsonify({
+        "message": "cache refresh started" if started else "cache refresh already running",
+        "job_id": job_id
+    }), 202
 
 
 @routes.route("/api/cache/full_refresh", methods=["POST"])
@@ -752,39 +759,25 @@ def api_cache_full_refresh():
         return jsonify({"error": "no user_id"}), 400
 
     sp = get_spotify_client(token=data.get("token"))
-    api_cache_clear(sp, user_id)
-    print("full cache refresh started")
-    cache_all_music_data(sp, user_id)
-    print("full cache refresh complete")
+    job_id, started = submit_sync(sp, user_id, "full_refresh")
+
+    return jsonify({
+        "message": "full cache refresh started" if started else "cache refresh already running",
+        "job_id": job_id
+    }), 202
 
-    return jsonify({"message": "full cache refresh complete"})
+@routes.route("/api/cache/status", methods=["GET"])
+def api_cache_status():
+    user_id = request.args.get("user_id")
+    if not user_id:
+        return jsonify({"error": "no user_id"}), 400
+
+    status = get_sync_status(user_id)
+    if not status:
+        return jsonify({"status": "none"})
+    return jsonify(status)
 
 @routes.route("/api/cache/clear", methods=["POST"])
 def api_cache_clear(sp, user_id):
-    db = SessionLocal()
-    
-    user = db.query(User).filter(User.id == user_id).first()
-    if user:
-        for playlist in user.playlists:
-            db.delete(playlist)
-        user.saved_tracks.clear()
-        
-        # this clears the joint tables, which was the issue earlier?
-        db.execute(track_artist_table.delete())
-        db.execute(playlist_track_table.delete())
-        db.execute(artist_genre_table.delete())
-
-        
-        # delete any remaining rows
-        db.query(Track).filter(~Track.saved_by_users.any(), ~Track.playlists.any()).delete(synchronize_session=False)
-        db.query(Artist).filter(~Artist.tracks.any()).delete(synchronize_session=False)
-        db.query(Album).filter(~Album.tracks.any()).delete(synchronize_session=False)
-        db.query(PodcastEpisode).filter(~PodcastEpisode.show.has()).delete(synchronize_session=False)
-        db.query(Show).filter(~Show.episodes.any()).delete(synchronize_session=False)
-        db.query(Genre).filter(~Genre.artists.any()).delete(synchronize_session=False)
-        
-        db.commit()
-    
-    db.close()
-    print("cache cleared")
-    return jsonify({"message": "cache cleared successfully"})
\ No newline at end of file
+    clear_user_cache(user_id)
+    return jsonify({"message": "cache cleared successfully"})
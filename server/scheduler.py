@@ -1,3 +1,90 @@
+import os
+import socket
+import threading
+from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal, Lease
 
-queue_scheduler = BackgroundScheduler()
\ No newline at end of file
+_scheduler = None
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+_startup_jobs = []
+
+
+def worker_id():
+    # computed per call, gunicorn --preload forks workers after this module loads
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def add_startup_job(func, **job_args):
+    """Register a job that every worker's scheduler runs, e.g. periodic sweeps."""
+    _startup_jobs.append((func, job_args))
+
+
+def get_scheduler():
+    """This process's scheduler, started on first use so each forked worker gets its own thread."""
+    global _scheduler, _scheduler_pid
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler_pid != os.getpid():
+            _scheduler = BackgroundScheduler()
+            _scheduler.start()
+            _scheduler_pid = os.getpid()
+            for func, job_args in _startup_jobs:
+                _scheduler.add_job(func, replace_existing=True, **job_args)
+        return _scheduler
+
+
+def user_job_id(user_id):
+    return f"queue:{user_id}"
+
+
+def schedule_user_job(user_id, func, **trigger_args):
+    """One job per user, rescheduling replaces that user's job and nobody else's."""
+    get_scheduler().add_job(
+        func,
+        id=user_job_id(user_id),
+        args=[user_id],
+        replace_existing=True,
+        **trigger_args
+    )
+
+
+def remove_user_job(user_id):
+    try:
+        get_scheduler().remove_job(user_job_id(user_id))
+    except JobLookupError:
+        pass
+
+
+def has_user_job(user_id):
+    return get_scheduler().get_job(user_job_id(user_id)) is not None
+
+
+def acquire_lease(name, ttl, force=False):
+    """Take or renew a named lease, True when this worker holds it afterwards."""
+    now = datetime.utcnow()
+    owner = worker_id()
+    db = SessionLocal()
+    try:
+        stmt = insert(Lease).values(name=name, owner=owner, expires_at=now + ttl)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["name"],
+            set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at},
+            where=None if force else ((Lease.owner == owner) | (Lease.expires_at < now)),
+        )
+        result = db.execute(stmt)
+        db.commit()
+        return result.rowcount == 1
+    finally:
+        db.close()
+
+
+def release_lease(name):
+    db = SessionLocal()
+    try:
+        db.query(Lease).filter(Lease.name == name, Lease.owner == worker_id()).delete()
+        db.commit()
+    finally:
+        db.close()
@@ -0,0 +1,85 @@
+from flask import Response, jsonify
+from sqlalchemy import select
+from database import Track, Album, Artist, Playlist, track_artist_table, saved_track_table, user_playlist_table
+from ingest import chunks
+
+try:
+    import orjson
+except ImportError:  # plain `pip install` from the readme doesn't pull it in
+    orjson = None
+
+
+def json_response(payload, status=200):
+    if orjson is None:
+        return jsonify(payload), status
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+
+def _artists_by_track(db, track_ids):
+    artists = {}
+    for chunk in chunks(track_ids):
+        rows = db.execute(
+            select(track_artist_table.c.track_id, Artist.id, Artist.name)
+            .join(Artist, Artist.id == track_artist_table.c.artist_id)
+            .where(track_artist_table.c.track_id.in_(chunk))
+        )
+        for track_id, artist_id, name in rows:
+            artists.setdefault(track_id, []).append({"id": artist_id, "name": name})
+    return artists
+
+
+def serialize_tracks(db, track_ids):
+    """Track dicts for the given ids, in the same order, in two queries."""
+    rows = {}
+    for chunk in chunks(track_ids):
+        for row in db.execute(
+            select(Track.id, Track.name, Track.preview_url, Album.name, Album.image_url)
+            .outerjoin(Album, Album.id == Track.album_id)
+            .where(Track.id.in_(chunk))
+        ):
+            rows[row[0]] = row
+    artists = _artists_by_track(db, list(rows))
+
+    return [
+        {
+            "id": track_id,
+            "name": name,
+            "album": album_name,
+            "artists": artists.get(track_id, []),
+            "preview_url": preview_url,
+            "album_image": album_image
+        }
+        for track_id, name, preview_url, album_name, album_image in (rows[i] for i in track_ids if i in rows)
+    ]
+
+
+def serialize_playlists(db, user_id):
+    return [
+        {
+            "id": playlist_id,
+            "name": name,
+            "num_tracks": num_tracks or 0,
+            "image_url": image_url
+        }
+        for playlist_id, name, num_tracks, image_url in db.execute(
+            select(Playlist.id, Playlist.name, Playlist.num_tracks, Playlist.image_url)
+            .join(user_playlist_table, user_playlist_table.c.playlist_id == Playlist.id)
+            .where(user_playlist_table.c.user_id == user_id)
+        )
+    ]
+
+
+def serialize_saved_songs(db, user_id):
+    return [
+        {
+            "id": track_id,
+            "name": name,
+            "album": album_name
+        }
+        for track_id, name, album_name in db.execute(
+            select(Track.id, Track.name, Album.name)
+            .join(saved_track_table, saved_track_table.c.track_id == Track.id)
+            .outerjoin(Album, Album.id == Track.album_id)
+            .where(saved_track_table.c.user_id == user_id)
+        )
+    ]
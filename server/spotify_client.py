@@ -0,0 +1,179 @@
+import os
+import time
+import random
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+import spotipy
+from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+from spotipy.cache_handler import MemoryCacheHandler
+from rate_limiter import rate_limiter
+
+API_URL = "https://api.spotify.com/v1/"
+
+# keep-alive connections per host, sized for the fetch pool plus request threads
+POOL_SIZE = int(os.getenv("SPOTIFY_POOL_SIZE", "32"))
+CONNECT_TIMEOUT = float(os.getenv("SPOTIFY_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("SPOTIFY_READ_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("SPOTIFY_HTTP_RETRIES", "3"))
+BACKOFF = 0.5
+# 429s asking for longer than this go back to the caller to retry later
+MAX_RETRY_AFTER = float(os.getenv("SPOTIFY_MAX_RETRY_AFTER", "5"))
+# spotipy clients kept around, one per access token
+CLIENT_CACHE_SIZE = 256
+
+RETRY_STATUSES = {500, 502, 503, 504}
+# safe to send twice, a POST to /me/player/next is not
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+def _backoff(attempt):
+    return BACKOFF * (2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def _retry_after(response, attempt):
+    try:
+        return max(0.0, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return _backoff(attempt)
+
+
+class SpotifyAdapter(HTTPAdapter):
+    """Pooled adapter that adds the rate limit, default timeouts and retries to every spotify call.
+
+    429s pause the shared limiter and are retried for any method since
+    spotify didn't run the request, 5xx and connection errors only for
+    idempotent ones.
+    """
+
+    def __init__(self, retries=HTTP_RETRIES, **kwargs):
+        self.retries = retries
+        kwargs.setdefault("pool_connections", 4)
+        kwargs.setdefault("pool_maxsize", POOL_SIZE)
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        idempotent = request.method in IDEMPOTENT_METHODS
+
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            rate_limiter.acquire()
+            try:
+                response = super().send(request, timeout=timeout, **kwargs)
+            except requests.exceptions.SSLError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if last or not idempotent:
+                    raise
+                wait = _backoff(attempt)
+            else:
+                if response.status_code == 429:
+                    wait = _retry_after(response, attempt)
+                    rate_limiter.pause(wait)
+                    if last or wait > MAX_RETRY_AFTER:
+                        return response
+                elif response.status_code in RETRY_STATUSES and idempotent and not last:
+                    wait = _backoff(attempt)
+                else:
+                    return response
+                response.close()
+                if response.status_code == 429:
+                    # acquire() waits out the pause
+                    continue
+            time.sleep(wait)
+
+
+_session = None
+_session_pid = None
+_clients = OrderedDict()
+# access token -> spotify user id, a token only ever belongs to one user
+_user_ids = OrderedDict()
+_app_client = None
+_oauth = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """The process wide session, rebuilt after a fork so workers don't share sockets."""
+    global _session, _session_pid, _app_client, _oauth
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            _session.mount("https://", SpotifyAdapter())
+            _session.mount("http://", SpotifyAdapter())
+            _session_pid = os.getpid()
+            _clients.clear()
+            _app_client = None
+            _oauth = None
+        return _session
+
+
+def get_client(token):
+    """Cached spotipy client for an access token, all of them share the pooled session."""
+    session = get_session()
+    with _lock:
+        sp = _clients.get(token)
+        if sp is not None:
+            _clients.move_to_end(token)
+            return sp
+    # the adapter already retries, spotipy's own retry layer is bypassed for a passed in session
+    sp = spotipy.Spotify(auth=token, requests_session=session, requests_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    with _lock:
+        _clients[token] = sp
+        while len(_clients) > CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+    return sp
+
+
+def get_app_client():
+    """Client credentials client for catalog reads that don't act for a user, e.g. artist lookups."""
+    global _app_client
+    session = get_session()
+    with _lock:
+        if _app_client is None:
+            # spotipy keeps the app token and fetches a new one when it expires
+            auth = SpotifyClientCredentials(requests_session=session)
+            _app_client = spotipy.Spotify(auth_manager=auth, requests_session=session, requests_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        return _app_client
+
+
+def refresh_user_token(refresh_token):
+    """New token info for a user from their stored refresh token, for work done while they're away.
+
+    Spotify sometimes rotates the refresh token, the returned one is the
+    one to keep.
+    """
+    global _oauth
+    session = get_session()
+    with _lock:
+        if _oauth is None:
+            # nothing is cached by spotipy, every user's token goes through this one object
+            _oauth = SpotifyOAuth(requests_session=session, cache_handler=MemoryCacheHandler(), open_browser=False)
+        oauth = _oauth
+    return oauth.refresh_access_token(refresh_token)
+
+
+def api_request(method, path, token, **kwargs):
+    """Raw call to the web api for endpoints the helpers hit without spotipy."""
+    headers = kwargs.pop("headers", {})
+    headers["Authorization"] = f"Bearer {token}"
+    url = path if path.startswith("http") else API_URL + path.lstrip("/")
+    return get_session().request(method, url, headers=headers, **kwargs)
+
+
+def get_user_id(token):
+    """Id of the token's user, only asked from spotify the first time the token is seen."""
+    with _lock:
+        user_id = _user_ids.get(token)
+        if user_id is not None:
+            _user_ids.move_to_end(token)
+            return user_id
+    user_id = get_client(token).current_user()["id"]
+    with _lock:
+        _user_ids[token] = user_id
+        while len(_user_ids) > CLIENT_CACHE_SIZE:
+            _user_ids.popitem(last=False)
+    return user_id
@@ -1,34 +1,153 @@
 import random
 import json
+import re
+import os
+import threading
+from collections import OrderedDict
 from flask import jsonify
-from database import SessionLocal, User, Playlist, Track, Album, Artist, PodcastEpisode, Show, Bundle, Genre
+from database import SessionLocal, User, Playlist, Track, Album, Artist, PodcastEpisode, Show, Bundle, Genre, QueueSession, Lease, saved_track_table, playlist_track_table, user_playlist_table, track_artist_table, artist_genre_table, user_genre_count_table
+from sqlalchemy import text, or_, exists, column, select, func, String
+from sqlalchemy.orm import selectinload, joinedload
 from sqlalchemy.orm.exc import NoResultFound
+from fetcher import call, fetch_all, stream, FETCH_WORKERS
+from spotify_client import get_client, get_app_client, api_request
+from ingest import ingest_tracks, chunks, refresh_user_genre_counts, refresh_playlist_count, artists_to_fetch, save_artist_details, link_playlists, unlink_playlists, playlist_followers, artist_listeners, CHUNK_SIZE, ARTIST_TTL
+from bundles import BundlePlan, get_bundle_plan
+from permutation import FeistelPermutation, new_seed
+from spread import spread_order, DEFAULT_WINDOW
+from track_store import track_store, source_query, invalidate_saved
+from rate_limiter import background
+from scheduler import add_startup_job, schedule_user_job, remove_user_job, has_user_job, acquire_lease, release_lease
+from datetime import datetime, timedelta
+import spotipy
+from spotipy.exceptions import SpotifyException
 
 def fetch_artist_genres(sp, artist_ids):
     """Fetch full artist details including genres from Spotify API"""
     artist_details = {}
     artist_ids_list = list(artist_ids)
+    num_batches = (len(artist_ids_list) - 1) // 50 + 1
     
     print(f"Fetching genres for {len(artist_ids_list)} unique artists...")
     
     # spotify only allows up to 50 artists per request
-    for i in range(0, len(artist_ids_list), 50):
+    def fetch_batch(i):
         batch = artist_ids_list[i:i+50]
         try:
-            print(f"Fetching batch {i//50 + 1}/{(len(artist_ids_list)-1)//50 + 1}")
-            results = sp.artists(batch)
-            for artist in results['artists']:
-                if artist:  # mae sure artist data exists
-                    artist_details[artist['id']] = artist
-                    print(f"Fetched {artist['name']}: {len(artist.get('genres', []))} genres")
+            print(f"Fetching batch {i//50 + 1}/{num_batches}")
+            return call(sp.artists, batch)['artists']
         except Exception as e:
             print(f"Error fetching artist batch {i//50 + 1}: {e}")
+            return []
+
+    for artists in fetch_all(fetch_batch, range(0, len(artist_ids_list), 50)):
+        for artist in artists:
+            if artist:  # mae sure artist data exists
+                artist_details[artist['id']] = artist
     
     print(f"Successfully fetched details for {len(artist_details)} artists")
     return artist_details
 
-# cache liked songs and playlists
-def cache_all_music_data(sp, user_id):
+def _enrich(sp, db, tracks, enriched):
+    """Genre details for the batch's artists that this sync hasn't looked at yet."""
+    artist_ids = {a["id"] for t in tracks for a in t.get("artists", []) if a.get("id")} - enriched
+    enriched.update(artist_ids)
+    missing = artists_to_fetch(db, artist_ids)
+    return fetch_artist_genres(sp, missing) if missing else {}
+
+# stale artists are looked for this often, by one worker at a time
+ARTIST_REFRESH_SECONDS = 15 * 60
+ARTIST_REFRESH_LEASE = timedelta(minutes=10)
+# 50-id /artists calls per run, spread out so a catalog past its TTL trickles back in
+ARTIST_REFRESH_BATCHES = int(os.getenv("ARTIST_REFRESH_BATCHES", "20"))
+
+def _genre_names(db, artist_ids):
+    """artist id -> set of genre names as cached."""
+    genres = {}
+    for chunk in chunks(list(artist_ids)):
+        for artist_id, name in db.execute(
+            select(artist_genre_table.c.artist_id, Genre.name)
+            .join(Genre, Genre.id == artist_genre_table.c.genre_id)
+            .where(artist_genre_table.c.artist_id.in_(chunk))
+        ):
+            genres.setdefault(artist_id, set()).add(name)
+    return genres
+
+def refresh_stale_artists():
+    """Look up artists past ARTIST_TTL again, oldest first, with the app's own credentials.
+
+    Runs in the background lane so it only uses budget shuffles and syncs
+    leave over. Each batch is written and committed on its own, with the
+    genre counts of everyone listening to an artist whose genres changed,
+    so no transaction stays open while a call waits on the rate limiter.
+    """
+    if not acquire_lease("artist_refresh", ARTIST_REFRESH_LEASE):
+        return
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - ARTIST_TTL
+        stale = db.execute(
+            select(Artist.id)
+            .where(or_(Artist.genres_fetched_at == None, Artist.genres_fetched_at < cutoff))
+            .order_by(Artist.genres_fetched_at)
+            .limit(ARTIST_REFRESH_BATCHES * 50)
+        ).scalars().all()
+        db.commit()
+        if not stale:
+            return
+        fetched, rebuilt = 0, set()
+        with background():
+            for batch in chunks(stale, 50):
+                try:
+                    artists = call(get_app_client().artists, batch)["artists"]
+                except Exception as e:
+                    print(f"artist refresh: batch failed: {e}")
+                    continue
+                details = {a["id"]: a for a in artists if a}
+                before = _genre_names(db, details)
+                changed = [artist_id for artist_id, artist in details.items()
+                           if set(artist.get("genres") or ()) != before.get(artist_id, set())]
+                save_artist_details(db, details, fetched_ids=batch)
+                listeners = artist_listeners(db, changed)
+                for user_id in listeners:
+                    refresh_user_genre_counts(db, user_id)
+                db.commit()
+                fetched += len(details)
+                rebuilt |= listeners
+        print(f"artist refresh: {len(stale)} stale, {fetched} looked up again, genre counts rebuilt for {len(rebuilt)} users")
+    except Exception as e:
+        db.rollback()
+        print(f"artist refresh failed: {e}")
+    finally:
+        db.close()
+
+add_startup_job(refresh_stale_artists, id="refresh_stale_artists", trigger="interval", seconds=ARTIST_REFRESH_SECONDS)
+
+def _checkpoint(db, progress=None):
+    """Commit what's ingested so far, with the job's counters so a restart shows how far it got."""
+    if progress:
+        progress.save(db)
+    db.commit()
+
+def _finish_playlist(db, playlist_id, seen, snapshot_id):
+    """Drop the tracks a reread playlist no longer has and mark it cached at snapshot_id."""
+    cached = set(db.execute(
+        select(playlist_track_table.c.track_id).where(playlist_track_table.c.playlist_id == playlist_id)
+    ).scalars())
+    for chunk in chunks(cached - seen):
+        db.execute(playlist_track_table.delete().where(
+            (playlist_track_table.c.playlist_id == playlist_id) &
+            (playlist_track_table.c.track_id.in_(chunk))
+        ))
+    refresh_playlist_count(db, playlist_id)
+    db.query(Playlist).filter(Playlist.id == playlist_id).update(
+        {Playlist.snapshot_id: snapshot_id}, synchronize_session=False
+    )
+
+# cache liked songs and playlists, a batch at a time so memory stays flat for big libraries.
+# every batch is committed, so a sync that dies part way loses one batch and the retry
+# picks up where it stopped
+def cache_all_music_data(sp, user_id, progress=None):
     db = SessionLocal()
     
     user = db.query(User).filter_by(id=user_id).first()
@@ -36,83 +155,83 @@ def cache_all_music_data(sp, user_id):
         user = User(id=user_id)
         db.add(user)
         db.commit()
-    
-    # get all music data first
-    saved_tracks = get_saved_songs(sp)
-    playlists_data = get_playlists(sp)
-    
-    # get all unique artist ids from all sources
-    all_artist_ids = set()
-    all_track_data = []
-    
-    # saved tracks
-    for item in saved_tracks:
-        all_track_data.append(('saved', item))
-        for artist_data in item.get("artists", []):
-            all_artist_ids.add(artist_data["id"])
-    
-    # playlists
-    playlist_tracks_data = {}
-    for playlist_obj in playlists_data:
-        playlist_id = playlist_obj["id"]
-        print(f"Fetching tracks for playlist: {playlist_obj['name']}")
-        playlist_tracks = get_songs(sp, playlist_id)
-        playlist_tracks_data[playlist_id] = {
-            'info': playlist_obj,
-            'tracks': playlist_tracks
-        }
-        
-        for track_data in playlist_tracks:
-            if track_data and track_data.get("type") == "track" and track_data.get("id"):
-                all_track_data.append(('playlist', track_data, playlist_id))
-                for artist_data in track_data.get("artists", []):
-                    all_artist_ids.add(artist_data["id"])
-    
-    # get all artist details with genres in batches
-    artist_details = fetch_artist_genres(sp, all_artist_ids)
-    
-    # proccess saved tracks with full artist data
-    for item in saved_tracks:
-        # combine artist data with genres
-        for artist_data in item.get("artists", []):
-            if artist_data["id"] in artist_details:
-                full_artist_data = artist_details[artist_data["id"]]
-                artist_data.update(full_artist_data)
-        
-        track = get_or_create_track(item, db)
-        if track and track not in user.saved_tracks:
-            user.saved_tracks.append(track)
-    
-    # proccess playlists with full artist data
-    print("Caching playlists with genre data...")
-    for playlist_id, playlist_data in playlist_tracks_data.items():
-        playlist_obj = playlist_data['info']
-        playlist_tracks = playlist_data['tracks']
-        
-        playlist = db.query(Playlist).filter_by(id=playlist_id).first()
-        if not playlist:
+
+    # artists already enriched during this sync
+    enriched = set()
+
+    try:
+        # saved tracks, the watermark is only set once all of them are in. After that,
+        # e.g. when retrying a sync that failed in the playlists, the diff is enough
+        if user.saved_tracks_watermark is None:
+            watermark, skipped = None, 0
+            for items in rebatch(iter_saved_items(sp)):
+                skipped += sum(1 for item in items if not (item["track"] or {}).get("id"))
+                items = [item for item in items if item["track"]]
+                if not items:
+                    continue
+                tracks = [item["track"] for item in items]
+                added_at = {item["track"].get("id"): item.get("added_at") for item in items}
+                watermark = watermark or next((item.get("added_at") for item in items if item["track"].get("id")), None)
+                saved_ids = ingest_tracks(db, tracks, _enrich(sp, db, tracks, enriched), user_id=user_id, added_at=added_at)
+                invalidate_saved(db, user_id)
+                if progress:
+                    progress.add_tracks(len(saved_ids))
+                _checkpoint(db, progress)
+            user.saved_tracks_watermark = watermark
+            user.saved_tracks_skipped = skipped
+        else:
+            print("liked songs cached before, syncing changes only")
+            _sync_saved_tracks(sp, user, db, progress)
+        invalidate_saved(db, user_id)
+        _checkpoint(db, progress)
+
+        # playlists, pages from several playlists are fetched at once and written as they arrive
+        playlists_data = get_playlists(sp)
+        if progress:
+            progress.set_total(len(playlists_data))
+        link_playlists(db, user_id, [p["id"] for p in playlists_data])
+        to_fetch = []
+        for playlist_obj in playlists_data:
+            playlist = db.get(Playlist, playlist_obj["id"])
+            snapshot_id = playlist_obj.get("snapshot_id")
+            if playlist and snapshot_id and playlist.snapshot_id == snapshot_id:
+                # cached at this snapshot, by another user or before this sync was interrupted
+                if progress:
+                    progress.playlist_done()
+                continue
             images = playlist_obj.get("images", [])
             image_url = images[0]["url"] if images else None
-            playlist = Playlist(id=playlist_id, name=playlist_obj["name"], user=user, snapshot_id=playlist_obj.get("snapshot_id"), image_url=image_url)
-            db.add(playlist)
-            db.flush()
-        
-        for track_data in playlist_tracks:
-            if not track_data or track_data.get("type") != "track" or not track_data.get("id"):
-                continue
-                
-            # combine artist data with genres
-            for artist_data in track_data.get("artists", []):
-                if artist_data["id"] in artist_details:
-                    full_artist_data = artist_details[artist_data["id"]]
-                    artist_data.update(full_artist_data)
-            
-            with db.no_autoflush:
-                track = get_or_create_track(track_data, db)
-                if track and track not in playlist.tracks:
-                    playlist.tracks.append(track)
-    
-    try:
+            if not playlist:
+                # the snapshot is set by _finish_playlist once every track is in
+                db.add(Playlist(id=playlist_obj["id"], name=playlist_obj["name"], image_url=image_url))
+            else:
+                # changed since it was cached, read again over the old tracks
+                playlist.name = playlist_obj["name"]
+                playlist.image_url = image_url or playlist.image_url
+            to_fetch.append(playlist_obj)
+        _checkpoint(db, progress)
+
+        def fetch_playlist(playlist_obj):
+            print(f"Fetching tracks for playlist: {playlist_obj['name']}")
+            return rebatch(iter_playlist_tracks(sp, playlist_obj["id"]))
+
+        print("Caching playlists with genre data...")
+        ingested, seen = {}, {}
+        for playlist_obj, tracks in stream(fetch_playlist, to_fetch):
+            playlist_id = playlist_obj["id"]
+            if tracks is None:
+                _finish_playlist(db, playlist_id, seen.pop(playlist_id, set()), playlist_obj.get("snapshot_id"))
+                if progress:
+                    progress.playlist_done(ingested.get(playlist_id, 0))
+            else:
+                track_ids = ingest_tracks(db, tracks, _enrich(sp, db, tracks, enriched), playlist_id=playlist_id)
+                seen.setdefault(playlist_id, set()).update(track_ids)
+                ingested[playlist_id] = ingested.get(playlist_id, 0) + len(track_ids)
+            _checkpoint(db, progress)
+
+        # playlists read again over old tracks may be shared, their followers' counts change too
+        for follower_id in {user_id} | playlist_followers(db, [p["id"] for p in to_fetch]):
+            refresh_user_genre_counts(db, follower_id)
         db.commit()
     except Exception as e:
         db.rollback()
@@ -120,26 +239,57 @@ def cache_all_music_data(sp, user_id):
     finally:
         db.close()
 
-import threading
-def cache_playlists_async(sp, user_id):
-    def worker():
-        cache_all_music_data(sp, user_id)
-
-    threading.Thread(target=worker).start()
+def clear_user_cache(user_id):
+    db = SessionLocal()
+    
+    user = db.query(User).filter(User.id == user_id).first()
+    if user:
+        # playlists other users follow stay cached for them
+        playlist_ids = [playlist.id for playlist in user.playlists]
+        deleted = unlink_playlists(db, user_id, playlist_ids)
+        user.saved_tracks.clear()
+        user.saved_tracks_watermark = None
+        user.saved_tracks_skipped = 0
+        invalidate_saved(db, user_id)
+        track_store.drop_user(user_id, deleted)
+        db.execute(user_genre_count_table.delete().where(user_genre_count_table.c.user_id == user_id))
+        db.flush()
 
+        # delete whatever nobody references anymore, join rows first
+        orphan_tracks = select(Track.id).where(~Track.saved_by_users.any(), ~Track.playlists.any())
+        db.execute(track_artist_table.delete().where(track_artist_table.c.track_id.in_(orphan_tracks)))
+        db.query(Track).filter(~Track.saved_by_users.any(), ~Track.playlists.any()).delete(synchronize_session=False)
+        orphan_artists = select(Artist.id).where(~Artist.tracks.any())
+        db.execute(artist_genre_table.delete().where(artist_genre_table.c.artist_id.in_(orphan_artists)))
+        db.query(Artist).filter(~Artist.tracks.any()).delete(synchronize_session=False)
+        db.query(Album).filter(~Album.tracks.any()).delete(synchronize_session=False)
+        db.query(PodcastEpisode).filter(~PodcastEpisode.show.has()).delete(synchronize_session=False)
+        db.query(Show).filter(~Show.episodes.any()).delete(synchronize_session=False)
+        db.query(Genre).filter(~Genre.artists.any()).delete(synchronize_session=False)
+        db.execute(text("DELETE FROM track_search WHERE track_id NOT IN (SELECT id FROM tracks)"))
+        db.execute(text("DELETE FROM artist_search WHERE artist_id NOT IN (SELECT id FROM artists)"))
+        
+        db.commit()
+    
+    db.close()
+    print("cache cleared")
 
-def cache_incremental(sp, user_id):
+def cache_incremental(sp, user_id, progress=None):
     """Smart incremental cache: only fetches what changed since last cache."""
     db = SessionLocal()
     try:
         user = db.query(User).filter_by(id=user_id).first()
         if not user:
             db.close()
-            cache_all_music_data(sp, user_id)
+            cache_all_music_data(sp, user_id, progress)
             return
 
-        _sync_saved_tracks(sp, user, db)
-        _sync_playlists(sp, user, db)
+        _sync_saved_tracks(sp, user, db, progress)
+        _checkpoint(db, progress)
+        changed = _sync_playlists(sp, user, db, progress)
+        # everyone following a changed playlist sees its new tracks in their counts
+        for follower_id in {user_id} | playlist_followers(db, changed):
+            refresh_user_genre_counts(db, follower_id)
 
         db.commit()
         print("incremental cache complete")
@@ -151,111 +301,126 @@ def cache_incremental(sp, user_id):
         db.close()
 
 
-def _sync_saved_tracks(sp, user, db):
-    """Add new liked songs and remove any that were unliked."""
-    first_page = sp.current_user_saved_tracks(limit=1)
-    spotify_total = first_page["total"]
-    cached_ids = set(t.id for t in user.saved_tracks)
-    cached_total = len(cached_ids)
+def _sync_saved_tracks(sp, user, db, progress=None):
+    """Diff liked songs against the cache in one newest-first walk.
+
+    Spotify lists liked songs by added_at, newest first, and re-liking a song
+    moves it back to the top, so everything older than the user's watermark
+    was already cached. Once the walk is past the watermark, a cached song
+    newer than the current position that hasn't shown up was unliked, and if
+    the cached songs still unseen match the count spotify has left the rest
+    of the library is unchanged and the walk stops. Items without a track id
+    are never cached, so the ones the last sync counted and this walk hasn't
+    come across yet are taken to be in the part it skips.
+    """
+    cached = dict(db.execute(
+        select(saved_track_table.c.track_id, saved_track_table.c.added_at)
+        .where(saved_track_table.c.user_id == user.id)
+    ).all())
+    watermark = user.saved_tracks_watermark
+
+    seen = set()
+    changed, added_at = [], {}
+    pages = consumed = skipped = 0
+    newest = boundary = None
+    complete = False
+
+    results = call(sp.current_user_saved_tracks, limit=50)
+    total = results["total"]
+    while True:
+        pages += 1
+        for item in results["items"]:
+            consumed += 1
+            track = item.get("track")
+            if not track or not track.get("id"):
+                skipped += 1
+                continue
+            track_id = track["id"]
+            seen.add(track_id)
+            newest = newest or item.get("added_at")
+            boundary = item.get("added_at") or boundary
+            # new likes, re-likes and rows from before added_at was stored
+            if cached.get(track_id, "") != item.get("added_at"):
+                changed.append(track)
+                added_at[track_id] = item.get("added_at")
+
+        if not results["next"]:
+            complete = True
+            break
+        # strictly past the watermark, so ties with the newest cached song can't hide a new one
+        if watermark and boundary and boundary < watermark:
+            unseen = [t for t in cached if t not in seen]
+            older = sum(1 for t in unseen if cached[t] is None or cached[t] <= boundary)
+            skipped_left = max(0, (user.saved_tracks_skipped or 0) - skipped)
+            if older + skipped_left == total - consumed:
+                skipped += skipped_left
+                break
+        results = call(sp.next, results)
 
-    if spotify_total == cached_total:
-        print(f"saved tracks unchanged ({spotify_total}), skipping")
-        return
+    if complete:
+        removed_ids = [t for t in cached if t not in seen]
+    else:
+        removed_ids = [t for t in cached if t not in seen and cached[t] is not None and cached[t] > boundary]
 
-    print(f"saved tracks changed: cached={cached_total}, spotify={spotify_total}")
-
-    if spotify_total > cached_total:
-        # only fetch new tracks — spotify returns newest first, stop when we hit cached ones
-        new_track_data = []
-        results = sp.current_user_saved_tracks(limit=50)
-        while results:
-            all_in_batch_cached = True
-            for item in results["items"]:
-                track = item.get("track")
-                if not track or not track.get("id"):
-                    continue
-                if track["id"] not in cached_ids:
-                    all_in_batch_cached = False
-                    new_track_data.append(track)
-            if all_in_batch_cached or not results["next"]:
-                break
-            results = sp.next(results)
+    print(f"saved tracks: {pages} pages read, {len(changed)} new or updated, {len(removed_ids)} removed")
 
-        print(f"fetching {len(new_track_data)} new saved tracks")
-        new_artist_ids = {a["id"] for t in new_track_data for a in t.get("artists", [])}
+    # genres are fetched before anything is written, so no write lock is held over the calls
+    artist_details = {}
+    if changed:
+        new_artist_ids = artists_to_fetch(db, {a["id"] for t in changed if t["id"] not in cached for a in t.get("artists", [])})
         artist_details = fetch_artist_genres(sp, new_artist_ids) if new_artist_ids else {}
 
-        for track_data in new_track_data:
-            for artist_data in track_data.get("artists", []):
-                if artist_data["id"] in artist_details:
-                    artist_data.update(artist_details[artist_data["id"]])
-            track = get_or_create_track(track_data, db)
-            if track and track not in user.saved_tracks:
-                user.saved_tracks.append(track)
+    # remove unliked tracks from user's saved list (don't delete the track itself)
+    for chunk in chunks(removed_ids):
+        db.execute(saved_track_table.delete().where(
+            (saved_track_table.c.user_id == user.id) &
+            (saved_track_table.c.track_id.in_(chunk))
+        ))
 
-    else:
-        # songs were removed — fetch full id set from spotify and reconcile
-        print("songs removed, reconciling saved tracks")
-        all_spotify_ids = set()
-        results = sp.current_user_saved_tracks(limit=50)
-        while results:
-            for item in results["items"]:
-                track = item.get("track")
-                if track and track.get("id"):
-                    all_spotify_ids.add(track["id"])
-            if not results["next"]:
-                break
-            results = sp.next(results)
-
-        removed_ids = cached_ids - all_spotify_ids
-        added_ids = all_spotify_ids - cached_ids
-
-        # remove unliked tracks from user's saved list (don't delete the track itself)
-        if removed_ids:
-            user.saved_tracks = [t for t in user.saved_tracks if t.id not in removed_ids]
-            print(f"removed {len(removed_ids)} unliked tracks")
-
-        # add any new ones
-        if added_ids:
-            new_track_data = []
-            results = sp.current_user_saved_tracks(limit=50)
-            while results:
-                for item in results["items"]:
-                    track = item.get("track")
-                    if track and track.get("id") in added_ids:
-                        new_track_data.append(track)
-                if not results["next"]:
-                    break
-                results = sp.next(results)
-
-            new_artist_ids = {a["id"] for t in new_track_data for a in t.get("artists", [])}
-            artist_details = fetch_artist_genres(sp, new_artist_ids) if new_artist_ids else {}
-            for track_data in new_track_data:
-                for artist_data in track_data.get("artists", []):
-                    if artist_data["id"] in artist_details:
-                        artist_data.update(artist_details[artist_data["id"]])
-                track = get_or_create_track(track_data, db)
-                if track and track not in user.saved_tracks:
-                    user.saved_tracks.append(track)
-
-
-def _sync_playlists(sp, user, db):
-    """Add/update changed playlists using snapshot_id, remove deleted ones."""
-    from database import Playlist
+    if changed or removed_ids:
+        invalidate_saved(db, user.id)
+
+    if changed:
+        ingest_tracks(db, changed, artist_details, user_id=user.id, added_at=added_at)
+        if progress:
+            progress.add_tracks(sum(1 for t in changed if t["id"] not in cached))
+
+    if newest or complete:
+        user.saved_tracks_watermark = newest
+    user.saved_tracks_skipped = skipped
+
+
+def _sync_playlists(sp, user, db, progress=None):
+    """Add/update changed playlists using snapshot_id, remove deleted ones.
+
+    Returns the ids of the playlists whose tracks were synced again.
+    """
     spotify_playlists = get_playlists(sp)
     spotify_ids = {p["id"] for p in spotify_playlists}
+    if progress:
+        progress.set_total(len(spotify_playlists))
 
-    # remove playlists deleted from spotify
+    # drop playlists the user deleted or unfollowed on spotify
+    cached_playlists = {}
+    removed = []
     for playlist in list(user.playlists):
         if playlist.id not in spotify_ids:
             print(f"removing deleted playlist: {playlist.name}")
-            db.delete(playlist)
-
+            removed.append(playlist.id)
+        else:
+            cached_playlists[playlist.id] = playlist
+    if removed:
+        for playlist_id in unlink_playlists(db, user.id, removed):
+            track_store.drop(f"playlist:{playlist_id}")
+    # new follows of playlists that are already cached need no fetch at all
+    link_playlists(db, user.id, [playlist_id for playlist_id in spotify_ids if playlist_id not in cached_playlists])
+
+    changed = []
     for playlist_obj in spotify_playlists:
         playlist_id = playlist_obj["id"]
         snapshot_id = playlist_obj.get("snapshot_id")
 
-        playlist = db.query(Playlist).filter_by(id=playlist_id).first()
+        playlist = cached_playlists.get(playlist_id) or db.get(Playlist, playlist_id)
 
         if playlist and playlist.snapshot_id == snapshot_id:
             print(f"playlist '{playlist.name}' unchanged, skipping")
@@ -264,285 +429,409 @@ def _sync_playlists(sp, user, db):
                 images = playlist_obj.get("images", [])
                 if images:
                     playlist.image_url = images[0]["url"]
+            if progress:
+                progress.playlist_done()
             continue
 
         print(f"syncing playlist '{playlist_obj['name']}'")
-        playlist_tracks = get_songs(sp, playlist_id)
+        # commit what the loop changed so far, the playlist is read and its genres fetched
+        # without holding the write lock, and only then written
+        _checkpoint(db, progress)
+
+        # diff membership so a one track edit is one insert, not a rebuild
+        cached_ids = set(db.execute(
+            select(playlist_track_table.c.track_id).where(playlist_track_table.c.playlist_id == playlist_id)
+        ).scalars())
+        # only keep payloads for tracks we don't have, ids are enough for the rest
+        playlist_track_ids, added_tracks = set(), []
+        for page in iter_playlist_tracks(sp, playlist_id):
+            for t in page:
+                if t.get("type", "track") != "track" or not t.get("id") or t["id"] in playlist_track_ids:
+                    continue
+                playlist_track_ids.add(t["id"])
+                if t["id"] not in cached_ids:
+                    added_tracks.append(t)
+        removed_ids = cached_ids - playlist_track_ids
 
+        # only fetch artist details for artists not already in db
+        artist_ids = {a["id"] for t in added_tracks for a in t.get("artists", []) if a.get("id")}
+        new_artist_ids = artists_to_fetch(db, artist_ids)
+        artist_details = fetch_artist_genres(sp, new_artist_ids) if new_artist_ids else {}
+
+        images = playlist_obj.get("images", [])
         if not playlist:
-            images = playlist_obj.get("images", [])
             image_url = images[0]["url"] if images else None
-            playlist = Playlist(id=playlist_id, name=playlist_obj["name"], user=user, snapshot_id=snapshot_id, image_url=image_url)
+            playlist = Playlist(id=playlist_id, name=playlist_obj["name"], snapshot_id=snapshot_id, image_url=image_url)
             db.add(playlist)
             db.flush()
         else:
             playlist.name = playlist_obj["name"]
             playlist.snapshot_id = snapshot_id
-            images = playlist_obj.get("images", [])
             playlist.image_url = images[0]["url"] if images else playlist.image_url
-            playlist.tracks.clear()
-            db.flush()
-
-        # only fetch artist details for artists not already in db
-        new_artist_ids = set()
-        for track_data in playlist_tracks:
-            if not track_data or track_data.get("type") != "track":
-                continue
-            for artist_data in track_data.get("artists", []):
-                from database import Artist
-                existing = db.get(Artist, artist_data["id"])
-                if not existing or not existing.genres:
-                    new_artist_ids.add(artist_data["id"])
-
-        artist_details = fetch_artist_genres(sp, new_artist_ids) if new_artist_ids else {}
-
-        for track_data in playlist_tracks:
-            if not track_data or track_data.get("type") != "track" or not track_data.get("id"):
-                continue
-            for artist_data in track_data.get("artists", []):
-                if artist_data["id"] in artist_details:
-                    artist_data.update(artist_details[artist_data["id"]])
-            with db.no_autoflush:
-                track = get_or_create_track(track_data, db)
-                if track and track not in playlist.tracks:
-                    playlist.tracks.append(track)
-    
-def get_or_create_album(album_data, db):
-    album_id = album_data.get("id")
-    if not album_id:
-        return None
 
-    album = db.get(Album, album_data["id"])
-    if not album:
-        images = album_data.get("images", [])
-        image_url = images[0]["url"] if images else None
-        album = Album(
-            id=album_data["id"],
-            name=album_data["name"],
-            release_date=album_data.get("release_date", ""),
-            image_url=image_url
-        )
-        db.add(album)
-    return album
-
-def get_or_create_artist(artist_data, db):
-    from sqlalchemy.exc import IntegrityError
+        for chunk in chunks(removed_ids):
+            db.execute(playlist_track_table.delete().where(
+                (playlist_track_table.c.playlist_id == playlist_id) &
+                (playlist_track_table.c.track_id.in_(chunk))
+            ))
+
+        added = ingest_tracks(db, added_tracks, artist_details, playlist_id=playlist_id)
+        print(f"playlist '{playlist_obj['name']}': {len(added)} added, {len(removed_ids)} removed")
+        changed.append(playlist_id)
+        if progress:
+            progress.playlist_done(len(added))
+        # one playlist at a time, its snapshot only lands together with its tracks
+        _checkpoint(db, progress)
+    return changed
     
-    artist = db.get(Artist, artist_data["id"])
-    if not artist:
-        artist = Artist(id=artist_data["id"], name=artist_data["name"])
-        db.add(artist)
-        
-    #  genres if they exist in the artist data
-    if "genres" in artist_data and artist_data["genres"]:
-        print(f"Processing {len(artist_data['genres'])} genres for {artist_data['name']}")
-        for genre_name in artist_data["genres"]:
-            genre = db.query(Genre).filter_by(name=genre_name).first()
-            if not genre:
-                try:
-                    genre = Genre(name=genre_name)
-                    db.add(genre)
-                    db.flush()
-                    print(f"Created new genre: {genre_name}")
-                except IntegrityError:
-                    # if genre already exists, rollback and get it
-                    db.rollback()
-                    genre = db.query(Genre).filter_by(name=genre_name).first()
-                    if not genre:
-                        print(f"Still couldn't find genre {genre_name}, skipping")
-                        continue
-            
-            if genre not in artist.genres:
-                artist.genres.append(genre)
-                
-    return artist
-
-def get_or_create_track(track_data, db):
-    if track_data.get("type") == "episode":
-        return get_or_create_podcast_episode(track_data, db)
-
-    track_id = track_data.get("id")
-    if not track_id:
-        print("Skipping track with missing ID:", track_data)
-        return None
-
-    track = db.get(Track, track_id)
-    if not track:
-        album = get_or_create_album(track_data["album"], db) if track_data.get("album") else None
-        track = Track(
-            id=track_id,
-            name=track_data["name"],
-            album=album,
-            preview_url=track_data.get("preview_url")
-        )
-        db.add(track)
-        for artist_data in track_data.get("artists", []):
-            artist = get_or_create_artist(artist_data, db)
-            track.artists.append(artist)
-        db.flush()
-    elif track.preview_url is None and track_data.get("preview_url"):
-        track.preview_url = track_data.get("preview_url")
-    return track
-
-def get_or_create_podcast_episode(episode_data, db):
-    episode_id = episode_data.get("id")
-    if not episode_id:
-        return None
-
-    episode = db.get(PodcastEpisode, episode_id)
-    if episode:
-        return episode
-
-    show = None
-    if "show" in episode_data and episode_data["show"]:
-        show = get_or_create_show(episode_data["show"], db)
-
-    episode = PodcastEpisode(
-        id=episode_id,
-        name=episode_data.get("name"),
-        show=show,
-        release_date=episode_data.get("release_date"),
-    )
-    db.add(episode)
-    db.flush() 
-    return episode
-
-def get_or_create_show(show_data, db):
-    show_id = show_data.get("id")
-    if not show_id:
-        return None
-    show = db.get(Show, show_id)
-    if show:
-        return show
-    show = Show(id=show_id, name=show_data.get("name"))
-    db.add(show)
-    return show
-
 def load_user_cache(user_id):
+    """A user's liked songs and playlists as plain id lists, read through the track store."""
     db = SessionLocal()
-    
-    user = db.query(User).filter_by(id=user_id).first()
-    if not user:
-        db.close()
-        return None
-
-    saved_songs = [track.id for track in user.saved_tracks]
-    
-    playlists = {}
-    for playlist in user.playlists:
-        playlists[playlist.id] = {
-            "name": playlist.name,
-            "tracks": [track.id for track in playlist.tracks]
+    try:
+        if not db.get(User, user_id):
+            return None
+        saved_songs = list(track_store.get(db, f"saved:{user_id}"))
+        playlists = {
+            playlist_id: {
+                "name": name,
+                "tracks": list(track_store.get(db, f"playlist:{playlist_id}"))
+            }
+            for playlist_id, name in db.execute(
+                select(Playlist.id, Playlist.name)
+                .join(user_playlist_table, user_playlist_table.c.playlist_id == Playlist.id)
+                .where(user_playlist_table.c.user_id == user_id)
+            )
         }
-
-    db.close()
+    finally:
+        db.close()
     return {
         "saved_songs": saved_songs,
         "playlists": playlists
     }
 
-def start_playback_with_queue(sp, track_uris, device_id, queue_scheduler, user_id):
-    sp.start_playback(uris=[f"spotify:track:{track_uris[0]}"], device_id=device_id)
+# orphaned queues are looked for this often
+QUEUE_CHECK_SECONDS = 60
+# a worker that stops renewing (crashed, restarted) loses the user this long after its next check was due
+QUEUE_LEASE = timedelta(seconds=150)
+
+def queue_lease_name(user_id):
+    return f"queue:{user_id}"
+
+# tracks kept ahead in spotify's queue, small so bundle edits and skips apply within a few songs
+QUEUE_WINDOW = int(os.getenv("QUEUE_WINDOW", "5"))
+# the next check is timed for when this many queued tracks are left
+QUEUE_LOW_WATER = 3
+# for tracks synced before durations were stored
+DEFAULT_DURATION_MS = 210000
+MIN_CHECK_SECONDS = 15
+# after a failed check, so a network blip doesn't end the session
+QUEUE_RETRY_SECONDS = 30
+# skips, pauses and seeks aren't visible from the queue, so don't trust a guess for longer
+# than about a song, someone skipping through could empty the window otherwise
+MAX_CHECK_SECONDS = 180
+
+def source_size(db, source):
+    return len(track_store.get(db, source))
+
+SHUFFLE_MODES = ("random", "artist", "album")
+# spread orders are computed once per session and kept for the refills, bounded across listeners
+SPREAD_CACHE_SIZE = 16
+_spread_orders = OrderedDict()
+_spread_lock = threading.Lock()
+
+def _source_keys(db, source, mode):
+    """A source's track ids in their stable order, with each track's artist or album."""
+    tracks = source_query(source).subquery()
+    if mode == "album":
+        stmt = (select(tracks.c.track_id, Track.album_id)
+                .outerjoin(Track, Track.id == tracks.c.track_id))
+    else:
+        # tracks with several artists count as their first by id
+        stmt = (select(tracks.c.track_id, func.min(track_artist_table.c.artist_id))
+                .outerjoin(track_artist_table, track_artist_table.c.track_id == tracks.c.track_id)
+                .group_by(tracks.c.track_id))
+    return db.execute(stmt.order_by(tracks.c.track_id)).all()
+
+def spread_track_order(db, session):
+    """Track ids of a spread session in play order, the same for the same seed."""
+    cache_key = (session.source, session.seed, session.mode, session.spread_window, session.num_tracks)
+    with _spread_lock:
+        order = _spread_orders.get(cache_key)
+        if order is not None:
+            _spread_orders.move_to_end(cache_key)
+            return order
+
+    rows = _source_keys(db, session.source, session.mode)
+    codes = {}
+    # unknown artist/album gets a key of its own so those tracks aren't spread as one group
+    keys = [codes.setdefault(key if key is not None else ("track", track_id), len(codes)) for track_id, key in rows]
+    order = [rows[i][0] for i in spread_order(keys, session.seed, session.spread_window or DEFAULT_WINDOW)]
+
+    with _spread_lock:
+        _spread_orders[cache_key] = order
+        while len(_spread_orders) > SPREAD_CACHE_SIZE:
+            _spread_orders.popitem(last=False)
+    return order
+
+def queue_exhausted(session):
+    if not session.source:
+        return session.curr_index >= len(json.loads(session.track_ids))
+    return session.cursor >= session.num_tracks and not json.loads(session.pending or "[]")
+
+def next_tracks(db, session, count, plan=None):
+    """The session's next count track ids, advancing it.
+
+    Lazy sessions walk a seeded permutation of their source (or the
+    seeded spread order in artist/album mode) and apply bundles as tracks
+    come out, the same left to right pass BundlePlan.apply makes over a
+    whole list.
+    """
+    if count <= 0:
+        return []
+    if not session.source:
+        # sessions started before lazy shuffles kept the full list
+        track_ids = json.loads(session.track_ids)
+        out = track_ids[session.curr_index:session.curr_index + count]
+        session.curr_index += len(out)
+        return out
+
+    pending = json.loads(session.pending or "[]")
+    used = set(json.loads(session.bundles_used or "[]"))
+    if session.mode in ("artist", "album"):
+        order = spread_track_order(db, session)
+        pick = lambda i: order[i] if i < len(order) else None
+    else:
+        perm = FeistelPermutation(session.num_tracks, session.seed)
+        tracks = track_store.get(db, session.source)
+
+        def pick(i):
+            j = perm[i]
+            return tracks[j] if j < len(tracks) else None
+    while len(pending) < count and session.cursor < session.num_tracks:
+        track_id = pick(session.cursor)
+        session.cursor += 1
+        if track_id is None:
+            # the source shrank since the shuffle started
+            continue
+        pending.extend(plan.expand(track_id, used) if plan else [track_id])
+
+    session.pending = json.dumps(pending[count:])
+    session.bundles_used = json.dumps(sorted(used))
+    return pending[:count]
+
+def pick_device(sp):
+    """The device spotify is playing on, else the first one listed, None when there are none."""
+    devices = sp.devices().get("devices", [])
+    active = [d for d in devices if d.get("is_active")]
+    return (active or devices)[0]["id"] if devices else None
+
+def remembered_device(db, user_id):
+    return db.execute(select(QueueSession.device_id).where(QueueSession.user_id == user_id)).scalar()
+
+class EmptyShuffle(ValueError):
+    """The source has no tracks to play."""
+
+def start_playback_with_queue(sp, source, device_id, user_id, token, seed=None, mode="random", spread_window=None, remembered=False):
+    """Start a lazy shuffle of source, returns (seed, number of source tracks).
 
+    Only the first track is started here, the queue is filled by a
+    check_queue run right after. Passing the seed of an earlier shuffle
+    replays the same order. remembered means device_id is from the last
+    shuffle rather than spotify's device list, if it's gone the list is
+    asked for after all.
+    """
     db = SessionLocal()
-    user = db.query(User).filter_by(id=user_id).first()
-    if not user:
+    try:
+        user = db.query(User).filter_by(id=user_id).first()
+        if not user:
+            raise Exception("user not found")
+        # before the session row is touched, the store's version check would autoflush it half filled
+        num_tracks = source_size(db, source)
+
+        session = db.get(QueueSession, user_id)
+        if session is None:
+            session = QueueSession(user_id=user_id)
+            db.add(session)
+        session.source = source
+        session.seed = new_seed() if seed is None else seed
+        session.mode = mode
+        session.spread_window = spread_window
+        session.num_tracks = num_tracks
+        session.cursor = 0
+        session.pending = None
+        session.bundles_used = None
+        session.playing_track_id = None
+        session.playing_since = None
+        session.track_ids = "[]"
+        session.curr_index = 0
+        session.device_id = device_id
+        session.access_token = token
+        session.active = True
+        session.updated_at = datetime.utcnow()
+
+        first = next_tracks(db, session, 1, get_bundle_plan(db, user.id, user.bundles_version))
+        if not first:
+            raise EmptyShuffle("nothing to shuffle")
+        uris = [f"spotify:track:{first[0]}"]
+        try:
+            sp.start_playback(uris=uris, device_id=device_id)
+        except SpotifyException as e:
+            if not remembered or e.http_status != 404:
+                raise
+            # app closed or speaker off since the last shuffle
+            session.device_id = pick_device(sp)
+            if not session.device_id:
+                raise
+            sp.start_playback(uris=uris, device_id=session.device_id)
+        db.commit()
+        seed, num_tracks = session.seed, session.num_tracks
+    finally:
         db.close()
-        raise Exception("user not found")
-
-    user.curr_index = 1
-    db.commit()
-    db.close()
 
-    reset_scheduler(queue_scheduler)
-    from datetime import datetime
-    queue_scheduler.add_job(
-        func=check_queue,
-        args=[sp, track_uris, device_id, user_id],
-        trigger="interval",
-        seconds=60,
-        next_run_time=datetime.now()
-    )
+    # take the user over from whichever worker ran their last shuffle
+    acquire_lease(queue_lease_name(user_id), QUEUE_LEASE, force=True)
+    schedule_queue_check(user_id)
+    return seed, num_tracks
+
+def schedule_queue_check(user_id, seconds=0):
+    # a one-off run, each check books the next one from what's left to play
+    schedule_user_job(user_id, check_queue, trigger="date", run_date=datetime.now() + timedelta(seconds=seconds))
+
+def _duration_seconds(duration_ms):
+    return (duration_ms or DEFAULT_DURATION_MS) / 1000
+
+def _next_check_seconds(session, current, ahead, skipping=False):
+    """Seconds until only QUEUE_LOW_WATER of the queued tracks are left.
+
+    The queue endpoint has no playback position, so the current track is
+    taken to have started when a check first saw it, which is at most one
+    check late since checks land on track changes. While the user is
+    skipping the check comes after the current track instead.
+    """
+    now = datetime.utcnow()
+    current_id = current.get("id") if current else None
+    if current_id != session.playing_track_id or session.playing_since is None:
+        session.playing_track_id = current_id
+        session.playing_since = now
+    elapsed = (now - session.playing_since).total_seconds()
+    remaining = max(0.0, _duration_seconds(current.get("duration_ms") if current else None) - elapsed)
+
+    keep = len(ahead) - 1 if skipping else QUEUE_LOW_WATER
+    wait = remaining + sum(ahead[:max(0, len(ahead) - keep)])
+    return min(MAX_CHECK_SECONDS, max(MIN_CHECK_SECONDS, wait))
+
+def check_queue(user_id):
+    lease = queue_lease_name(user_id)
+    if not acquire_lease(lease, QUEUE_LEASE):
+        # another worker owns this user's queue now
+        remove_user_job(user_id)
+        return
 
-def check_queue(sp, track_uris, device_id, user_id):
     print("checking queue :)")
     db = SessionLocal()
-    user = db.query(User).filter_by(id=user_id).first()
-    if not user:
+    try:
+        session = db.get(QueueSession, user_id)
+        if not session or not session.active or queue_exhausted(session):
+            if session:
+                session.active = False
+                db.commit()
+            remove_user_job(user_id)
+            release_lease(lease)
+            return
+        loaded_at = session.updated_at
+
+        sp = get_client(session.access_token)
+        try:
+            current_queue = sp.queue()
+            ahead = [_duration_seconds(t.get("duration_ms")) for t in current_queue.get("queue", []) if t]
+            # checks are timed to find QUEUE_LOW_WATER left, fewer means tracks got skipped
+            skipping = len(ahead) < QUEUE_LOW_WATER
+
+            user = db.get(User, user_id)
+            plan = get_bundle_plan(db, user.id, user.bundles_version) if user else None
+            added = next_tracks(db, session, QUEUE_WINDOW - len(ahead), plan)
+            for track_id in added:
+                sp.add_to_queue(uri=f"spotify:track:{track_id}", device_id=session.device_id)
+            if added:
+                durations = dict(db.execute(select(Track.id, Track.duration_ms).where(Track.id.in_(added))).all())
+                ahead.extend(_duration_seconds(durations.get(track_id)) for track_id in added)
+            wait = _next_check_seconds(session, current_queue.get("currently_playing"), ahead, skipping)
+        except Exception as e:
+            if isinstance(e, SpotifyException) and e.http_status == 401:
+                # token expired, the next shuffle starts a fresh session
+                print(f"queue token expired for {user_id}, stopping")
+                session.active = False
+            else:
+                # nothing is saved, the retry picks up the same tracks
+                print(f"queue check failed for {user_id}: {e}")
+                db.rollback()
+                wait = QUEUE_RETRY_SECONDS
+
+        with db.no_autoflush:
+            restarted = db.execute(
+                select(QueueSession.updated_at).where(QueueSession.user_id == user_id)
+            ).scalar() != loaded_at
+        if restarted:
+            # a new shuffle replaced the session while this ran, and its own first
+            # fill was skipped since this job was still running, so fill it now
+            db.rollback()
+            wait = 0
+        else:
+            session.updated_at = datetime.utcnow()
+            db.commit()
+            if not session.active:
+                remove_user_job(user_id)
+                release_lease(lease)
+                return
+    finally:
         db.close()
-        return
 
-    curr_index = user.curr_index
-    current_queue = sp.queue()
-    queue_length = len(current_queue.get("queue", [])) + 1
+    # hold the lease until a while after the next check is due
+    acquire_lease(lease, timedelta(seconds=wait) + QUEUE_LEASE)
+    schedule_queue_check(user_id, wait)
 
-    while queue_length < 50 and curr_index < len(track_uris):
-        sp.add_to_queue(uri=f"spotify:track:{track_uris[curr_index]}", device_id=device_id)
-        curr_index += 1
-        queue_length += 1
+def resume_queue_sessions():
+    """Adopt active sessions whose worker stopped renewing the lease."""
+    db = SessionLocal()
+    try:
+        orphaned = (
+            db.query(QueueSession.user_id)
+            .outerjoin(Lease, Lease.name == "queue:" + QueueSession.user_id)
+            .filter(QueueSession.active == True)
+            .filter((Lease.name == None) | (Lease.expires_at < datetime.utcnow()))
+            .all()
+        )
+    finally:
+        db.close()
 
-    user.curr_index = curr_index
-    db.commit()
-    db.close()
+    for (user_id,) in orphaned:
+        if not has_user_job(user_id):
+            print(f"resuming queue for {user_id}")
+            schedule_queue_check(user_id)
+
+add_startup_job(resume_queue_sessions, id="resume_queue_sessions", trigger="interval", seconds=QUEUE_CHECK_SECONDS)
     
 # bundles helpers
-import requests
 def play_immediately(token, track_id):
-    headers = {'Authorization': f'Bearer {token}'}
     data = {"uris": [f"spotify:track:{track_id}"]}
-    requests.put('https://api.spotify.com/v1/me/player/play', json=data, headers=headers)
+    api_request("PUT", "me/player/play", token, json=data)
 
 def skip_current(token):
-    headers = {'Authorization': f'Bearer {token}'}
-    requests.post('https://api.spotify.com/v1/me/player/next', headers=headers)
+    api_request("POST", "me/player/next", token)
 
 def queue_bundle(token, track_id):
-    headers = {'Authorization': f'Bearer {token}'}
-    requests.post(
-        'https://api.spotify.com/v1/me/player/queue',
-        params={'uri': f'spotify:track:{track_id}'},
-        headers=headers
+    api_request(
+        "POST",
+        "me/player/queue",
+        token,
+        params={'uri': f'spotify:track:{track_id}'}
     )
     
 def apply_bundles(track_ids: list[str], bundles: list[Bundle]) -> list[str]:
-    new_queue = []
-    seen_bundles = set()
-
-    for track_id in track_ids:
-        # find next bundle that matches current track
-        bundle = next((
-            b for b in bundles
-            if b.id not in seen_bundles and (
-                (b.strict and (b.intro_song_id == track_id or b.main_song_id == track_id)) or
-                (not b.strict and b.intro_song_id == track_id)
-            )
-        ), None)
-
-        if bundle:
-            seen_bundles.add(bundle.id)
-
-            if bundle.strict:
-                # always intro then main regardless of current track
-                new_queue.append(bundle.intro_song_id)
-                new_queue.append(bundle.main_song_id)
-            else:
-                # not strict, if current is intro, add intro + main
-                # if current is main, just add main
-                if track_id == bundle.intro_song_id:
-                    new_queue.append(bundle.intro_song_id)
-                    new_queue.append(bundle.main_song_id)
-                else:
-                    new_queue.append(track_id)
-        else:
-            new_queue.append(track_id)
-
-    return new_queue
+    return BundlePlan.from_bundles(bundles).apply(track_ids)
 
 def get_curr(token):
-    headers = {
-        'Authorization': f'Bearer {token}'
-    }
-    response = requests.get('https://api.spotify.com/v1/me/player/currently-playing', headers=headers)
+    response = api_request("GET", "me/player/currently-playing", token)
 
     if response.status_code != 200:
         return None  
@@ -559,33 +848,61 @@ def get_curr(token):
         'uri': item['uri']
     }
     
+# only what ingest_tracks reads, trims most of each playlist page
+PLAYLIST_ITEM_FIELDS = "next,total,items(track(id,type,name,preview_url,duration_ms,album(id,name,release_date,images(url)),artists(id,name)))"
+
+def rebatch(pages, size=CHUNK_SIZE):
+    """Regroup small api pages into batches of about size for ingest."""
+    batch = []
+    for page in pages:
+        batch.extend(page)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def get_playlists(sp):
     playlists = []
-    results = sp.current_user_playlists()
+    results = call(sp.current_user_playlists)
     playlists.extend(results['items'])
     while results['next']:
-        results = sp.next(results)
+        results = call(sp.next, results)
         playlists.extend(results['items'])
     return playlists  
-    
+
+def iter_playlist_tracks(sp, playlist_id):
+    """Pages of a playlist's tracks, fetched one after another."""
+    results = call(sp.playlist_tracks, playlist_id, fields=PLAYLIST_ITEM_FIELDS)
+    while True:
+        yield [item.get('track') or item.get('episode') for item in results['items'] if (item.get('track') or item.get('episode'))]
+        if not results['next']:
+            break
+        results = call(sp.next, results)
+
 def get_songs(sp, playlist_id):
-    items = []
-    results = sp.playlist_tracks(playlist_id)
-    items.extend(results['items'])
-    while results['next']:
-        results = sp.next(results)
-        items.extend(results['items'])
-    
-    return [item.get('track') or item.get('episode') for item in items if (item.get('track') or item.get('episode'))]
+    return [track for page in iter_playlist_tracks(sp, playlist_id) for track in page]
+
+def iter_saved_items(sp):
+    """Pages of liked song items (track plus added_at), newest first, with the ones whose track is gone.
+
+    The saved tracks endpoint takes offsets, so a window of pages is
+    fetched in parallel and handed on before the next window starts.
+    """
+    results = call(sp.current_user_saved_tracks, limit=50)
+    yield results['items']
+    offsets = list(range(50, results['total'], 50))
+    for start in range(0, len(offsets), FETCH_WORKERS):
+        window = offsets[start:start + FETCH_WORKERS]
+        for page in fetch_all(lambda offset: call(sp.current_user_saved_tracks, limit=50, offset=offset), window):
+            yield page['items']
+
+def get_saved_items(sp):
+    """Liked song items (track plus added_at), newest first."""
+    return [item for page in iter_saved_items(sp) for item in page if item['track']]
 
 def get_saved_songs(sp):
-    track_items = []
-    results = sp.current_user_saved_tracks()
-    track_items.extend(results['items'])
-    while results['next']:
-        results = sp.next(results)
-        track_items.extend(results['items'])
-    return [t['track'] for t in track_items if t['track']]
+    return [t['track'] for t in get_saved_items(sp)]
 
 def get_bundles(user_id: str, db_session):
     user = db_session.query(User).filter_by(id=user_id).first()
@@ -611,21 +928,72 @@ def serialize_track(track):
         }
 
 # search helpers
+def albums_in_years(start_year: int, end_year: int):
+    # range scan on ix_albums_release_year_id, never touches the album rows
+    return select(Album.id).where(Album.release_year.between(start_year, end_year))
+
 def get_tracks_by_release_year(db, start_year: int, end_year: int):
     return (
         db.query(Track)
-        .join(Track.album)
-        .filter(Album.release_date >= f"{start_year}-01-01")
-        .filter(Album.release_date <= f"{end_year}-12-31")
+        .filter(Track.album_id.in_(albums_in_years(start_year, end_year)))
         .all()
     )
-    
-def get_tracks_by_name(db, name: str):
+
+def get_year_histogram(db, user_id: str):
+    """(release_year, track count) over the user's liked songs and playlists."""
+    library = (
+        select(saved_track_table.c.track_id).where(saved_track_table.c.user_id == user_id)
+        .union(
+            select(playlist_track_table.c.track_id)
+            .join(user_playlist_table, user_playlist_table.c.playlist_id == playlist_track_table.c.playlist_id)
+            .where(user_playlist_table.c.user_id == user_id)
+        )
+    )
     return (
-        db.query(Track)
-        .filter(Track.name.ilike(f"%{name}%"))
+        db.query(Album.release_year, func.count(Track.id))
+        .join(Track, Track.album_id == Album.id)
+        .filter(Track.id.in_(library))
+        .filter(Album.release_year != None)
+        .group_by(Album.release_year)
+        .order_by(Album.release_year)
         .all()
     )
+    
+def fts_query(text_query: str, column: str = None) -> str:
+    """Turn user input into an fts5 prefix query, every word must match."""
+    words = re.findall(r"\w+", text_query.lower())
+    if not words:
+        return ""
+    terms = " ".join(f'"{w}"*' for w in words)
+    return f"{column} : ({terms})" if column else terms
+
+def search_track_ids(db, name: str = "", artist: str = "", limit: int = None) -> list[str]:
+    """Track ids matching the name / artist prefixes, best match first."""
+    clauses = [q for q in (fts_query(name, "name") if name else "", fts_query(artist, "artists") if artist else "") if q]
+    if not clauses:
+        return []
+    sql = "SELECT track_id FROM track_search WHERE track_search MATCH :q ORDER BY rank"
+    params = {"q": " AND ".join(clauses)}
+    if limit:
+        sql += " LIMIT :limit"
+        params["limit"] = limit
+    return [row[0] for row in db.execute(text(sql), params)]
+
+def search_artist_ids(db, name: str, limit: int = 10) -> list[str]:
+    q = fts_query(name, "name")
+    if not q:
+        return []
+    return [row[0] for row in db.execute(
+        text("SELECT artist_id FROM artist_search WHERE artist_search MATCH :q ORDER BY rank LIMIT :limit"),
+        {"q": q, "limit": limit}
+    )]
+
+def get_tracks_by_name(db, name: str):
+    track_ids = search_track_ids(db, name=name)
+    tracks = []
+    for chunk in chunks(track_ids):
+        tracks.extend(db.query(Track).filter(Track.id.in_(chunk)).all())
+    return tracks
 
 def get_tracks_by_artists(db, artist_names: list[str]):
     return (
@@ -644,8 +1012,55 @@ def get_tracks_by_genres(session, genre_list: list[str]):
         .all()
     )
 
-def reset_scheduler(queue_scheduler):
-    if queue_scheduler.running:
-        queue_scheduler.remove_all_jobs()
-    else:
-        queue_scheduler.start()
+def search_tracks(db, user_id=None, song_name="", artists=(), genres=(), start_year=None, end_year=None,
+                  liked_only=False, limit=500, offset=0):
+    """All search filters compiled into one statement over the user's library.
+
+    Each filter is an EXISTS / IN subquery so the database intersects them and
+    only one page of tracks (plus their artists and albums) is ever loaded.
+    Returns (the page of tracks, how many tracks match in all).
+    """
+    filters = []
+    if song_name:
+        fts = fts_query(song_name, "name")
+        if not fts:
+            return [], 0
+        filters.append(Track.id.in_(
+            text("SELECT track_id FROM track_search WHERE track_search MATCH :fts")
+            .bindparams(fts=fts)
+            .columns(column("track_id", String))
+        ))
+    if artists:
+        filters.append(Track.artists.any(Artist.name.in_(artists)))
+    if genres:
+        filters.append(Track.artists.any(Artist.genres.any(Genre.name.in_(genres))))
+    if start_year and end_year:
+        filters.append(Track.album_id.in_(albums_in_years(start_year, end_year)))
+
+    liked = exists().where(
+        (saved_track_table.c.user_id == user_id) & (saved_track_table.c.track_id == Track.id)
+    )
+    if liked_only and user_id:
+        filters.append(liked)
+    if not filters:
+        return [], 0
+
+    if user_id:
+        in_playlist = exists().where(
+            (playlist_track_table.c.track_id == Track.id) &
+            (playlist_track_table.c.playlist_id == user_playlist_table.c.playlist_id) &
+            (user_playlist_table.c.user_id == user_id)
+        )
+        filters.append(or_(liked, in_playlist))
+
+    total = db.execute(select(func.count()).select_from(Track).where(*filters)).scalar()
+    tracks = (
+        db.query(Track)
+        .filter(*filters)
+        .options(selectinload(Track.artists), joinedload(Track.album))
+        .order_by(Track.name, Track.id)
+        .limit(limit)
+        .offset(offset)
+        .all()
+    )
+    return tracks, total
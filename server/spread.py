@@ -0,0 +1,140 @@
+try:
+    import numpy as np
+except ImportError:  # same algorithm in plain python, a few times slower
+    np = None
+
+from permutation import MASK64, _mix
+
+# tracks in a row that shouldn't share an artist (or album)
+DEFAULT_WINDOW = 3
+MAX_WINDOW = 20
+# how far ahead the fix-up pass looks for a track to swap in
+LOOKAHEAD = 64
+# keeps a key's tracks in their shuffled order, see _merge
+JITTER = 0.1
+GOLDEN = 0x9E3779B97F4A7C15
+# the random draws, each is its own counter-based stream
+ORDER, OFFSET, NUDGE = range(3)
+
+
+def _bits_python(seed, stream, n):
+    # splitmix64 over a counter, so numpy can compute the exact same draws.
+    # _mix is a bijection, so the draws of one stream never tie
+    base = _mix((seed ^ (stream * GOLDEN)) & MASK64)
+    return [_mix((base + i * GOLDEN) & MASK64) for i in range(n)]
+
+
+def _uniforms_python(seed, stream, n):
+    return [(x >> 11) * 2.0 ** -53 for x in _bits_python(seed, stream, n)]
+
+
+def _bits_numpy(seed, stream, n):
+    base = np.uint64(_mix((seed ^ (stream * GOLDEN)) & MASK64))
+    # uint64 arrays wrap on overflow, like the & MASK64 above
+    x = base + np.arange(n, dtype=np.uint64) * np.uint64(GOLDEN)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _uniforms_numpy(seed, stream, n):
+    return (_bits_numpy(seed, stream, n) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def _merge_numpy(keys, seed):
+    keys = np.asarray(keys, dtype=np.int64)
+    n = len(keys)
+    counts = np.bincount(keys)
+
+    # each track's rank among its key's tracks, in random order. A stable
+    # sort by key of the tracks sorted by a random draw keeps that order
+    # within each key, and is a radix sort when the keys fit 16 bits
+    by_draw = np.argsort(_bits_numpy(seed, ORDER, n))
+    sort_keys = keys.astype(np.uint16) if len(counts) <= 1 << 16 else keys
+    by_key = by_draw[np.argsort(sort_keys[by_draw], kind="stable")]
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(n, dtype=np.int64)
+    rank[by_key] = np.arange(n) - np.repeat(starts, counts)
+
+    # rank r lands in [r + offset - JITTER, r + offset + JITTER), so ranks never swap
+    offset = _uniforms_numpy(seed, OFFSET, len(counts))
+    nudge = _uniforms_numpy(seed, NUDGE, n) * (2 * JITTER) - JITTER
+    pos = (rank + offset[keys] + nudge) / counts[keys]
+    order = np.argsort(pos)
+    # positions almost never tie, when they do, break ties by index like sorted() does
+    if n > 1 and (pos[order[1:]] == pos[order[:-1]]).any():
+        order = np.argsort(pos, kind="stable")
+    return order.tolist()
+
+
+def _merge_python(keys, seed):
+    n = len(keys)
+    draw = _bits_python(seed, ORDER, n)
+    groups = {}
+    for i in sorted(range(n), key=draw.__getitem__):
+        groups.setdefault(keys[i], []).append(i)
+
+    offset = _uniforms_python(seed, OFFSET, max(keys) + 1)
+    nudge = _uniforms_python(seed, NUDGE, n)
+    pos = [0.0] * n
+    for key, members in groups.items():
+        for rank, i in enumerate(members):
+            pos[i] = (rank + offset[key] + (nudge[i] * (2 * JITTER) - JITTER)) / len(members)
+    return sorted(range(n), key=pos.__getitem__)
+
+
+def _first_repeat(order, keys, window):
+    """Index of the first track whose key showed up fewer than window tracks earlier, or None."""
+    if np is not None:
+        seq = np.asarray(keys)[order]
+        close = np.zeros(len(seq), dtype=bool)
+        for gap in range(1, window):
+            close[gap:] |= seq[gap:] == seq[:-gap]
+        hits = np.flatnonzero(close)
+        return int(hits[0]) if len(hits) else None
+    last = {}
+    for i, index in enumerate(order):
+        key = keys[index]
+        if i - last.get(key, -window) < window:
+            return i
+        last[key] = i
+    return None
+
+
+def _fix_window(order, keys, window):
+    """Swap a later track in wherever a key repeats within window, as far as the mix of keys allows."""
+    start = _first_repeat(order, keys, window)
+    if start is None:
+        return order
+    # nothing before start needs fixing, pick up the window state there
+    last = {keys[order[i]]: i for i in range(max(0, start - window), start)}
+    n = len(order)
+    for i in range(start, n):
+        key = keys[order[i]]
+        if i - last.get(key, -window) < window:
+            for j in range(i + 1, min(n, i + LOOKAHEAD)):
+                candidate = keys[order[j]]
+                if i - last.get(candidate, -window) >= window:
+                    order[i], order[j] = order[j], order[i]
+                    key = candidate
+                    break
+        last[key] = i
+    return order
+
+
+def spread_order(keys, seed, window=DEFAULT_WINDOW):
+    """Shuffled order of range(len(keys)) that keeps equal keys apart.
+
+    keys are small ints, e.g. each track's artist numbered from 0. Every
+    key's tracks are shuffled among themselves and laid out evenly over
+    [0, 1) from a random offset, then all keys are merged by position.
+    A key with k of n tracks comes up about every n / k tracks, and a
+    greedy pass fixes what's still closer than window. With or without
+    numpy, the same seed gives the same order.
+    """
+    if not keys:
+        return []
+    order = _merge_numpy(keys, seed) if np is not None else _merge_python(keys, seed)
+    if window > 1:
+        order = _fix_window(order, keys, window)
+    return order
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# the server modules import each other by bare name, like gunicorn runs them from server/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# a throwaway database, set before anything imports database.py
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
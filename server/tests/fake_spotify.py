@@ -0,0 +1,69 @@
+import threading
+from collections import Counter
+
+
+def track(i, artist=None):
+    artist = artist or f"ar{i % 5}"
+    return {
+        "id": f"t{i}",
+        "name": f"song {i}",
+        "type": "track",
+        "duration_ms": 200000,
+        "album": {"id": f"al{i % 7}", "name": f"album {i % 7}", "images": [], "release_date": "2001-01-01"},
+        "artists": [{"id": artist, "name": f"artist {artist}"}],
+    }
+
+
+def liked(i, added_at=None):
+    """A liked songs item, higher i is liked later."""
+    return {"added_at": added_at or f"2024-01-01T{i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d}Z", "track": track(i)}
+
+
+class FakeSpotify:
+    """Just the spotipy calls the sync makes, over lists the test edits in between syncs.
+
+    saved is newest first like spotify lists it, playlists are dicts with
+    id, name, snapshot_id and the tracks in items. calls counts the api
+    calls made by method name.
+    """
+
+    def __init__(self, saved=(), playlists=(), genres=None):
+        self.saved = list(saved)
+        self.playlists = list(playlists)
+        self.genres = genres or {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def _page(self, kind, key, items, limit, offset):
+        next_page = {"kind": kind, "key": key, "limit": limit, "offset": offset + limit} if offset + limit < len(items) else None
+        return {"items": items[offset:offset + limit], "total": len(items), "next": next_page}
+
+    def next(self, results):
+        page = results["next"]
+        if page["kind"] == "saved":
+            return self.current_user_saved_tracks(limit=page["limit"], offset=page["offset"])
+        if page["kind"] == "playlists":
+            return self.current_user_playlists(limit=page["limit"], offset=page["offset"])
+        return self.playlist_tracks(page["key"], limit=page["limit"], offset=page["offset"])
+
+    def current_user_saved_tracks(self, limit=20, offset=0, market=None):
+        self._count("saved")
+        return self._page("saved", None, self.saved, limit, offset)
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self._count("playlists")
+        meta = [{k: v for k, v in p.items() if k != "items"} for p in self.playlists]
+        return self._page("playlists", None, meta, limit, offset)
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, market=None, additional_types=("track",)):
+        self._count("playlist_tracks")
+        playlist = next(p for p in self.playlists if p["id"] == playlist_id)
+        return self._page("playlist", playlist_id, [{"track": t} for t in playlist["items"]], limit, offset)
+
+    def artists(self, ids):
+        self._count("artists")
+        return {"artists": [{"id": i, "name": f"artist {i}", "genres": self.genres.get(i, ["pop"])} for i in ids]}
@@ -0,0 +1,91 @@
+from datetime import datetime
+
+import pytest
+
+import auto_sync
+from database import init_db, SessionLocal, User
+
+
+@pytest.fixture
+def tick(monkeypatch):
+    """sync_active_users with one sync slot and spotify faked out, returns the calls it made."""
+    init_db()
+    calls = {"checked": [], "started": []}
+
+    def check(entry):
+        calls["checked"].append(entry[0])
+        return 2, f"token-{entry[0]}", None
+
+    def submit_sync(sp, user_id, kind):
+        calls["started"].append(user_id)
+        return 1, True
+
+    monkeypatch.setattr(auto_sync, "MAX_RUNNING", 1)
+    monkeypatch.setattr(auto_sync, "acquire_lease", lambda *args: True)
+    monkeypatch.setattr(auto_sync, "_running_syncs", lambda db: 0)
+    monkeypatch.setattr(auto_sync, "_check", check)
+    monkeypatch.setattr(auto_sync, "submit_sync", submit_sync)
+    monkeypatch.setattr(auto_sync, "get_client", lambda token: None)
+    monkeypatch.setattr(auto_sync, "refresh_user_token", lambda refresh_token: {
+        "access_token": f"fresh-{refresh_token}", "expires_at": 2 ** 40,
+    })
+
+    def run():
+        calls["checked"].clear()
+        calls["started"].clear()
+        auto_sync.sync_active_users()
+        return calls
+    return run
+
+
+def add_users(*user_ids):
+    db = SessionLocal()
+    try:
+        for user_id in user_ids:
+            db.add(User(id=user_id, refresh_token=f"refresh-{user_id}", last_active_at=datetime.utcnow()))
+        db.commit()
+    finally:
+        db.close()
+
+
+def get_user(user_id):
+    db = SessionLocal()
+    try:
+        return db.get(User, user_id)
+    finally:
+        db.close()
+
+
+def test_changes_without_a_slot_survive_a_restart(tick):
+    add_users("auto-a", "auto-b")
+    calls = tick()
+    assert sorted(calls["checked"]) == ["auto-a", "auto-b"]
+    assert len(calls["started"]) == 1
+    waiting = "auto-b" if calls["started"] == ["auto-a"] else "auto-a"
+    assert get_user(waiting).sync_pending == 2
+
+    # a restart, or the lease moving to another worker, loses this process's memory
+    auto_sync._tokens.clear()
+    calls = tick()
+    # started from what the database kept, without checking the library again
+    assert calls["started"] == [waiting]
+    assert calls["checked"] == []
+    user = get_user(waiting)
+    assert user.sync_pending == 0
+    assert user.next_sync_at > datetime.utcnow()
+
+    # nothing left over for the next tick
+    assert tick()["started"] == []
+
+
+def test_pending_changes_stay_until_the_sync_is_submitted(tick, monkeypatch):
+    add_users("auto-c", "auto-d")
+    calls = tick()
+    waiting = ({"auto-c", "auto-d"} - set(calls["started"])).pop()
+
+    def submit_sync(sp, user_id, kind):
+        raise RuntimeError("worker went away")
+    monkeypatch.setattr(auto_sync, "submit_sync", submit_sync)
+    with pytest.raises(RuntimeError):
+        tick()
+    assert get_user(waiting).sync_pending == 2
@@ -0,0 +1,79 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from bundles import BundlePlan
+
+
+def linear_apply(track_ids, bundles):
+    """The scan BundlePlan replaced, kept here as the reference."""
+    new_queue = []
+    seen_bundles = set()
+    for track_id in track_ids:
+        bundle = next((
+            b for b in bundles
+            if b.id not in seen_bundles and (
+                (b.strict and (b.intro_song_id == track_id or b.main_song_id == track_id)) or
+                (not b.strict and b.intro_song_id == track_id)
+            )
+        ), None)
+        if bundle:
+            seen_bundles.add(bundle.id)
+            if bundle.strict or track_id == bundle.intro_song_id:
+                new_queue.append(bundle.intro_song_id)
+                new_queue.append(bundle.main_song_id)
+            else:
+                new_queue.append(track_id)
+        else:
+            new_queue.append(track_id)
+    return new_queue
+
+
+def bundle(bundle_id, intro, main, strict):
+    return SimpleNamespace(id=bundle_id, intro_song_id=intro, main_song_id=main, strict=strict)
+
+
+def check(tracks, bundles):
+    assert BundlePlan.from_bundles(bundles).apply(tracks) == linear_apply(tracks, bundles)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_linear_scan_on_random_bundles(seed):
+    rnd = random.Random(seed)
+    # a small pool so intros and mains collide a lot
+    pool = [f"t{i}" for i in range(rnd.randint(1, 25))]
+    bundles = [bundle(i, rnd.choice(pool), rnd.choice(pool), rnd.random() < 0.5) for i in range(rnd.randint(0, 15))]
+    tracks = [rnd.choice(pool) for _ in range(rnd.randint(0, 60))]
+    check(tracks, bundles)
+
+
+def test_overlapping_triggers():
+    # several bundles share an intro or a main, the earliest unused one wins each time
+    bundles = [
+        bundle(1, "a", "b", False),
+        bundle(2, "a", "c", True),
+        bundle(3, "d", "b", True),
+        bundle(4, "b", "a", False),
+        bundle(5, "c", "a", True),
+    ]
+    check(["a", "a", "a", "b", "b", "c", "d", "c", "a"], bundles)
+    check(["b", "c", "a", "d", "b", "a"], bundles)
+
+
+def test_nested_triggers():
+    # one bundle's main is the next one's intro, and a bundle that loops back on itself
+    bundles = [
+        bundle(1, "a", "b", True),
+        bundle(2, "b", "c", True),
+        bundle(3, "c", "a", False),
+        bundle(4, "e", "e", True),
+    ]
+    check(["a", "b", "c", "a", "b", "c", "e", "e"], bundles)
+    check(["c", "b", "a", "e"], bundles)
+
+
+def test_empty_plan_is_falsy_and_changes_nothing():
+    plan = BundlePlan([])
+    assert not plan
+    assert plan.apply(["a", "b"]) == ["a", "b"]
@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from flask import Flask
+
+import routes
+import permutation
+from permutation import FeistelPermutation, SEED_LIMIT, new_seed
+
+SIZES = [1, 2, 3, 5, 7, 100, 255, 256, 257, 1000, 1023, 1024, 1025, 4097]
+SEEDS = [0, 1, 42, 2 ** 32 + 7, SEED_LIMIT - 1]
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("seed", SEEDS)
+def test_covers_every_position_once(n, seed):
+    assert sorted(FeistelPermutation(n, seed)) == list(range(n))
+
+
+def test_seeds_give_different_orders():
+    orders = {tuple(FeistelPermutation(1000, seed)) for seed in SEEDS}
+    assert len(orders) == len(SEEDS)
+
+
+def test_new_seeds_are_in_range():
+    for _ in range(1000):
+        assert 0 <= new_seed() < SEED_LIMIT
+
+
+@pytest.mark.parametrize("seed", [-1, SEED_LIMIT, SEED_LIMIT + 5, 2 ** 64])
+def test_out_of_range_seeds_are_rejected(seed):
+    with pytest.raises(ValueError):
+        FeistelPermutation(10, seed)
+
+
+def test_resumes_the_same_order_in_a_new_process():
+    n, seed, position = 5000, 123456789012345, 1234
+    rest = [FeistelPermutation(n, seed)[i] for i in range(position, n)]
+    # a restarted worker only has the seed and the cursor from the database
+    script = (
+        "from permutation import FeistelPermutation\n"
+        f"perm = FeistelPermutation({n}, {seed})\n"
+        f"print(','.join(str(perm[i]) for i in range({position}, {n})))\n"
+    )
+    out = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(permutation.__file__),
+                         capture_output=True, text=True, check=True).stdout
+    assert [int(x) for x in out.strip().split(",")] == rest
+
+
+@pytest.fixture
+def shuffle(monkeypatch):
+    """POST /api/shuffle with spotify and the queue faked out, returns the response and the seed used."""
+    import spotify_helpers
+    from database import init_db, SessionLocal, User
+
+    init_db()
+    db = SessionLocal()
+    if db.get(User, "seed-user") is None:
+        db.add(User(id="seed-user"))
+        db.commit()
+    db.close()
+    started = []
+    monkeypatch.setattr(routes, "get_access_token", lambda code=None, token=None: "token")
+    monkeypatch.setattr(routes, "get_spotify_client", lambda token=None: None)
+    monkeypatch.setattr(routes, "get_user_id", lambda token: "seed-user")
+    monkeypatch.setattr(routes, "mark_active", lambda user_id: None)
+    monkeypatch.setattr(spotify_helpers, "remembered_device", lambda db, user_id: "device")
+
+    def start(sp, source, device_id, user_id, token, seed=None, **kwargs):
+        started.append(seed)
+        return seed if seed is not None else new_seed(), 10
+    monkeypatch.setattr(spotify_helpers, "start_playback_with_queue", start)
+    app = Flask(__name__)
+    app.register_blueprint(routes.routes)
+    client = app.test_client()
+
+    def post(seed):
+        started.clear()
+        response = client.post("/api/shuffle", json={"token": "token", "shuffle_choice": "1", "seed": seed})
+        return response, started[0] if started else None
+    return post
+
+
+@pytest.mark.parametrize("seed", [-1, str(SEED_LIMIT), str(2 ** 64), "abc"])
+def test_shuffle_rejects_bad_seeds(shuffle, seed):
+    response, used = shuffle(seed)
+    assert response.status_code == 400
+    assert used is None
+
+
+def test_shuffle_replays_a_seed(shuffle):
+    response, used = shuffle(str(SEED_LIMIT - 1))
+    assert response.status_code == 200
+    assert used == SEED_LIMIT - 1
+    assert response.get_json()["seed"] == str(SEED_LIMIT - 1)
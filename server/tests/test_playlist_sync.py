@@ -0,0 +1,110 @@
+import itertools
+
+import pytest
+from sqlalchemy import select
+
+from database import init_db, SessionLocal, Playlist, playlist_track_table, user_playlist_table
+from spotify_helpers import cache_all_music_data, cache_incremental
+from fake_spotify import FakeSpotify, track
+
+prefixes = (f"playlist-sync-{i}" for i in itertools.count())
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    init_db()
+
+
+def playlist(playlist_id, track_numbers, snapshot_id="s1"):
+    return {"id": playlist_id, "name": playlist_id, "snapshot_id": snapshot_id, "images": [],
+            "items": [track(i) for i in track_numbers]}
+
+
+def library(*playlists):
+    """A fake client and a user synced once, playlist ids are made unique to the test."""
+    prefix = next(prefixes)
+    for p in playlists:
+        p["id"] = f"{prefix}-{p['id']}"
+    sp = FakeSpotify(playlists=playlists)
+    cache_all_music_data(sp, f"{prefix}-user")
+    return f"{prefix}-user", sp
+
+
+def playlist_tracks(playlist_id):
+    db = SessionLocal()
+    try:
+        tracks = set(db.execute(
+            select(playlist_track_table.c.track_id).where(playlist_track_table.c.playlist_id == playlist_id)
+        ).scalars())
+        row = db.get(Playlist, playlist_id)
+        return tracks, row and row.num_tracks
+    finally:
+        db.close()
+
+
+def followers(playlist_id):
+    db = SessionLocal()
+    try:
+        return set(db.execute(
+            select(user_playlist_table.c.user_id).where(user_playlist_table.c.playlist_id == playlist_id)
+        ).scalars())
+    finally:
+        db.close()
+
+
+def test_snapshot_change_applies_the_diff():
+    user_id, sp = library(playlist("a", range(10)), playlist("b", range(100, 105)))
+    a = sp.playlists[0]
+    a["items"] = [track(i) for i in list(range(3, 10)) + [50, 51]]
+    a["snapshot_id"] = "s2"
+    sp.calls.clear()
+    cache_incremental(sp, user_id)
+
+    tracks, num_tracks = playlist_tracks(a["id"])
+    assert tracks == {f"t{i}" for i in list(range(3, 10)) + [50, 51]}
+    assert num_tracks == len(tracks)
+    # only the changed playlist is read again
+    assert sp.calls["playlist_tracks"] == 1
+    db = SessionLocal()
+    assert db.get(Playlist, a["id"]).snapshot_id == "s2"
+    db.close()
+
+
+def test_unchanged_snapshot_reads_no_tracks():
+    user_id, sp = library(playlist("a", range(10)), playlist("b", range(20, 30)))
+    sp.calls.clear()
+    cache_incremental(sp, user_id)
+    assert sp.calls["playlist_tracks"] == 0
+    assert sp.calls["artists"] == 0
+    assert playlist_tracks(sp.playlists[0]["id"]) == ({f"t{i}" for i in range(10)}, 10)
+
+
+def test_duplicates_and_episodes_are_left_out():
+    user_id, sp = library(playlist("a", range(5)))
+    a = sp.playlists[0]
+    a["items"] = [track(1), track(1), track(2), dict(track(3), type="episode"), {"id": None, "type": "track"}]
+    a["snapshot_id"] = "s2"
+    cache_incremental(sp, user_id)
+    assert playlist_tracks(a["id"]) == ({"t1", "t2"}, 2)
+
+
+def test_unfollow_keeps_the_playlist_for_other_followers():
+    first, sp = library(playlist("shared", range(8)), playlist("own", range(40, 44)))
+    shared, own = sp.playlists
+    second = f"{first}-2"
+    other = FakeSpotify(playlists=[shared])
+    cache_all_music_data(other, second)
+    assert followers(shared["id"]) == {first, second}
+
+    # the first user unfollows both, only the playlist nobody else follows goes
+    sp.playlists = []
+    cache_incremental(sp, first)
+    assert followers(shared["id"]) == {second}
+    assert playlist_tracks(shared["id"]) == ({f"t{i}" for i in range(8)}, 8)
+    assert playlist_tracks(own["id"]) == (set(), None)
+
+    # and the one still following sees its changes
+    shared["items"].append(track(60))
+    shared["snapshot_id"] = "s2"
+    cache_incremental(other, second)
+    assert playlist_tracks(shared["id"]) == ({f"t{i}" for i in list(range(8)) + [60]}, 9)
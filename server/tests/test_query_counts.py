@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+
+import pytest
+from flask import Flask
+from sqlalchemy import event
+
+from database import engine, init_db, SessionLocal, User, Playlist
+from ingest import ingest_tracks, link_playlists
+from routes import routes
+
+# statements per request, whatever the size of the library
+MAX_QUERIES = {
+    "/api/get_playlists": 2,
+    "/api/get_saved_songs": 2,
+    "/api/search_songs": 3,
+    "/api/get_track": 2,
+}
+
+
+def track(i):
+    return {
+        "id": f"t{i}",
+        "name": f"song {i}",
+        "duration_ms": 200000,
+        "album": {"id": f"al{i % 7}", "name": f"album {i % 7}", "images": [], "release_date": "2001-01-01"},
+        "artists": [{"id": f"ar{i % 11}", "name": f"artist {i % 11}"}, {"id": f"ar{i % 3 + 20}", "name": "feat"}],
+    }
+
+
+def make_library(user_id, num_tracks, num_playlists):
+    db = SessionLocal()
+    try:
+        db.add(User(id=user_id))
+        tracks = [track(i) for i in range(num_tracks)]
+        ingest_tracks(db, tracks, user_id=user_id, added_at={t["id"]: "2020-01-01T00:00:00Z" for t in tracks})
+        for p in range(num_playlists):
+            playlist_id = f"{user_id}-pl{p}"
+            db.add(Playlist(id=playlist_id, name=f"playlist {p}"))
+            db.flush()
+            ingest_tracks(db, tracks[p::num_playlists], playlist_id=playlist_id)
+            link_playlists(db, user_id, [playlist_id])
+        db.commit()
+    finally:
+        db.close()
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db()
+    make_library("small", 3, 1)
+    make_library("big", 400, 25)
+    # just the api, app.py would also start the background jobs
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+    return app.test_client()
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def queries_for(client, url, params):
+    # the first call may also note the user as active, count a steady state request
+    assert client.get(url, query_string=params).status_code == 200
+    with count_queries() as statements:
+        assert client.get(url, query_string=params).status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize("url,params", [
+    ("/api/get_playlists", lambda user: {"user_id": user}),
+    ("/api/get_saved_songs", lambda user: {"user_id": user}),
+    ("/api/search_songs", lambda user: {"query": "song", "limit": 200}),
+    ("/api/get_track", lambda user: {"id": "t1"}),
+])
+def test_query_count_does_not_grow_with_the_library(client, url, params):
+    small = queries_for(client, url, params("small"))
+    big = queries_for(client, url, params("big"))
+    assert big == small
+    assert big <= MAX_QUERIES[url]
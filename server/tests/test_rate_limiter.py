@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+import redis
+
+import rate_limiter
+from rate_limiter import RateLimiter, INTERACTIVE, WATCH, BACKGROUND, background
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# fakeredis runs the lua scripts with lupa, `pip install "fakeredis[lua]"`
+needs_redis = pytest.mark.skipif(fakeredis is None, reason="fakeredis isn't installed")
+
+
+@pytest.fixture(params=["local", pytest.param("redis", marks=needs_redis)])
+def make_limiter(request):
+    """Limiters on the local bucket, or limiters sharing one fake redis like the workers do."""
+    server = fakeredis.FakeServer() if request.param == "redis" else None
+
+    def make(**kwargs):
+        client = fakeredis.FakeRedis(server=server) if server else None
+        return RateLimiter(redis_client=client, **kwargs)
+    return make
+
+
+def takes(limiter, lane, attempts=50):
+    """Tokens the lane gets right now without waiting."""
+    bucket = limiter._bucket()
+    return sum(1 for _ in range(attempts) if bucket.take(limiter.floors[lane]) <= 0)
+
+
+def test_lanes_stop_at_their_floors(make_limiter):
+    # next to no refill, so only the burst is there to take
+    limiter = make_limiter(rate=0.001, capacity=10, reserve=0.4)
+    assert takes(limiter, BACKGROUND) == 6
+    assert takes(limiter, WATCH) == 2
+    assert takes(limiter, INTERACTIVE) == 2
+
+
+def test_interactive_goes_ahead_of_background(make_limiter):
+    limiter = make_limiter(rate=40, capacity=4, reserve=0.5)
+    stop = threading.Event()
+    background_calls = []
+
+    def sync():
+        with background():
+            while not stop.is_set():
+                limiter.acquire()
+                background_calls.append(1)
+
+    threads = [threading.Thread(target=sync) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        time.sleep(0.3)
+        waits = []
+        for _ in range(10):
+            start = time.monotonic()
+            limiter.acquire()
+            waits.append(time.monotonic() - start)
+            time.sleep(0.1)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    # background work kept the bucket at its floor, shuffles still got through at once
+    assert len(background_calls) > 30
+    assert max(waits) < 0.05
+
+
+def test_watch_lane_is_capped(make_limiter):
+    limiter = make_limiter(rate=200, capacity=200, watch_share=0.1)
+    start = time.monotonic()
+    for _ in range(40):
+        limiter.acquire(WATCH)
+    # a burst of 20, the other 20 at 20 a second
+    assert time.monotonic() - start > 0.8
+    start = time.monotonic()
+    for _ in range(40):
+        limiter.acquire(INTERACTIVE)
+    assert time.monotonic() - start < 0.2
+
+
+@needs_redis
+def test_pause_holds_back_every_worker():
+    server = fakeredis.FakeServer()
+    worker_a = RateLimiter(rate=100, capacity=10, redis_client=fakeredis.FakeRedis(server=server))
+    worker_b = RateLimiter(rate=100, capacity=10, redis_client=fakeredis.FakeRedis(server=server))
+    worker_a.pause(0.5)
+    # the pausing worker's own fallback bucket is paused too
+    assert worker_a.local.take(0) > 0
+    start = time.monotonic()
+    worker_b.acquire()
+    assert time.monotonic() - start > 0.4
+
+
+def test_pause_without_redis():
+    limiter = RateLimiter(rate=100, capacity=10)
+    limiter.pause(0.3)
+    start = time.monotonic()
+    limiter.acquire(BACKGROUND)
+    assert time.monotonic() - start > 0.25
+
+
+@needs_redis
+def test_falls_back_to_the_local_bucket_while_redis_is_down(monkeypatch):
+    server = fakeredis.FakeServer()
+    limiter = RateLimiter(rate=100, capacity=10, redis_client=fakeredis.FakeRedis(server=server))
+    server.connected = False
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.pause(0.01)
+    assert time.monotonic() - start < 0.5
+    assert limiter._bucket() is limiter.local
+
+    # redis is tried again once the retry window is over
+    server.connected = True
+    monkeypatch.setattr(limiter, "redis_down_until", 0.0)
+    limiter.acquire()
+    assert limiter._bucket() is limiter.shared
+    assert fakeredis.FakeRedis(server=server).exists(rate_limiter.REDIS_KEY)
+
+
+def test_unreachable_redis_server():
+    # nothing listens here, connecting fails straight away
+    client = redis.Redis(host="127.0.0.1", port=1, socket_connect_timeout=0.2, socket_timeout=0.2)
+    limiter = RateLimiter(rate=100, capacity=10, redis_client=client)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start < 1.0
+    assert limiter._bucket() is limiter.local
@@ -0,0 +1,110 @@
+import itertools
+
+import pytest
+from sqlalchemy import select
+
+from database import init_db, SessionLocal, saved_track_table
+from spotify_helpers import cache_all_music_data, cache_incremental
+from fake_spotify import FakeSpotify, liked
+
+# 4 pages of 50
+LIBRARY_SIZE = 200
+user_ids = (f"saved-sync-{i}" for i in itertools.count())
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    init_db()
+
+
+def synced_library(items=None):
+    """A user whose liked songs were fully synced once, and their fake client."""
+    user_id = next(user_ids)
+    sp = FakeSpotify(items if items is not None else [liked(i) for i in reversed(range(LIBRARY_SIZE))])
+    cache_all_music_data(sp, user_id)
+    sp.calls.clear()
+    return user_id, sp
+
+
+def saved_ids(user_id):
+    db = SessionLocal()
+    try:
+        return set(db.execute(
+            select(saved_track_table.c.track_id).where(saved_track_table.c.user_id == user_id)
+        ).scalars())
+    finally:
+        db.close()
+
+
+def sync(sp, user_id):
+    sp.calls.clear()
+    cache_incremental(sp, user_id)
+    return sp.calls["saved"]
+
+
+def expected(sp):
+    return {item["track"]["id"] for item in sp.saved if item["track"] and item["track"].get("id")}
+
+
+def test_nothing_changed_reads_one_page():
+    user_id, sp = synced_library()
+    assert sync(sp, user_id) == 1
+    assert saved_ids(user_id) == expected(sp)
+
+
+def test_new_like_reads_one_page():
+    user_id, sp = synced_library()
+    sp.saved.insert(0, liked(1000))
+    assert sync(sp, user_id) == 1
+    assert "t1000" in saved_ids(user_id)
+    assert saved_ids(user_id) == expected(sp)
+
+
+def test_relike_moves_to_the_top():
+    user_id, sp = synced_library()
+    item = sp.saved.pop(120)
+    sp.saved.insert(0, liked(int(item["track"]["id"][1:]), added_at="2025-01-01T00:00:00Z"))
+    assert sync(sp, user_id) == 1
+    assert saved_ids(user_id) == expected(sp)
+
+
+def test_unlike_newest_reads_one_page():
+    user_id, sp = synced_library()
+    sp.saved.pop(0)
+    assert sync(sp, user_id) == 1
+    assert saved_ids(user_id) == expected(sp)
+
+
+def test_unlike_old_song_is_found():
+    user_id, sp = synced_library()
+    sp.saved.pop(170)
+    # the count left is off by one until the walk gets there
+    assert sync(sp, user_id) == LIBRARY_SIZE // 50
+    assert saved_ids(user_id) == expected(sp)
+    # and the next sync is back to one page
+    assert sync(sp, user_id) == 1
+
+
+@pytest.mark.parametrize("position", [0, 60, 130, LIBRARY_SIZE])
+def test_items_without_a_track_dont_force_a_full_walk(position):
+    items = [liked(i) for i in reversed(range(LIBRARY_SIZE))]
+    added_at = items[min(position, len(items) - 1)]["added_at"]
+    items.insert(position, {"added_at": added_at, "track": None})
+    items.insert(position, {"added_at": added_at, "track": {"id": None, "name": "local file", "type": "track"}})
+    user_id, sp = synced_library(items)
+    assert saved_ids(user_id) == expected(sp)
+    assert sync(sp, user_id) == 1
+    sp.saved.insert(0, liked(1000))
+    assert sync(sp, user_id) == 1
+    assert saved_ids(user_id) == expected(sp)
+
+
+def test_new_item_without_a_track_is_counted():
+    user_id, sp = synced_library()
+    sp.saved.insert(0, {"added_at": "2025-01-01T00:00:00Z", "track": None})
+    assert sync(sp, user_id) == 1
+    sp.saved.append({"added_at": "2019-01-01T00:00:00Z", "track": None})
+    # one more item spotify has than the sync knows about, only a full walk can place it
+    assert sync(sp, user_id) == LIBRARY_SIZE // 50 + 1
+    assert sync(sp, user_id) == 1
+    assert saved_ids(user_id) == expected(sp)
@@ -0,0 +1,71 @@
+import random
+from collections import Counter
+
+import pytest
+
+import spread
+from spread import spread_order, _merge_python
+
+
+def zipf_keys(rnd, n, num_keys, exponent=1.0):
+    """Artist (or album) numbers for n tracks, a few keys with most of the tracks like a real library."""
+    weights = [1 / (k + 1) ** exponent for k in range(num_keys)]
+    return rnd.choices(range(num_keys), weights=weights, k=n)
+
+
+def repeats(order, keys, window):
+    """How many tracks share a key with one of the window - 1 tracks before them."""
+    last, count = {}, 0
+    for i, index in enumerate(order):
+        key = keys[index]
+        if i - last.get(key, -window) < window:
+            count += 1
+        last[key] = i
+    return count
+
+
+# (zipf exponent, number of keys, window), all with the top key under 1 / window of the tracks
+SKEWED = [(1.0, 200, 3), (1.2, 300, 3), (1.0, 500, 5), (0.8, 300, 5), (0.5, 400, 10)]
+
+
+@pytest.mark.parametrize("exponent,num_keys,window", SKEWED)
+@pytest.mark.parametrize("seed", range(10))
+def test_no_key_repeats_within_the_window(exponent, num_keys, window, seed):
+    rnd = random.Random(seed)
+    keys = zipf_keys(rnd, 2000, num_keys, exponent)
+    assert Counter(keys).most_common(1)[0][1] * window < len(keys)
+    order = spread_order(keys, rnd.getrandbits(63), window)
+    assert sorted(order) == list(range(len(keys)))
+    assert repeats(order, keys, window) == 0
+
+
+def test_dominant_key_still_gives_every_track_once():
+    # half the tracks by one artist can't all be kept apart, but nothing is lost or doubled
+    keys = [0] * 500 + list(range(1, 501))
+    order = spread_order(keys, 42, 3)
+    assert sorted(order) == list(range(len(keys)))
+
+
+def test_same_seed_replays_the_same_order():
+    keys = zipf_keys(random.Random(1), 1000, 100)
+    assert spread_order(keys, 7) == spread_order(keys, 7)
+    assert spread_order(keys, 7) != spread_order(keys, 8)
+    assert spread_order([], 7) == []
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_numpy_and_python_merges_match(seed):
+    pytest.importorskip("numpy")
+    rnd = random.Random(seed)
+    keys = zipf_keys(rnd, rnd.randint(1, 3000), rnd.randint(1, 400), rnd.choice([0.5, 1.0, 1.5]))
+    shuffle_seed = rnd.getrandbits(63)
+    assert spread._merge_numpy(keys, shuffle_seed) == _merge_python(keys, shuffle_seed)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2 ** 63 - 1])
+def test_spread_order_is_the_same_without_numpy(seed, monkeypatch):
+    pytest.importorskip("numpy")
+    keys = zipf_keys(random.Random(seed), 2000, 150)
+    with_numpy = spread_order(keys, seed, 4)
+    monkeypatch.setattr(spread, "np", None)
+    assert spread_order(keys, seed, 4) == with_numpy
@@ -0,0 +1,112 @@
+import pytest
+from sqlalchemy import select
+
+import fetcher
+import jobs
+from database import init_db, SessionLocal, Playlist, Genre, SyncJob, saved_track_table, playlist_track_table, \
+    user_playlist_table, user_genre_count_table
+from spotify_helpers import clear_user_cache, cache_all_music_data
+from fake_spotify import FakeSpotify, liked, track
+
+USER = "resume-user"
+FAIL_AT = 4
+
+
+class Inline:
+    """Runs a submitted job right away, so the test sees it finished."""
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class FlakySpotify(FakeSpotify):
+    """Fails reading one playlist's tracks while failing is set."""
+
+    failing = None
+
+    def playlist_tracks(self, playlist_id, **kwargs):
+        if playlist_id == self.failing:
+            self.failing = None
+            raise ConnectionError("connection reset")
+        return super().playlist_tracks(playlist_id, **kwargs)
+
+
+@pytest.fixture
+def sp(monkeypatch):
+    init_db()
+    monkeypatch.setattr(jobs, "_get_executor", lambda: Inline())
+    # one playlist at a time, so which ones were done when it failed doesn't depend on timing
+    monkeypatch.setattr(fetcher, "FETCH_WORKERS", 1)
+    playlists = [
+        {"id": f"resume-pl{p}", "name": f"playlist {p}", "snapshot_id": "s1", "images": [],
+         "items": [track(i, artist=f"ar{i % 13}") for i in range(p * 30, p * 30 + 40)]}
+        for p in range(8)
+    ]
+    return FlakySpotify([liked(i) for i in reversed(range(120))], playlists,
+                        genres={f"ar{i}": [f"genre {i % 4}"] for i in range(13)})
+
+
+def library_state(user_id):
+    db = SessionLocal()
+    try:
+        playlist_ids = set(db.execute(
+            select(user_playlist_table.c.playlist_id).where(user_playlist_table.c.user_id == user_id)
+        ).scalars())
+        playlists = {}
+        for playlist in db.query(Playlist).filter(Playlist.id.in_(playlist_ids)):
+            tracks = set(db.execute(
+                select(playlist_track_table.c.track_id).where(playlist_track_table.c.playlist_id == playlist.id)
+            ).scalars())
+            playlists[playlist.id] = (playlist.snapshot_id, playlist.num_tracks, tracks)
+        return {
+            "saved": dict(db.execute(
+                select(saved_track_table.c.track_id, saved_track_table.c.added_at)
+                .where(saved_track_table.c.user_id == user_id)
+            ).all()),
+            "playlists": playlists,
+            "genres": dict(db.execute(
+                select(Genre.name, user_genre_count_table.c.artist_count)
+                .join(Genre, Genre.id == user_genre_count_table.c.genre_id)
+                .where(user_genre_count_table.c.user_id == user_id)
+            ).all()),
+        }
+    finally:
+        db.close()
+
+
+def last_job(user_id):
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(SyncJob.status, SyncJob.kind).where(SyncJob.user_id == user_id).order_by(SyncJob.id.desc())
+        ).first()
+    finally:
+        db.close()
+
+
+def test_interrupted_full_refresh_resumes_from_its_checkpoints(sp):
+    sp.failing = sp.playlists[FAIL_AT]["id"]
+    jobs.submit_sync(sp, USER, "full_refresh")
+    assert tuple(last_job(USER)) == ("failed", "full_refresh")
+
+    # playlists before the failing one were committed at their snapshot, the rest weren't
+    state = library_state(USER)
+    assert len(state["saved"]) == 120
+    done = {playlist_id for playlist_id, (snapshot_id, _, _) in state["playlists"].items() if snapshot_id == "s1"}
+    assert done == {p["id"] for p in sp.playlists[:FAIL_AT]}
+
+    sp.calls.clear()
+    jobs.submit_sync(sp, USER, "full_refresh")
+    assert tuple(last_job(USER)) == ("done", "full_refresh")
+    # the retry skipped what was committed, liked songs only needed their first page
+    assert sp.calls["playlist_tracks"] == len(sp.playlists) - FAIL_AT
+    assert sp.calls["saved"] == 1
+    resumed = library_state(USER)
+
+    # the same as a full sync from nothing
+    clear_user_cache(USER)
+    cache_all_music_data(sp, USER)
+    clean = library_state(USER)
+    assert resumed == clean
+    assert all(snapshot_id == "s1" and num_tracks == len(tracks)
+               for snapshot_id, num_tracks, tracks in clean["playlists"].values())
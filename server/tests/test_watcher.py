@@ -0,0 +1,33 @@
+from database import init_db, SessionLocal, User, Bundle, BundleWatch, QueueSession
+from bundles import invalidate_bundle_plan
+from watcher import _load_listeners
+
+
+def listeners():
+    return {user_id: (token, plan) for user_id, token, plan in _load_listeners() if user_id.startswith("watch-")}
+
+
+def test_listeners_get_their_current_bundle_plan():
+    init_db()
+    db = SessionLocal()
+    for user_id in ("watch-a", "watch-b", "watch-c"):
+        db.add(User(id=user_id, bundles_version=1))
+        db.add(Bundle(user_id=user_id, intro_song_id=f"{user_id}-intro", main_song_id=f"{user_id}-main", strict=False))
+        db.add(BundleWatch(user_id=user_id, access_token=f"token-{user_id}"))
+    # a running shuffle already lays the bundles out, the watcher leaves that user alone
+    db.add(QueueSession(user_id="watch-c", track_ids="[]", active=True))
+    db.commit()
+
+    found = listeners()
+    assert set(found) == {"watch-a", "watch-b"}
+    token, plan = found["watch-a"]
+    assert token == "token-watch-a"
+    assert plan.match("watch-a-intro", set())[3] == "watch-a-main"
+
+    # a new bundle bumps the version, the next reload builds the plan again
+    db.add(Bundle(user_id="watch-a", intro_song_id="watch-a-intro2", main_song_id="watch-a-main2", strict=True))
+    invalidate_bundle_plan(db, "watch-a")
+    db.commit()
+    db.close()
+    _, plan = listeners()["watch-a"]
+    assert plan.match("watch-a-main2", set())[2] == "watch-a-intro2"
@@ -0,0 +1,153 @@
+import os
+import threading
+from array import array
+from collections import OrderedDict
+from sqlalchemy import select, func
+from database import User, Playlist, saved_track_table, playlist_track_table
+
+# ids kept across all cached sources, 4 bytes each plus the intern table
+STORE_SIZE = int(os.getenv("TRACK_STORE_SIZE", "2000000"))
+# the intern table only grows, past this it's dropped along with every source
+MAX_INTERNED = int(os.getenv("TRACK_STORE_MAX_INTERNED", "1000000"))
+
+
+def source_query(source):
+    # a stable order for the permutation to index into, walks the join table's primary key
+    kind, _, key = source.partition(":")
+    if kind == "saved":
+        return (select(saved_track_table.c.track_id)
+                .where(saved_track_table.c.user_id == key)
+                .order_by(saved_track_table.c.track_id))
+    if kind == "playlist":
+        return (select(playlist_track_table.c.track_id)
+                .where(playlist_track_table.c.playlist_id == key)
+                .order_by(playlist_track_table.c.track_id))
+    raise ValueError(f"unknown shuffle source {source}")
+
+
+def source_version(db, source):
+    """Cheap fingerprint of a source that changes whenever its tracks do.
+
+    Playlists change snapshot_id on every edit on spotify's side and
+    num_tracks on every edit made here, liked songs carry a counter that
+    every write to saved_tracks bumps (see invalidate_saved).
+    """
+    kind, _, key = source.partition(":")
+    if kind == "saved":
+        return tuple(db.execute(select(User.saved_tracks_version).where(User.id == key)).first() or ())
+    if kind == "playlist":
+        return tuple(db.execute(
+            select(Playlist.snapshot_id, Playlist.num_tracks).where(Playlist.id == key)
+        ).first() or ())
+    raise ValueError(f"unknown shuffle source {source}")
+
+
+class SourceTracks:
+    """A source's track ids, decoded from the interned ints on access."""
+
+    __slots__ = ("tracks", "names")
+
+    def __init__(self, tracks, names):
+        self.tracks = tracks
+        # the intern list is only appended to, or replaced when it's cleared, so this stays valid
+        self.names = names
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getitem__(self, i):
+        return self.names[self.tracks[i]]
+
+    def __iter__(self):
+        names = self.names
+        return (names[n] for n in self.tracks)
+
+
+class TrackStore:
+    """Track ids of shuffle sources as interned ints, one array('I') per source.
+
+    A 20k song library is 80KB here instead of 20k ORM rows, and reading
+    track n is an index instead of an OFFSET query. Entries are checked
+    against source_version on every get, so the other gunicorn worker's
+    writes are picked up without any messaging between them.
+    """
+
+    def __init__(self, size=STORE_SIZE, max_interned=MAX_INTERNED):
+        self.size = size
+        self.max_interned = max_interned
+        self.ids = []
+        self.index = {}
+        self.sources = OrderedDict()
+        self.stored = 0
+        self.lock = threading.Lock()
+
+    def _intern(self, track_ids):
+        with self.lock:
+            if len(self.index) + len(track_ids) > self.max_interned:
+                self._clear()
+            index, ids = self.index, self.ids
+            out = array("I")
+            for track_id in track_ids:
+                n = index.get(track_id)
+                if n is None:
+                    n = index[track_id] = len(ids)
+                    ids.append(track_id)
+                out.append(n)
+            return SourceTracks(out, ids)
+
+    def _clear(self):
+        self.ids = []
+        self.index = {}
+        self.sources.clear()
+        self.stored = 0
+
+    def get(self, db, source):
+        """The source's track ids in source_query order."""
+        version = source_version(db, source)
+        with self.lock:
+            cached = self.sources.get(source)
+            if cached and cached[0] == version:
+                self.sources.move_to_end(source)
+                return cached[1]
+
+        tracks = self._intern(db.execute(source_query(source)).scalars().all())
+        # sqlite runs each select on its own, a sync committing in between
+        # would pair new rows with the old version, so only keep a clean read
+        if source_version(db, source) != version:
+            return tracks
+        with self.lock:
+            old = self.sources.pop(source, None)
+            if old:
+                self.stored -= len(old[1])
+            if tracks.names is not self.ids:
+                # the intern table was cleared by another thread meanwhile
+                return tracks
+            self.sources[source] = (version, tracks)
+            self.stored += len(tracks)
+            while self.stored > self.size and len(self.sources) > 1:
+                _, (_, evicted) = self.sources.popitem(last=False)
+                self.stored -= len(evicted)
+        return tracks
+
+    def drop(self, source):
+        with self.lock:
+            old = self.sources.pop(source, None)
+            if old:
+                self.stored -= len(old[1])
+
+    def drop_user(self, user_id, playlist_ids=()):
+        self.drop(f"saved:{user_id}")
+        for playlist_id in playlist_ids:
+            self.drop(f"playlist:{playlist_id}")
+
+
+track_store = TrackStore()
+
+
+def invalidate_saved(db, user_id):
+    """Bump the user's liked songs version in the caller's transaction, like invalidate_bundle_plan."""
+    db.query(User).filter(User.id == user_id).update(
+        {User.saved_tracks_version: func.coalesce(User.saved_tracks_version, 0) + 1},
+        synchronize_session=False,
+    )
+    track_store.drop(f"saved:{user_id}")
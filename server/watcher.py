@@ -0,0 +1,360 @@
+import os
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from database import SessionLocal, User, BundleWatch, QueueSession
+from bundles import get_bundle_plan
+from rate_limiter import watching, WATCH_RATE
+from scheduler import add_startup_job, acquire_lease, release_lease
+from spotify_client import api_request
+from spotify_helpers import queue_bundle, skip_current
+
+# one worker runs the watcher for everybody
+WATCHER_LEASE_NAME = "bundle_watcher"
+WATCHER_LEASE = timedelta(seconds=90)
+# opted in users, their tokens and bundles are read again this often, which also renews the lease
+RELOAD_SECONDS = 30
+# threads making the blocking spotify calls, the loop itself never blocks
+WATCH_WORKERS = int(os.getenv("WATCH_WORKERS", "16"))
+
+# while something plays the next poll lands just after the track should end,
+# but no later than PLAYING_MAX_POLL so a skip onto an intro is still caught in time
+MIN_POLL = 2
+PLAYING_MAX_POLL = 15
+# nothing playing, backs off doubling up to IDLE_MAX_POLL
+IDLE_MIN_POLL = 15
+IDLE_MAX_POLL = 300
+# polls per second planned against the watch lane's rate, the rest is for queueing mains
+BUDGET_HEADROOM = 0.8
+# when polls don't fit, idle users still get this share, so someone starting to play is noticed
+IDLE_SHARE = 0.1
+# playing users' checks mid track are never stretched further apart than this
+MAX_STRETCH = 8
+
+
+class Listener:
+    """Watcher state for one user, only touched from the loop thread."""
+
+    def __init__(self, user_id, token, plan):
+        self.user_id = user_id
+        self.token = token
+        self.plan = plan
+        self.track_id = None
+        # intro queued by a strict redirect, so it starting doesn't queue the main twice
+        self.redirected_intro = None
+        # the interval react asked for, polls are this times the watcher's stretch apart
+        self.interval = MIN_POLL
+        self.playing = False
+        # seconds from the last poll until the playing track should end, None when nothing plays
+        self.ends_in = None
+        self.due = 0.0
+
+
+def react(listener, playing):
+    """What to queue for the track now playing, and seconds until the next poll.
+
+    playing is the currently-playing payload or None. Returns (track ids
+    to queue, whether to skip the current track, interval). An intro
+    starting queues its main, a strict bundle's main starting without its
+    intro right before is replaced by intro then main.
+    """
+    item = (playing or {}).get("item")
+    if not playing or not playing.get("is_playing") or not item or not item.get("id"):
+        return [], False, min(IDLE_MAX_POLL, max(IDLE_MIN_POLL, listener.interval * 2))
+
+    track_id = item["id"]
+    queue, skip = [], False
+    if track_id != listener.track_id:
+        bundle = listener.plan.match(track_id, set())
+        redirected = None
+        if bundle:
+            _, _, intro_id, main_id, strict = bundle
+            if track_id == intro_id:
+                if listener.redirected_intro != intro_id:
+                    queue = [main_id]
+            elif strict and listener.track_id != intro_id:
+                queue, skip = [intro_id, main_id], True
+                redirected = intro_id
+        listener.redirected_intro = redirected
+        listener.track_id = track_id
+
+    remaining = ((item.get("duration_ms") or 0) - (playing.get("progress_ms") or 0)) / 1000
+    return queue, skip, min(PLAYING_MAX_POLL, max(MIN_POLL, remaining + 1))
+
+
+def _now_playing(token):
+    # polls give way to shuffles, and stay within their own share of the api budget
+    with watching():
+        response = api_request("GET", "me/player/currently-playing", token)
+    if response.status_code == 204:
+        return 200, None
+    if response.status_code != 200:
+        return response.status_code, None
+    return 200, response.json()
+
+
+def _enforce(token, queue, skip):
+    with watching():
+        for track_id in queue:
+            queue_bundle(token, track_id)
+        if skip:
+            skip_current(token)
+
+
+def _load_listeners():
+    """(user_id, token, plan) for opted in users that have bundles and no shuffle running.
+
+    A running shuffle already lays bundles out in the queue it fills.
+    """
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(User.id, User.bundles_version, BundleWatch.access_token)
+            .join(BundleWatch, BundleWatch.user_id == User.id)
+            .outerjoin(QueueSession, (QueueSession.user_id == User.id) & (QueueSession.active == True))
+            .where(BundleWatch.access_token != None, QueueSession.user_id == None)
+        ).all()
+        listeners = []
+        for user_id, bundles_version, token in rows:
+            plan = get_bundle_plan(db, user_id, bundles_version)
+            if plan:
+                listeners.append((user_id, token, plan))
+        return listeners
+    finally:
+        db.close()
+
+
+def _expire_token(user_id, token):
+    db = SessionLocal()
+    try:
+        db.query(BundleWatch).filter(BundleWatch.user_id == user_id, BundleWatch.access_token == token).update(
+            {BundleWatch.access_token: None, BundleWatch.updated_at: datetime.utcnow()},
+            synchronize_session=False,
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+class Watcher:
+    """Polls currently-playing for every watched user from one asyncio loop.
+
+    Each user sits in a heap by when they're next due. Polls and the
+    queue calls they trigger run on a small thread pool through the pooled
+    session, so thousands of mostly idle users cost a heap entry each
+    rather than a thread each. When the polls asked for add up to more
+    than the watch lane's budget, intervals are stretched to fit, idle
+    users' first.
+    """
+
+    def __init__(self, workers=WATCH_WORKERS, budget=WATCH_RATE * BUDGET_HEADROOM):
+        self.workers = workers
+        self.budget = budget
+        # multipliers on playing and idle users' intervals, 1 while everything fits
+        self.stretch = (1.0, 1.0)
+        self.listeners = {}
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.stopping = False
+        self.stats = {"polls": 0, "queued": 0, "redirects": 0, "errors": 0}
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="bundle-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+
+    def _schedule(self, listener, delay):
+        listener.interval = delay
+        if listener.playing:
+            # stretching only thins out the checks mid track, the poll right after it ends still happens
+            delay = max(delay, min(delay * self.stretch[0], listener.ends_in))
+        else:
+            delay *= self.stretch[1]
+        listener.due = time.monotonic() + delay
+        heapq.heappush(self.heap, (listener.due, next(self.seq), listener.user_id))
+
+    def _playing_rate(self, stretch):
+        """Polls per second playing users make with their intervals stretched this much."""
+        return sum(
+            1 / max(listener.interval, min(listener.interval * stretch, listener.ends_in), MIN_POLL)
+            for listener in self.listeners.values() if listener.playing
+        )
+
+    def _update_stretch(self):
+        """Fit the polls per second the listeners ask for into the budget."""
+        idle = sum(1 / max(listener.interval, MIN_POLL) for listener in self.listeners.values() if not listener.playing)
+        playing = self._playing_rate(1.0)
+        if playing + idle <= self.budget:
+            self.stretch = (1.0, 1.0)
+            return
+        # idle users get what playing ones leave over, and at least IDLE_SHARE
+        idle_budget = min(idle, max(self.budget - playing, self.budget * IDLE_SHARE))
+        playing_budget = self.budget - idle_budget
+        # polls at the end of a track aren't stretched, so search for the stretch that fits
+        low, high = 1.0, MAX_STRETCH
+        if self._playing_rate(high) > playing_budget:
+            low = high
+        for _ in range(20):
+            if high - low < 0.05:
+                break
+            mid = (low + high) / 2
+            if self._playing_rate(mid) > playing_budget:
+                low = mid
+            else:
+                high = mid
+        self.stretch = (high, max(1.0, idle / idle_budget) if idle_budget > 0 else 1.0)
+
+    def _merge(self, rows):
+        seen, new = set(), []
+        for user_id, token, plan in rows:
+            seen.add(user_id)
+            listener = self.listeners.get(user_id)
+            if listener is None:
+                listener = self.listeners[user_id] = Listener(user_id, token, plan)
+                new.append(listener)
+            else:
+                listener.token, listener.plan = token, plan
+        # first polls are spread over as long as the budget needs for them, not all at once
+        spread = len(new) / self.budget
+        for listener in new:
+            self._schedule(listener, random.uniform(0, spread) if spread > 1 else 0)
+        # dropped users are left in the heap and skipped when they come up
+        for user_id in [u for u in self.listeners if u not in seen]:
+            del self.listeners[user_id]
+
+    async def _poll(self, listener, executor, slots):
+        loop = asyncio.get_running_loop()
+        async with slots:
+            try:
+                status, playing = await loop.run_in_executor(executor, _now_playing, listener.token)
+                self.stats["polls"] += 1
+                if status == 401:
+                    print(f"bundle watcher: token expired for {listener.user_id}")
+                    self.listeners.pop(listener.user_id, None)
+                    await loop.run_in_executor(executor, _expire_token, listener.user_id, listener.token)
+                    return
+                if status != 200:
+                    raise Exception(f"currently-playing returned {status}")
+                queue, skip, interval = react(listener, playing)
+                listener.playing = bool(playing and playing.get("is_playing"))
+                if listener.playing:
+                    item = playing.get("item") or {}
+                    listener.ends_in = ((item.get("duration_ms") or 0) - (playing.get("progress_ms") or 0)) / 1000 + 1
+                if queue:
+                    await loop.run_in_executor(executor, _enforce, listener.token, queue, skip)
+                    self.stats["queued"] += len(queue)
+                    self.stats["redirects"] += skip
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"bundle watcher: poll failed for {listener.user_id}: {e}")
+                listener.playing = False
+                interval = min(IDLE_MAX_POLL, max(IDLE_MIN_POLL, listener.interval * 2))
+        if self.listeners.get(listener.user_id) is listener:
+            self._schedule(listener, interval)
+
+    async def _reload(self, executor):
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(executor, acquire_lease, WATCHER_LEASE_NAME, WATCHER_LEASE):
+            print("bundle watcher: lost the lease, stopping")
+            self.stopping = True
+            return
+        self._merge(await loop.run_in_executor(executor, _load_listeners))
+        if self.stretch != (1.0, 1.0):
+            print(f"bundle watcher: over budget, intervals stretched {self.stretch[0]:.1f}x playing, {self.stretch[1]:.1f}x idle")
+
+    async def _main(self):
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="watch")
+        # keeps a backlog from turning into thousands of tasks parked on the pool
+        slots = asyncio.Semaphore(self.workers * 2)
+        tasks = set()
+        next_reload = next_stretch = 0.0
+        print("bundle watcher started")
+        try:
+            while not self.stopping:
+                now = time.monotonic()
+                if now >= next_reload:
+                    try:
+                        await self._reload(executor)
+                    except Exception as e:
+                        print(f"bundle watcher: reload failed: {e}")
+                    next_reload = now + RELOAD_SECONDS
+                    continue
+                if now >= next_stretch:
+                    self._update_stretch()
+                    next_stretch = now + 1
+
+                while self.heap and self.heap[0][0] <= now:
+                    due, _, user_id = heapq.heappop(self.heap)
+                    listener = self.listeners.get(user_id)
+                    if listener is None or listener.due != due:
+                        continue
+                    task = asyncio.create_task(self._poll(listener, executor, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                wake = next_reload
+                if self.heap:
+                    wake = min(wake, self.heap[0][0])
+                await asyncio.sleep(max(0.0, min(wake - time.monotonic(), 1.0)))
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False)
+            release_lease(WATCHER_LEASE_NAME)
+            print("bundle watcher stopped")
+
+
+_watcher = None
+_watcher_pid = None
+_watcher_lock = threading.Lock()
+
+
+def ensure_watcher():
+    """Start the watcher in this worker if no other worker holds its lease."""
+    global _watcher, _watcher_pid
+    with _watcher_lock:
+        if _watcher is not None and _watcher_pid == os.getpid() and _watcher.running():
+            return
+        if not acquire_lease(WATCHER_LEASE_NAME, WATCHER_LEASE):
+            return
+        _watcher = Watcher()
+        _watcher_pid = os.getpid()
+        _watcher.start()
+
+
+def set_watch(db, user_id, token, enabled):
+    """Opt a user in or out, in the caller's transaction. The watcher picks it up on its next reload."""
+    watch = db.get(BundleWatch, user_id)
+    if not enabled:
+        if watch:
+            db.delete(watch)
+        return
+    if watch is None:
+        watch = BundleWatch(user_id=user_id)
+        db.add(watch)
+    watch.access_token = token
+    watch.updated_at = datetime.utcnow()
+
+
+def refresh_watch_token(db, user_id, token):
+    """Hand a fresh token to an opted in user's watch, e.g. after they log in again."""
+    db.query(BundleWatch).filter(BundleWatch.user_id == user_id).update(
+        {BundleWatch.access_token: token, BundleWatch.updated_at: datetime.utcnow()},
+        synchronize_session=False,
+    )
+
+
+add_startup_job(ensure_watcher, id="bundle_watcher", trigger="interval", seconds=RELOAD_SECONDS, next_run_time=datetime.now())